@@ -0,0 +1,87 @@
+# app_log.py – Structured logging for operational messages
+#
+# Chat output (incoming messages, prompts, command results) stays on print().
+# Diagnostics (job failures, reconnects, dropped frames, handler errors) go
+# through stdlib logging under the "siphrix" logger so they have levels and can
+# be filtered or shipped as JSON lines:
+#
+#   log = app_log.get("scheduler")
+#   log.warning("job failed", extra={"kind": job["kind"]})
+#
+#   python user_send.py --log-level INFO --log-json --log-file siphrix.log
+#
+# Anything passed in `extra` becomes a field of the JSON record.
+
+import json
+import logging
+import sys
+
+ROOT = "siphrix"
+DEFAULT_LEVEL = "WARNING"
+
+# Attributes every LogRecord has; the rest came from `extra`
+_STANDARD = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname.lower(),
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _STANDARD:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """Looks like the rest of the console output, with the fields appended."""
+
+    ICONS = {"DEBUG": "🔹", "INFO": "ℹ️", "WARNING": "⚠️", "ERROR": "❌", "CRITICAL": "🚨"}
+
+    def format(self, record):
+        fields = " ".join(f"{k}={v}" for k, v in vars(record).items() if k not in _STANDARD)
+        text = f"{self.ICONS.get(record.levelname, '')} {record.getMessage()}"
+        if fields:
+            text += f" ({fields})"
+        if record.exc_info:
+            text += "\n" + self.formatException(record.exc_info)
+        return text
+
+
+def get(name):
+    return logging.getLogger(f"{ROOT}.{name}")
+
+
+def configure(level=DEFAULT_LEVEL, json_lines=False, path=None):
+    """Send "siphrix.*" records at `level` and above to stderr or `path`."""
+    logger = logging.getLogger(ROOT)
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    handler = logging.FileHandler(path, encoding="utf-8") if path else logging.StreamHandler(sys.stderr)
+    handler.setFormatter(JsonFormatter() if json_lines else TextFormatter())
+    logger.addHandler(handler)
+    logger.setLevel(level.upper() if isinstance(level, str) else level)
+    logger.propagate = False
+    return logger
+
+
+def options_from_args(argv):
+    """{"level", "json_lines", "path"} from --log-level / --log-json / --log-file."""
+    options = {"level": DEFAULT_LEVEL, "json_lines": "--log-json" in argv, "path": None}
+    for flag, key in (("--log-level", "level"), ("--log-file", "path")):
+        if flag in argv:
+            i = argv.index(flag)
+            if i + 1 >= len(argv):
+                raise SystemExit(f"❌ {flag} needs a value")
+            options[key] = argv[i + 1]
+    return options
+
+
+# Until configure() runs (tests, tools importing a module), warnings still show
+configure()
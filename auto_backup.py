@@ -1,11 +1,50 @@
+# auto_backup.py – Incremental, deduplicated, encrypted backups
+#
+#   auto_backups/chunks/<ab>/<sha256>    one compressed + encrypted chunk
+#   auto_backups/snapshots/<time>.snap   encrypted manifest: path -> size, mtime, chunk hashes
+#
+# Files are cut into CHUNK_SIZE pieces stored under their hash, so a chunk that
+# is already in the store is never written twice, and files whose size and
+# mtime match the previous snapshot are not read at all. Compression and
+# encryption (AES-GCM keyed from recovery.key) run on a thread pool; zlib and
+# AES-GCM release the GIL. Only the newest KEEP_SNAPSHOTS snapshots are kept
+# and chunks none of them use are deleted.
+#
+# Trade-off: the backup key comes from recovery.key, and recovery.key is not
+# in the backup (a backup that carries its own key protects nothing). Losing
+# that one file makes every snapshot unreadable, where the old zip backups
+# could still be opened. Keep a copy of recovery.key somewhere else; every
+# backup run says so.
+
+import hashlib
+import json
 import os
-import shutil
-import zipfile
+import threading
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from pathlib import Path
+
+import state_store
+from constants import GROUP_FILE, HISTORY_FILE, MESSAGE_STORE_DIR, OUTBOX_DIR, STATE_DB, USAGE_DIR, USAGE_FILE
+from cryptography.exceptions import InvalidTag
+
+from crypto_provider import cipher
+from key_storage import RECOVERY_KEY_FILE, derive_local_key
+from vault_manager import VAULT_DIR
 
 BACKUP_FOLDER = "auto_backups"
+CHUNK_DIR = os.path.join(BACKUP_FOLDER, "chunks")
+SNAPSHOT_DIR = os.path.join(BACKUP_FOLDER, "snapshots")
 LAST_BACKUP_FILE = "last_backup.txt"
+CHUNK_SIZE = 256 * 1024
+KEEP_SNAPSHOTS = 7
+COMPRESS_LEVEL = 6
+WORKERS = min(4, os.cpu_count() or 1)
+
+_running = threading.Lock()
+
 
 def should_backup(days=1):
     """Checks if a backup should run (once per X days)."""
@@ -21,35 +60,192 @@ def should_backup(days=1):
     delta = (datetime.now() - last_date).days
     return delta >= days
 
-def create_auto_backup():
-    username = load_or_create_username()
-    os.makedirs(BACKUP_FOLDER, exist_ok=True)
 
-    backup_dir = f"auto_temp_{username}"
-    zip_path = os.path.join(BACKUP_FOLDER, f"auto_backup_{username}.zip")
-    os.makedirs(backup_dir, exist_ok=True)
+# === Chunk store ===
+
+
+def _backup_cipher():
+    return cipher(derive_local_key(b"siphrix-backup"))
+
+
+def _chunk_path(digest):
+    return os.path.join(CHUNK_DIR, digest[:2], digest)
+
+
+def _write_atomic(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{threading.get_ident()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def _store_chunk(aead, data):
+    """Runs on a worker: returns (hash, bytes written)."""
+    digest = hashlib.sha256(data).hexdigest()
+    path = _chunk_path(digest)
+    if os.path.exists(path):
+        return digest, 0
+    sealed = aead.seal(zlib.compress(data, COMPRESS_LEVEL), digest.encode())
+    _write_atomic(path, sealed)
+    return digest, len(sealed)
+
+
+def _load_chunk(aead, digest):
+    with open(_chunk_path(digest), "rb") as f:
+        data = zlib.decompress(aead.open(f.read(), digest.encode()))
+    if hashlib.sha256(data).hexdigest() != digest:
+        raise ValueError(f"chunk {digest[:12]} is corrupt")
+    return data
+
+
+def _chunk_file(pool, aead, path):
+    """Store `path` chunk by chunk; at most a few chunks per worker are held in memory."""
+    pending = deque()
+    done = []
+    with open(path, "rb") as f:
+        while True:
+            data = f.read(CHUNK_SIZE)
+            if not data:
+                break
+            pending.append(pool.submit(_store_chunk, aead, data))
+            if len(pending) >= WORKERS * 4:
+                done.append(pending.popleft().result())
+    done += [future.result() for future in pending]
+    return [digest for digest, _ in done], sum(written for _, written in done)
 
-    files = [
-        f"{username}_keys.json",
-        "inbox_history.txt",
-        "usage_stats.json",
-        "offline_queue.json",
-        "groups.json"
-    ]
 
-    for file in files:
-        if os.path.exists(file):
-            shutil.copy(file, os.path.join(backup_dir, file))
+# === Snapshots ===
 
-    if os.path.exists("vault"):
-        shutil.copytree("vault", os.path.join(backup_dir, "vault"), dirs_exist_ok=True)
 
-    with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED) as zipf:
-        for file in Path(backup_dir).rglob("*"):
-            zipf.write(file, file.relative_to(backup_dir))
+def list_snapshots():
+    """Snapshot names, oldest first."""
+    if not os.path.isdir(SNAPSHOT_DIR):
+        return []
+    return sorted(name[:-5] for name in os.listdir(SNAPSHOT_DIR) if name.endswith(".snap"))
+
+
+def load_snapshot(name, aead=None):
+    aead = aead or _backup_cipher()
+    with open(os.path.join(SNAPSHOT_DIR, name + ".snap"), "rb") as f:
+        return json.loads(aead.open(f.read(), name.encode()))
+
+
+def _snapshot_name():
+    """Timestamp down to the microsecond, plus a counter if that name is somehow taken."""
+    base = datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+    name, n = base, 1
+    while os.path.exists(os.path.join(SNAPSHOT_DIR, name + ".snap")):
+        name, n = f"{base}-{n}", n + 1
+    return name
+
+
+def _sources(username):
+    paths = [path for path in (f"{username}_keys.json", HISTORY_FILE, USAGE_FILE, GROUP_FILE) if os.path.isfile(path)]
+    for folder in (VAULT_DIR, MESSAGE_STORE_DIR, OUTBOX_DIR, USAGE_DIR):
+        for root, _, names in os.walk(folder):
+            paths += sorted(os.path.join(root, name) for name in names)
+    return paths
+
+
+def create_auto_backup(username):
+    """Take one incremental snapshot. Blocking; run it off the event loop."""
+    if not _running.acquire(blocking=False):
+        print("🛡️  A backup is already running")
+        return None
+    try:
+        return _create_snapshot(username)
+    finally:
+        _running.release()
+
+
+def _create_snapshot(username):
+    start = time.time()
+    aead = _backup_cipher()
+    snapshots = list_snapshots()
+    previous = load_snapshot(snapshots[-1], aead)["files"] if snapshots else {}
+    os.makedirs(BACKUP_FOLDER, exist_ok=True)
+
+    files = {}
+    reread = written = 0
+    with ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix="backup") as pool:
+        for path in _sources(username):
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue  # removed since the walk (e.g. a compacted segment)
+            entry = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+            old = previous.get(path)
+            if old and old["size"] == entry["size"] and old["mtime_ns"] == entry["mtime_ns"] \
+                    and all(os.path.exists(_chunk_path(digest)) for digest in old["chunks"]):
+                entry["chunks"] = old["chunks"]
+            else:
+                entry["chunks"], size = _chunk_file(pool, aead, path)
+                reread += 1
+                written += size
+            files[path] = entry
+
+        # The live database is copied through SQLite so the snapshot is consistent
+        db_copy = os.path.join(BACKUP_FOLDER, "state.db.tmp")
+        state_store.backup_to(db_copy)
+        chunks, size = _chunk_file(pool, aead, db_copy)
+        files[STATE_DB] = {"size": os.path.getsize(db_copy), "mtime_ns": 0, "chunks": chunks}
+        os.remove(db_copy)
+        written += size
+
+    name = _snapshot_name()
+    manifest = {"created": start, "username": username, "files": files}
+    _write_atomic(os.path.join(SNAPSHOT_DIR, name + ".snap"), aead.seal(json.dumps(manifest).encode(), name.encode()))
+    removed = _prune(aead)
 
-    shutil.rmtree(backup_dir)
     with open(LAST_BACKUP_FILE, "w") as f:
         f.write(datetime.now().strftime("%Y-%m-%d"))
+    print(f"🛡️  Auto-backup snapshot {name}: {len(files)} files ({reread} re-read), "
+          f"{written // 1024} KB new, {removed} old chunks removed, {time.time() - start:.1f}s")
+    print(f"🔑 Backups can only be restored with {RECOVERY_KEY_FILE}, which they do not contain; "
+          f"keep a copy of it somewhere other than this folder.")
+    return name
+
+
+def _prune(aead):
+    """Keep the newest KEEP_SNAPSHOTS snapshots and delete unreferenced chunks."""
+    snapshots = list_snapshots()
+    for name in snapshots[:-KEEP_SNAPSHOTS]:
+        os.remove(os.path.join(SNAPSHOT_DIR, name + ".snap"))
+    live = set()
+    for name in snapshots[-KEEP_SNAPSHOTS:]:
+        for entry in load_snapshot(name, aead)["files"].values():
+            live.update(entry["chunks"])
+    removed = 0
+    for root, _, names in os.walk(CHUNK_DIR):
+        for digest in names:
+            if digest not in live:
+                os.remove(os.path.join(root, digest))
+                removed += 1
+    return removed
+
 
-    print(f"🛡️  Auto-backup created: {zip_path}")
+def restore_snapshot(name=None, target_dir="."):
+    """Write every file from snapshot `name` (default: newest) under `target_dir`."""
+    snapshots = list_snapshots()
+    if not snapshots:
+        print("❌ No backup snapshots found.")
+        return 0
+    if not os.path.exists(RECOVERY_KEY_FILE):
+        # derive_local_key() would quietly make a new one that opens nothing
+        print(f"❌ {RECOVERY_KEY_FILE} is missing; backups cannot be decrypted without it.")
+        return 0
+    aead = _backup_cipher()
+    try:
+        files = load_snapshot(name or snapshots[-1], aead)["files"]
+    except (InvalidTag, ValueError):
+        print(f"❌ This {RECOVERY_KEY_FILE} is not the one the backups were made with.")
+        return 0
+    for path, entry in files.items():
+        out = os.path.join(target_dir, path)
+        os.makedirs(os.path.dirname(out) or ".", exist_ok=True)
+        with open(out, "wb") as f:
+            for digest in entry["chunks"]:
+                f.write(_load_chunk(aead, digest))
+    print(f"♻️ Restored {len(files)} files from snapshot {name or snapshots[-1]}")
+    return len(files)
@@ -0,0 +1,69 @@
+# bench_crypto.py – Message encryption and signatures
+
+import asyncio
+import os
+import time
+
+from harness import bench
+
+
+def _loop(fn, count):
+    start = time.perf_counter()
+    for _ in range(count):
+        fn()
+    return count / (time.perf_counter() - start)
+
+
+@bench("crypto.encrypt_message")
+def encrypt(ctx):
+    from ecdh_encryption import encrypt_message
+    alice, bob = ctx.keys("alice"), ctx.keys("bob")
+    text = os.urandom(128).hex()
+    encrypt_message(alice[0], bob[1], text)  # session key derivation is cached after this
+    return _loop(lambda: encrypt_message(alice[0], bob[1], text), ctx.n(20000))
+
+
+@bench("crypto.decrypt_message")
+def decrypt(ctx):
+    from ecdh_encryption import decrypt_message, encrypt_message
+    alice, bob = ctx.keys("alice"), ctx.keys("bob")
+    blob = encrypt_message(alice[0], bob[1], os.urandom(128).hex())
+    decrypt_message(bob[0], alice[1], blob)
+    return _loop(lambda: decrypt_message(bob[0], alice[1], blob), ctx.n(20000))
+
+
+@bench("crypto.sign_message")
+def sign(ctx):
+    from ecdh_encryption import sign_message
+    alice = ctx.keys("alice")
+    return _loop(lambda: sign_message(alice[0], "hello bob"), ctx.n(5000))
+
+
+@bench("crypto.verify_signature")
+def verify(ctx):
+    from ecdh_encryption import sign_message, verify_signature
+    alice = ctx.keys("alice")
+    signature = sign_message(alice[0], "hello bob")
+    return _loop(lambda: verify_signature(alice[1], "hello bob", signature), ctx.n(3000))
+
+
+@bench("crypto.verify_batched")
+def verify_batched(ctx):
+    """Signature checks through crypto_pool, many in flight as on a busy channel."""
+    import crypto_pool
+    from ecdh_encryption import sign_message
+
+    alice = ctx.keys("alice")
+    signature = sign_message(alice[0], "hello bob")
+    count = ctx.n(3000)
+
+    async def run():
+        start = time.perf_counter()
+        results = await asyncio.gather(*(crypto_pool.verify(alice[1], "hello bob", signature) for _ in range(count)))
+        assert all(results)
+        return count / (time.perf_counter() - start)
+
+    try:
+        return asyncio.run(run())
+    finally:
+        crypto_pool.shutdown()
@@ -0,0 +1,163 @@
+# bench_messaging.py – Receive path, group fan-out, outbox, DHT, search, startup
+
+import asyncio
+import hashlib
+import os
+import subprocess
+import sys
+import time
+
+from harness import bench
+from loopback import pair, settle
+
+WORDS = ("meeting lunch tomorrow project deadline coffee weekend report budget release "
+         "#work #family @alice @bob invoice travel flight hotel photo music concert").split()
+
+
+def _text(i):
+    return " ".join(WORDS[(i * 7 + k * 3) % len(WORDS)] for k in range(8)) + f" note{i % 1000}"
+
+
+def _msg_frame(sender_priv, recipient_pub, sender, text):
+    from ecdh_encryption import encrypt_message, sign_message
+    msg_hash = hashlib.sha256(text.encode()).hexdigest()
+    encrypted = encrypt_message(sender_priv, recipient_pub, text)
+    return f"@msg::{sender}::{msg_hash}::None::{encrypted}::{sign_message(sender_priv, text)}"
+
+
+@bench("messaging.receive_msg", unit="msgs/s")
+def receive_msg(ctx):
+    """Full @msg:: handling on the receiver: decrypt, verify, state writes, store + index, receipts."""
+    import crypto_pool
+    import peer_connection
+    import search_index
+    from dispatcher import MessageDispatcher
+
+    alice, bob = ctx.keys("alice"), ctx.keys("bob")
+    peer_connection.public_keys["alice"] = alice[1]
+    search_index.open_index()
+    frames = [_msg_frame(alice[0], bob[1], "alice", _text(i)) for i in range(ctx.n(2000))]
+
+    async def run():
+        a, b = pair()
+        dispatcher = MessageDispatcher()
+        peer_connection.make_bind("bob", *bob)(b, dispatcher)
+        start = time.perf_counter()
+        # aiortc runs each message handler as its own task, so frames overlap like this
+        await asyncio.gather(*(dispatcher.dispatch(frame) for frame in frames))
+        await settle(a, b)
+        elapsed = time.perf_counter() - start
+        assert dispatcher.counts.get("msg") == len(frames) and not dispatcher.errors, dispatcher.errors
+        return len(frames) / elapsed
+
+    try:
+        return asyncio.run(run())
+    finally:
+        crypto_pool.shutdown()
+
+
+@bench("messaging.group_fanout", unit="msgs/s")
+def group_fanout(ctx):
+    """send_group_message to 20 members, each on its own pooled connection."""
+    import connection_pool
+    import group_session
+
+    alice = ctx.keys("alice")
+    members = [f"member{i}" for i in range(20)]
+    public_keys = {name: ctx.keys(name)[1] for name in members}
+    count = ctx.n(2000)
+
+    async def run():
+        links = []
+        for name in members:
+            a, b = pair(name)
+            connection_pool.adopt(name, a)
+            links.append(a)
+        group_session.send_group_message(links[0], "alice", alice[0], public_keys, "team", members + ["alice"], "hi")
+        start = time.perf_counter()
+        for i in range(count):
+            group_session.send_group_message(links[0], "alice", alice[0], public_keys, "team", members + ["alice"], _text(i))
+        elapsed = time.perf_counter() - start
+        await settle(*links)
+        assert all(link.frames >= count for link in links)
+        await connection_pool.close_all()
+        return count / elapsed
+
+    return asyncio.run(run())
+
+
+@bench("messaging.outbox_drain", unit="frames/s")
+def outbox_drain(ctx):
+    """Queue frames for an offline contact, then drain them to a peer that acks each one."""
+    import outbox
+    from wire_format import send_frame
+
+    count = ctx.n(5000)
+    payloads = [f"@msg::alice::{hashlib.sha256(str(i).encode()).hexdigest()}::None::{'x' * 200}::sig" for i in range(count)]
+    for payload in payloads:
+        outbox.queue("bob", payload)
+
+    async def run():
+        a, b = pair()
+        a.on("message", lambda frame: outbox.ack("bob", frame.split("::")[2]))
+        b.on("message", lambda frame: send_frame(b, f"@delivered::bob::{frame.split('::')[2]}"))
+        start = time.perf_counter()
+        await outbox.start_drain(a, "bob")
+        while outbox.pending_count("bob"):
+            await asyncio.sleep(0.001)
+        return count / (time.perf_counter() - start)
+
+    return asyncio.run(run())
+
+
+@bench("dht.merge_10k", unit="entries/s")
+def dht_merge(ctx):
+    import dht
+
+    dht.load("bench")
+    private_key, public_key = ctx.keys("peer")
+    now = time.time()
+    entries = [
+        dht.sign_entry({"username_hash": dht.node_id(f"user{i}"), "public_key": public_key,
+                        "status": "online", "avatar": None, "bio": "", "version": 1, "updated": now}, private_key)
+        for i in range(ctx.n(10000))
+    ]
+    start = time.perf_counter()
+    dht.merge(entries)
+    return len(entries) / (time.perf_counter() - start)
+
+
+@bench("search.query_100k", unit="queries/s", repeat=1)
+def search_query(ctx):
+    """user_send.search_messages over a message store of 100k records (results decrypted and printed)."""
+    import message_store
+    import search_index
+    import user_send
+    from ecdh_encryption import decrypt_message, encrypt_message
+
+    me = ctx.keys("me")
+    user_send.private_key, user_send.public_key = me
+    for i in range(ctx.n(100000)):
+        message_store.append_message(f"peer{i % 50}", message_store.DIRECTION_FROM, encrypt_message(me[0], me[1], _text(i)))
+    search_index.open_index()
+    search_index.rebuild_from_store(lambda record: decrypt_message(me[0], me[1], record["ciphertext"]))
+
+    queries = ["project deadline", "#work", "@alice", "meet*", "note42", "hotel flight photo"]
+    rounds = 20
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for query in queries:
+            user_send.search_messages(query)
+    return rounds * len(queries) / (time.perf_counter() - start)
+
+
+@bench("startup.import_user_send", unit="s", higher_is_better=False)
+def startup(ctx):
+    """Time for a fresh interpreter to import the entry point (everything before main())."""
+    env = dict(os.environ, PYTHONPATH=ctx.root)
+    code = "import time; t = time.perf_counter(); import user_send; print(time.perf_counter() - t)"
+    samples = []
+    for _ in range(3):
+        out = subprocess.run([sys.executable, "-c", code], env=env, capture_output=True, text=True, check=True)
+        samples.append(float(out.stdout.strip().splitlines()[-1]))
+    return min(samples)
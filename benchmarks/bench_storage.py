@@ -0,0 +1,113 @@
+# bench_storage.py – File transfer, vault and backups
+
+import asyncio
+import os
+import time
+
+from harness import bench, timed, write_file
+from loopback import attach, pair
+
+MB = 1024 * 1024
+
+
+@bench("file_transfer.offer_file", unit="MB/s", repeat=1)
+def transfer(ctx):
+    """Encrypted chunked transfer of one file between two loopback ends, until the receiver has it."""
+    import file_transfer
+    from dispatcher import MessageDispatcher
+
+    alice, bob = ctx.keys("alice"), ctx.keys("bob")
+    size = ctx.n(64 * MB, minimum=MB)
+    path = write_file("payload.bin", size)
+
+    async def run():
+        a, b = pair("xfer")
+        done = asyncio.get_running_loop().create_future()
+        for channel, name, keys, peers in ((a, "alice", alice, {"bob": bob[1]}), (b, "bob", bob, {"alice": alice[1]})):
+            dispatcher = MessageDispatcher()
+            file_transfer.register_handlers(
+                dispatcher, channel, name, keys[0], peers,
+                on_complete=lambda saved, state: done.done() or done.set_result(saved),
+            )
+            attach(channel, dispatcher)
+        start = time.perf_counter()
+        file_transfer.offer_file(a, "alice", alice[0], "bob", bob[1], path, "received.bin")
+        saved = await asyncio.wait_for(done, 600)
+        elapsed = time.perf_counter() - start
+        assert os.path.getsize(saved) == size
+        return size / MB / elapsed
+
+    return asyncio.run(run())
+
+
+def _vault(ctx, size):
+    import vault_manager
+    vault_manager.open_vault(*ctx.keys("me"))
+    return vault_manager, write_file("vault_src.bin", size)
+
+
+@bench("vault.store_file", unit="MB/s", repeat=1)
+def vault_store(ctx):
+    vault_manager, path = _vault(ctx, ctx.n(64 * MB, minimum=MB))
+    entry, seconds = timed(vault_manager.store_file, path)
+    return entry["size"] / MB / seconds
+
+
+@bench("vault.export_file", unit="MB/s", repeat=1)
+def vault_export(ctx):
+    vault_manager, path = _vault(ctx, ctx.n(64 * MB, minimum=MB))
+    entry = vault_manager.store_file(path)
+    _, seconds = timed(vault_manager.export_file, entry, "vault_out.bin")
+    return entry["size"] / MB / seconds
+
+
+@bench("vault.read_range", unit="ops/s")
+def vault_read_range(ctx):
+    """Random 4 KiB reads from a stored file (only the covering chunks are decrypted)."""
+    import random
+    vault_manager, path = _vault(ctx, 16 * MB)
+    entry = vault_manager.store_file(path)
+    rng = random.Random(0)
+    offsets = [rng.randrange(entry["size"] - 4096) for _ in range(ctx.n(2000))]
+    start = time.perf_counter()
+    for offset in offsets:
+        vault_manager.read_range(entry, offset, 4096)
+    return len(offsets) / (time.perf_counter() - start)
+
+
+def _backup_sources(ctx):
+    """A profile worth backing up: message store, vault and state DB."""
+    import message_store
+    import state_store
+    from ecdh_encryption import encrypt_message
+
+    me = ctx.keys("me")
+    for i in range(ctx.n(20000)):
+        message_store.append_message(f"peer{i % 20}", message_store.DIRECTION_TO, encrypt_message(me[0], me[1], f"message {i}"))
+    vault_manager, path = _vault(ctx, ctx.n(32 * MB, minimum=MB))
+    vault_manager.store_file(path)
+    os.remove(path)
+    with state_store.transaction():
+        for i in range(ctx.n(5000)):
+            state_store.put("sent_ids", state_store.message_key(f"peer{i % 20}", i), "x" * 64)
+
+
+@bench("backup.first_snapshot", unit="s", higher_is_better=False, repeat=1)
+def backup_first(ctx):
+    import auto_backup
+    _backup_sources(ctx)
+    _, seconds = timed(auto_backup.create_auto_backup, "bench")
+    return seconds
+
+
+@bench("backup.incremental_snapshot", unit="s", higher_is_better=False, repeat=1)
+def backup_incremental(ctx):
+    """Second snapshot after a few new messages: unchanged chunks must be skipped."""
+    import auto_backup
+    import message_store
+    _backup_sources(ctx)
+    auto_backup.create_auto_backup("bench")
+    for i in range(100):
+        message_store.append_message("peer0", message_store.DIRECTION_TO, f"new {i}")
+    _, seconds = timed(auto_backup.create_auto_backup, "bench")
+    return seconds
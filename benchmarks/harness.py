@@ -0,0 +1,57 @@
+# harness.py – Registry and helpers shared by the bench_*.py modules
+#
+#   @bench("crypto.encrypt_message", unit="ops/s")
+#   def encrypt(ctx):
+#       ...
+#       return ops / seconds
+#
+# A benchmark gets a Context and returns one number in its unit. run.py calls
+# each one in a fresh process whose working directory is an empty temp dir, so
+# the app's relative paths (state DB, message store, vault, ...) start empty.
+
+import os
+import time
+from functools import lru_cache
+
+BENCHMARKS = {}  # name -> {"fn", "unit", "higher_is_better", "repeat"}
+
+
+def bench(name, unit="ops/s", higher_is_better=True, repeat=None):
+    """Register a benchmark. `repeat` overrides run.py's --repeat for slow ones."""
+    def wrap(fn):
+        BENCHMARKS[name] = {"fn": fn, "unit": unit, "higher_is_better": higher_is_better, "repeat": repeat}
+        return fn
+    return wrap
+
+
+class Context:
+    def __init__(self, scale=1.0):
+        self.scale = scale
+        self.root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+    def n(self, base, minimum=1):
+        """`base` scaled by --scale."""
+        return max(minimum, int(base * self.scale))
+
+    @staticmethod
+    @lru_cache(maxsize=None)
+    def keys(name):
+        from ecdh_encryption import generate_keypair
+        return generate_keypair()
+
+
+def timed(fn, *args):
+    """(result, seconds) of one call."""
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+
+def write_file(path, size, block=1024 * 1024):
+    """A file of `size` random-ish bytes (compressible data would flatter zlib)."""
+    chunk = os.urandom(block)
+    with open(path, "wb") as f:
+        for written in range(0, size, block):
+            f.write(chunk[:min(block, size - written)])
+            chunk = chunk[1:] + chunk[:1]
+    return path
@@ -0,0 +1,73 @@
+# loopback.py – In-process stand-in for an aiortc RTCDataChannel pair
+#
+# send() on one end queues the frame for the other end's "message" handler on
+# the next loop iteration, like aiortc does, and bufferedAmount counts bytes
+# not delivered yet, so backpressure code paths run as they would for real.
+
+import asyncio
+
+
+class LoopbackChannel:
+    def __init__(self, label="loopback"):
+        self.label = label
+        self.peer = None
+        self.readyState = "open"
+        self.bufferedAmount = 0
+        self.frames = 0
+        self.bytes = 0
+        self._handlers = {}
+        self._tasks = set()
+
+    def on(self, event, handler=None):
+        if handler is None:
+            return lambda h: self.on(event, h) or h
+        self._handlers[event] = handler
+
+    def send(self, data):
+        if self.readyState != "open":
+            raise ConnectionError("channel closed")
+        size = len(data)
+        self.bufferedAmount += size
+        self.frames += 1
+        self.bytes += size
+        asyncio.get_running_loop().call_soon(self._deliver, data, size)
+
+    def _deliver(self, data, size):
+        self.bufferedAmount -= size
+        handler = self.peer._handlers.get("message") if self.peer else None
+        if handler is None:
+            return
+        result = handler(data)
+        if asyncio.iscoroutine(result):
+            task = asyncio.get_running_loop().create_task(result)
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    def close(self):
+        self.readyState = "closed"
+        for end in (self, self.peer):
+            if end and "close" in end._handlers:
+                end._handlers["close"]()
+
+
+def pair(label="loopback"):
+    """Two connected ends: (a, b)."""
+    a, b = LoopbackChannel(label + ":a"), LoopbackChannel(label + ":b")
+    a.peer, b.peer = b, a
+    return a, b
+
+
+def attach(channel, dispatcher):
+    """Feed frames arriving on `channel` into `dispatcher`, as peer_connection does."""
+    channel.on("message", dispatcher.dispatch)
+
+
+async def settle(*channels):
+    """Wait until nothing is in flight on `channels` and their handlers finished."""
+    while True:
+        await asyncio.sleep(0)
+        tasks = [t for c in channels for t in c._tasks]
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+        elif not any(c.bufferedAmount for c in channels):
+            return
@@ -0,0 +1,155 @@
+# run.py – Run the benchmark suite and compare it against a baseline
+#
+#   python benchmarks/run.py                       # everything, compared to baseline.json
+#   python benchmarks/run.py --only crypto. --scale 0.1
+#   python benchmarks/run.py --save-baseline       # record this machine's numbers
+#
+# Every benchmark runs in its own interpreter inside an empty temp directory, so
+# module caches, the state DB and the message store never leak between runs.
+# Results are written as JSON; with a baseline, any benchmark that got worse by
+# more than --threshold is reported and the exit status is 1.
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+from datetime import datetime
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path[:0] = [HERE, ROOT]
+
+import bench_crypto  # noqa: E402,F401  (registers benchmarks)
+import bench_messaging  # noqa: E402,F401
+import bench_storage  # noqa: E402,F401
+from harness import BENCHMARKS, Context  # noqa: E402
+
+DEFAULT_BASELINE = os.path.join(HERE, "baseline.json")
+
+
+def run_child(name, scale):
+    """Run one benchmark in this process and print its result as JSON."""
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")  # the app prints a line per message
+    try:
+        value = BENCHMARKS[name]["fn"](Context(scale))
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    print(json.dumps({"value": value}))
+
+
+def run_one(name, scale):
+    with tempfile.TemporaryDirectory(prefix="siphrix-bench-") as tmp:
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join([HERE, ROOT]))
+        proc = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--child", name, "--scale", str(scale)],
+            cwd=tmp, env=env, capture_output=True, text=True,
+        )
+    if proc.returncode != 0:
+        raise RuntimeError(f"{name} failed:\n{proc.stderr.strip()}")
+    return json.loads(proc.stdout.strip().splitlines()[-1])["value"]
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+                              capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def compare(results, baseline, threshold):
+    """Print a table against `baseline`. Returns the names that regressed."""
+    regressions = []
+    print(f"\n{'benchmark':34} {'value':>12} {'baseline':>12} {'change':>8}  unit")
+    for name, result in results.items():
+        base = baseline.get(name, {}).get("value")
+        change = ""
+        if base:
+            delta = (result["value"] - base) / base
+            better = delta if result["higher_is_better"] else -delta
+            change = f"{better:+.0%}"
+            if better < -threshold:
+                regressions.append(name)
+                change += " ❌"
+        base_text = f"{base:12.4g}" if base else f"{'-':>12}"
+        print(f"{name:34} {result['value']:12.4g} {base_text} {change:>8}  {result['unit']}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Siphrix benchmark suite")
+    parser.add_argument("--only", action="append", default=[], help="run benchmarks whose name starts with this")
+    parser.add_argument("--scale", type=float, default=1.0, help="multiply workload sizes (0.1 for a quick run)")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per benchmark; the median is reported")
+    parser.add_argument("--out", help="write results JSON here")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--save-baseline", action="store_true", help="write results to --baseline")
+    parser.add_argument("--threshold", type=float, default=0.15, help="allowed slowdown before failing")
+    parser.add_argument("--list", action="store_true")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        return run_child(args.child, args.scale)
+
+    names = [name for name in BENCHMARKS if not args.only or any(name.startswith(p) for p in args.only)]
+    if args.list:
+        print("\n".join(names))
+        return 0
+
+    results = {}
+    for name in names:
+        spec = BENCHMARKS[name]
+        runs = []
+        for _ in range(spec["repeat"] or args.repeat):
+            runs.append(run_one(name, args.scale))
+        results[name] = {
+            "value": statistics.median(runs),
+            "unit": spec["unit"],
+            "higher_is_better": spec["higher_is_better"],
+            "runs": runs,
+        }
+        print(f"⏱️  {name}: {results[name]['value']:.4g} {spec['unit']}", flush=True)
+
+    report = {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "commit": git_commit(),
+            "scale": args.scale,
+            "time": datetime.now().isoformat(timespec="seconds"),
+        },
+        "results": results,
+    }
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
+
+    baseline = {}
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get("meta", {}).get("scale") != args.scale:
+            print(f"⚠️  Baseline was recorded at --scale {baseline['meta'].get('scale')}; comparing anyway")
+        baseline = baseline["results"]
+    regressions = compare(results, baseline, args.threshold)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"💾 Baseline saved to {args.baseline}")
+    if regressions:
+        print(f"\n❌ {len(regressions)} regression(s) over {args.threshold:.0%}: {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
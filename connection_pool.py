@@ -0,0 +1,378 @@
+# connection_pool.py – One WebRTC connection per peer
+#
+# The chat used to run everything (contacts, group members, onion hops) over
+# the single data channel start_webrtc_chat made. The pool keeps a Peer per
+# username instead, each with its own RTCPeerConnection, dispatcher and send
+# queue drained by its own task, so a slow peer only backs up its own queue.
+#
+#   send(name, frame)    queue a frame on name's own connection (opened lazily
+#                        when a signaling function is configured for it)
+#   channel_for(name)    name's direct channel, else the DHT route, else the
+#                        primary link (the connection the chat started with)
+#
+# Connections idle for IDLE_TIMEOUT are closed by maintain() (scheduler job).
+# A connection that drops while frames are queued is re-established with
+# exponential backoff; after MAX_RETRIES the queue goes out over channel_for().
+
+import asyncio
+import random
+import time
+from collections import deque
+
+import app_log
+import dht
+import metrics
+import scheduler
+import wire_format
+from dispatcher import MessageDispatcher
+
+IDLE_TIMEOUT = 600  # seconds without traffic before a pooled connection is closed
+CONNECT_TIMEOUT = 30
+QUEUE_LIMIT = 1000  # frames waiting per peer
+HIGH_WATER = 1024 * 1024  # per-peer SCTP buffer level at which the pump waits
+BACKOFF_BASE = 1
+BACKOFF_MAX = 120
+MAX_RETRIES = 6
+
+_peers = {}  # username -> Peer
+_by_channel = {}  # id(channel) -> Peer
+_primary = None
+_hooks = {"bind": None, "opened": None, "closed": None, "signal": None, "auto": False}
+
+log = app_log.get("pool")
+
+
+class Peer:
+    def __init__(self, name):
+        self.name = name
+        self.pc = None
+        self.channel = None
+        self.dispatcher = None
+        self.state = "idle"  # idle -> connecting -> open -> closed
+        self.queue = deque()
+        self.wakeup = asyncio.Event()
+        self.pump = None
+        self.last_used = time.monotonic()
+        self.failures = 0
+        self.retry = None  # pending reconnect timer
+        self.pooled = True  # False for the primary link we did not open ourselves
+
+    def is_open(self):
+        return self.state == "open" and getattr(self.channel, "readyState", "open") == "open"
+
+
+def configure(bind, opened=None, closed=None, signal=None, auto=False):
+    """Set how connections are wired up.
+
+    bind(channel, dispatcher)   registers the frame handlers for a new channel
+    opened(name, channel) / closed(channel)   run when a channel opens / goes away
+    signal(name, offer) -> answer   coroutine exchanging SDP dicts with `name`
+    auto   open connections lazily from send(); otherwise only connect() does
+    """
+    _hooks.update(bind=bind, opened=opened, closed=closed, signal=signal, auto=auto)
+
+
+def set_signal(signal, auto=True):
+    """Swap the signaling function. Returns the previous (signal, auto)."""
+    previous = _hooks["signal"], _hooks["auto"]
+    _hooks.update(signal=signal, auto=auto)
+    return previous
+
+
+def set_primary(channel):
+    global _primary
+    _primary = channel
+
+
+# === Routing ===
+
+
+def _usable(channel):
+    return channel is not None and getattr(channel, "readyState", "open") == "open"
+
+
+def channel_for(name, default=None):
+    """The open channel to reach `name` on: direct, then DHT route, then the primary link."""
+    peer = _peers.get(name)
+    if peer is not None and peer.is_open():
+        return peer.channel
+    for channel in (dht.channel_for(name), default, _primary):
+        if _usable(channel):
+            return channel
+    return None
+
+
+def get(name):
+    return _peers.get(name)
+
+
+def peer_for(channel):
+    return _by_channel.get(id(channel))
+
+
+def adopt(name, channel):
+    """Record that `channel` (opened outside the pool) leads directly to `name`.
+
+    Only call this once `name` is proven on the channel (wire_format.verified_peer).
+    """
+    peer = _by_channel.get(id(channel))
+    if peer is not None:
+        return peer
+    peer = _peers.get(name)
+    if peer is not None and peer.is_open():
+        return peer
+    peer = _peers[name] = _peers.get(name) or Peer(name)
+    peer.channel, peer.state, peer.pooled = channel, "open", False
+    _by_channel[id(channel)] = peer
+    _start_pump(peer)
+    return peer
+
+
+def send(name, frame):
+    """Send `frame` to `name` over its own connection. Returns False if it was dropped."""
+    peer = _peers.get(name)
+    if peer is None and _hooks["auto"] and _hooks["signal"] is not None:
+        peer = connect(name)
+    if peer is None or peer.state == "closed" and peer.retry is None:
+        channel = channel_for(name)
+        if channel is None:
+            print(f"❌ No connection to {name}")
+            return False
+        wire_format.send_frame(channel, frame)
+        return True
+
+    peer.last_used = time.monotonic()
+    if peer.is_open() and not peer.queue and getattr(peer.channel, "bufferedAmount", 0) <= HIGH_WATER:
+        wire_format.send_frame(peer.channel, frame)
+        return True
+    if len(peer.queue) >= QUEUE_LIMIT:
+        metrics.inc("frames_dropped_total", reason="queue_full")
+        log.warning("Send queue for %s is full; frame dropped", name, extra={"peer": name})
+        return False
+    peer.queue.append(frame)
+    peer.wakeup.set()
+    return True
+
+
+# === Connections ===
+
+
+def connect(name):
+    """Open (or reuse) a direct connection to `name` in the background."""
+    if _hooks["signal"] is None:
+        raise RuntimeError("no signaling configured")
+    peer = _peers.get(name)
+    if peer is None:
+        peer = _peers[name] = Peer(name)
+    if peer.state in ("idle", "closed"):
+        peer.state = "connecting"
+        asyncio.get_running_loop().create_task(_connect(peer))
+    _start_pump(peer)
+    return peer
+
+
+async def _connect(peer):
+    from aiortc import RTCPeerConnection, RTCSessionDescription
+
+    await _close_pc(peer)
+    peer.pc = RTCPeerConnection()
+    _watch(peer)
+    _attach(peer, peer.pc.createDataChannel("siphrix"))
+    try:
+        await peer.pc.setLocalDescription(await peer.pc.createOffer())
+        offer = {"sdp": peer.pc.localDescription.sdp, "type": peer.pc.localDescription.type}
+        answer = await asyncio.wait_for(_hooks["signal"](peer.name, offer), CONNECT_TIMEOUT)
+        await peer.pc.setRemoteDescription(RTCSessionDescription(sdp=answer["sdp"], type=answer["type"]))
+    except Exception as e:
+        log.warning("Could not connect to %s: %s", peer.name, e, extra={"peer": peer.name})
+        _lost(peer)
+
+
+async def accept(name, offer):
+    """Answer an incoming offer from `name`. Returns the answer dict."""
+    from aiortc import RTCPeerConnection, RTCSessionDescription
+
+    peer = _peers.get(name)
+    if peer is None:
+        peer = _peers[name] = Peer(name)
+    await _close_pc(peer)
+    peer.state = "connecting"
+    peer.pc = RTCPeerConnection()
+    _watch(peer)
+    peer.pc.on("datachannel", lambda channel: _attach(peer, channel))
+    await peer.pc.setRemoteDescription(RTCSessionDescription(sdp=offer["sdp"], type=offer["type"]))
+    await peer.pc.setLocalDescription(await peer.pc.createAnswer())
+    _start_pump(peer)
+    return {"sdp": peer.pc.localDescription.sdp, "type": peer.pc.localDescription.type}
+
+
+def _watch(peer):
+    pc = peer.pc
+
+    @pc.on("connectionstatechange")
+    def on_state():
+        if pc is peer.pc and pc.connectionState in ("failed", "closed"):
+            _lost(peer)
+
+
+def _attach(peer, channel):
+    peer.channel = channel
+    peer.dispatcher = MessageDispatcher(channel)
+    _by_channel[id(channel)] = peer
+    if _hooks["bind"]:
+        _hooks["bind"](channel, peer.dispatcher)
+
+    @channel.on("message")
+    async def on_message(message):
+        peer.last_used = time.monotonic()
+        await peer.dispatcher.dispatch(message)
+
+    channel.on("open", lambda: _opened(peer, channel))
+    channel.on("close", lambda: peer.channel is channel and _lost(peer))
+    if getattr(channel, "readyState", None) == "open":
+        _opened(peer, channel)
+
+
+def _opened(peer, channel):
+    if peer.state == "open" and peer.channel is channel:
+        return
+    peer.state = "open"
+    peer.failures = 0
+    peer.last_used = time.monotonic()
+    print(f"🔗 Direct connection to {peer.name} is open")
+    if _hooks["opened"]:
+        _hooks["opened"](peer.name, channel)
+    peer.wakeup.set()
+
+
+def _lost(peer):
+    if peer.state == "closed":
+        return
+    peer.state = "closed"
+    channel = peer.channel
+    if channel is not None:
+        _by_channel.pop(id(channel), None)
+        if _hooks["closed"]:
+            _hooks["closed"](channel)
+    if peer.queue and peer.pooled and _hooks["signal"] is not None:
+        _schedule_reconnect(peer)
+    else:
+        _fall_back(peer)
+
+
+def _schedule_reconnect(peer):
+    if peer.failures >= MAX_RETRIES:
+        log.warning("Giving up on a direct connection to %s", peer.name, extra={"peer": peer.name})
+        peer.failures = 0
+        _fall_back(peer)
+        return
+    delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** peer.failures) * random.uniform(0.5, 1.5)
+    peer.failures += 1
+    metrics.inc("reconnects_total")
+    log.info("Reconnecting to %s in %.1fs", peer.name, delay, extra={"peer": peer.name})
+
+    def retry():
+        peer.retry = None
+        if peer.state == "closed":
+            connect(peer.name)
+
+    peer.retry = asyncio.get_running_loop().call_later(delay, retry)
+
+
+def _fall_back(peer):
+    """Hand queued frames to whatever route is left (DHT or the primary link)."""
+    channel = channel_for(peer.name)
+    while peer.queue and channel is not None:
+        wire_format.send_frame(channel, peer.queue.popleft())
+    if peer.queue:
+        metrics.inc("frames_dropped_total", len(peer.queue), reason="no_route")
+        log.warning("Dropped %d frame(s) for %s: no route", len(peer.queue), peer.name, extra={"peer": peer.name})
+        peer.queue.clear()
+
+
+def _start_pump(peer):
+    if peer.pump is None or peer.pump.done():
+        peer.pump = asyncio.get_running_loop().create_task(_pump(peer))
+
+
+async def _pump(peer):
+    while True:
+        await peer.wakeup.wait()
+        peer.wakeup.clear()
+        while peer.queue and peer.is_open():
+            if getattr(peer.channel, "bufferedAmount", 0) > HIGH_WATER:
+                await asyncio.sleep(0.01)
+                continue
+            wire_format.send_frame(peer.channel, peer.queue.popleft())
+            peer.last_used = time.monotonic()
+            await asyncio.sleep(0)
+
+
+async def _close_pc(peer):
+    if peer.pc is not None:
+        pc, peer.pc = peer.pc, None
+        await pc.close()
+
+
+# === Housekeeping ===
+
+
+def maintain(job=None):
+    """Close pooled connections that have been idle for IDLE_TIMEOUT (scheduler job)."""
+    now = time.monotonic()
+    for name, peer in list(_peers.items()):
+        if peer.pooled and peer.is_open() and not peer.queue and now - peer.last_used > IDLE_TIMEOUT:
+            log.info("Closing idle connection to %s", name, extra={"peer": name})
+            _lost(peer)
+            _forget(name)
+            asyncio.get_running_loop().create_task(_close_pc(peer))
+        elif peer.state == "closed" and not peer.queue and peer.retry is None:
+            _forget(name)
+
+
+def _forget(name):
+    peer = _peers.pop(name, None)
+    if peer is not None and peer.pump is not None:
+        peer.pump.cancel()
+
+
+def stats():
+    now = time.monotonic()
+    return {
+        name: {
+            "state": peer.state,
+            "pooled": peer.pooled,
+            "queued": len(peer.queue),
+            "idle": now - peer.last_used,
+            "failures": peer.failures,
+            "buffered": getattr(peer.channel, "bufferedAmount", 0),
+        }
+        for name, peer in _peers.items()
+    }
+
+
+def print_stats():
+    peers = stats()
+    if not peers:
+        print("📭 No peer connections.")
+        return
+    print("🔗 Peer connections:")
+    for name, s in sorted(peers.items()):
+        kind = "pooled" if s["pooled"] else "primary"
+        print(f"   - {name}: {s['state']} ({kind}), {s['queued']} queued, idle {s['idle']:.0f}s, "
+              f"{s['failures']} failed attempts")
+
+
+async def close_all():
+    for name in list(_peers):
+        peer = _peers[name]
+        if peer.retry is not None:
+            peer.retry.cancel()
+        _forget(name)
+        await _close_pc(peer)
+    _by_channel.clear()
+
+
+metrics.gauge("send_queue_depth", lambda: {name: len(peer.queue) for name, peer in _peers.items()}, label="peer")
+metrics.gauge("connections_open", lambda: sum(peer.is_open() for peer in _peers.values()))
+scheduler.register("connection_maintenance", maintain)
@@ -0,0 +1,109 @@
+# console.py – Non-blocking command input for the chat loop
+#
+# A reader thread (stdin or a named pipe) and optional localhost socket clients
+# push lines into one asyncio queue. The chat loop and every follow-up prompt
+# await that queue instead of calling input() on the event loop thread, so
+# aiortc, presence checks and file timers keep running while the user types.
+#
+#   python user_send.py                  interactive
+#   cmds.txt | python user_send.py       headless, commands from stdin
+#   python user_send.py --pipe /tmp/sx   headless, commands from a FIFO
+#   python user_send.py --listen 7701    headless, commands from 127.0.0.1:7701
+#
+# Headless input is one line per answer, in the order the prompts would ask.
+# With --listen the session ends like stdin does once the last client hangs up.
+
+import asyncio
+import os
+import sys
+import threading
+
+_loop = None
+_lines = None  # asyncio.Queue of input lines, None marks end of input
+_server = None
+_clients = 0  # sockets connected to _server
+interactive = True
+
+
+def source_from_args(argv):
+    """{"pipe": path} / {"port": n} from --pipe / --listen, or {} for stdin."""
+    source = {}
+    for flag, key, cast in (("--pipe", "pipe", str), ("--listen", "port", int)):
+        if flag in argv:
+            i = argv.index(flag)
+            if i + 1 >= len(argv):
+                raise SystemExit(f"❌ {flag} needs a value")
+            source[key] = cast(argv[i + 1])
+    return source
+
+
+async def start(pipe=None, port=None):
+    """Start collecting input lines on the running loop."""
+    global _loop, _lines, _server, interactive
+    _loop = asyncio.get_running_loop()
+    _lines = asyncio.Queue()
+    interactive = not (pipe or port) and sys.stdin.isatty()
+
+    if port:
+        _server = await asyncio.start_server(_serve_client, "127.0.0.1", port)
+        print(f"🛰️ Listening for commands on 127.0.0.1:{port}")
+    else:
+        threading.Thread(target=_read_stream, args=(pipe,), daemon=True).start()
+        if pipe:
+            print(f"🛰️ Reading commands from {pipe}")
+
+
+async def stop():
+    global _server
+    if _server is not None:
+        _server.close()
+        await _server.wait_closed()
+        _server = None
+
+
+def _push(line):
+    try:
+        _loop.call_soon_threadsafe(_lines.put_nowait, line)
+    except RuntimeError:
+        pass  # loop already closed
+
+
+def _read_stream(pipe):
+    if pipe and not os.path.exists(pipe):
+        os.mkfifo(pipe)
+    while True:
+        stream = open(pipe, "r", encoding="utf-8") if pipe else sys.stdin
+        for line in iter(stream.readline, ""):
+            _push(line.rstrip("\r\n"))
+        if not pipe:
+            break
+        # A FIFO hits EOF whenever its writer goes away; wait for the next one
+        stream.close()
+    _push(None)
+
+
+async def _serve_client(reader, writer):
+    global _clients
+    _clients += 1
+    try:
+        while line := await reader.readline():
+            _lines.put_nowait(line.decode("utf-8", errors="replace").rstrip("\r\n"))
+    finally:
+        writer.close()
+        _clients -= 1
+        if not _clients:
+            _lines.put_nowait(None)
+            _loop.create_task(stop())  # wait_closed() would wait for this very handler
+
+
+async def ask(prompt=""):
+    """Async replacement for input(). Raises EOFError once the input source is closed."""
+    if interactive:
+        print(prompt, end="", flush=True)
+    line = await _lines.get()
+    if line is None:
+        _lines.put_nowait(None)  # keep later callers seeing EOF too
+        raise EOFError
+    if not interactive and prompt:
+        print(f"{prompt}{line}")
+    return line
@@ -7,10 +7,16 @@ BLOCKED_EXTENSIONS = {'.exe', '.bat', '.cmd', '.sh', '.msi'}
 # Inbox history file
 HISTORY_FILE = "inbox_history.txt"
 
-# WebSocket settings (optional for future use)
+# Signaling server (signaling_server.py); use "wss" when it runs with --cert
 WS_HOST = "127.0.0.1"
 WS_PORT = 8000
-WS_PROTOCOL = "wss"
+WS_PROTOCOL = "ws"
 USAGE_FILE = "usage_stats.json"
 GROUP_FILE = "groups.json"
 PINNED_FILE = "pinned_messages.json"
+MESSAGE_STORE_DIR = "message_store"
+STATE_DB = "siphrix_state.db"
+OUTBOX_DIR = "outbox"
+USAGE_DIR = "usage"
+SIGNATURE_SCHEME = "ecdsa"  # "ed25519" once your contacts run a client that verifies it
+VAULT_BACKEND = "aesgcm"  # any crypto_provider backend; recorded per vault file
@@ -0,0 +1,80 @@
+# crypto_pool.py – Batched signature checks off the event loop
+#
+# Handlers await verify() instead of calling verify_signature() inline. Checks
+# that arrive together (a drained outbox, a busy group) are collected for up to
+# BATCH_DELAY seconds or BATCH_SIZE items, then split into one job per worker,
+# so the loop keeps reading frames and the console stays responsive. Workers
+# are threads so they share the parsed-key cache and the metrics registry.
+#
+#   if not await crypto_pool.verify(public_keys[sender], text, signature): ...
+
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+from ecdh_encryption import verify_signature
+
+BATCH_SIZE = 64
+BATCH_DELAY = 0.002  # seconds to wait for more signatures before flushing
+WORKERS = min(4, os.cpu_count() or 1)
+
+_executor = None
+_batch = []  # (future, (public_key, message, signature))
+_flush_timer = None
+
+
+def _verify_all(items):
+    return [verify_signature(*item) for item in items]
+
+
+def verify(public_key, message, signature):
+    """Awaitable verify_signature(); resolves to True/False."""
+    global _flush_timer
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+    _batch.append((future, (public_key, message, signature)))
+    if len(_batch) >= BATCH_SIZE:
+        _flush()
+    elif _flush_timer is None:
+        _flush_timer = loop.call_later(BATCH_DELAY, _flush)
+    return future
+
+
+def _flush():
+    global _batch, _flush_timer, _executor
+    if _flush_timer is not None:
+        _flush_timer.cancel()
+        _flush_timer = None
+    batch, _batch = _batch, []
+    if not batch:
+        return
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix="verify")
+    loop = asyncio.get_running_loop()
+    size = -(-len(batch) // WORKERS)
+    for start in range(0, len(batch), size):
+        part = batch[start:start + size]
+        job = loop.run_in_executor(_executor, _verify_all, [item for _, item in part])
+        job.add_done_callback(lambda done, part=part: _deliver(part, done))
+
+
+def _deliver(batch, job):
+    if job.cancelled() or job.exception() is not None:
+        for future, _ in batch:
+            if not future.done():
+                future.set_result(False)
+        return
+    for (future, _), ok in zip(batch, job.result()):
+        if not future.done():
+            future.set_result(ok)
+
+
+def shutdown():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False)
+        _executor = None
+
+
+metrics.gauge("verify_batch_pending", lambda: len(_batch))
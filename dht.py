@@ -0,0 +1,505 @@
+# dht.py – Kademlia routing table behind the dht.json peer directory
+#
+# Entries are the same dicts dht.json always held ({"username_hash",
+# "public_key", "status", "avatar", "bio"}) plus an "updated" timestamp.
+# A node id is the 256-bit sha256 of the username. Entries live in k-buckets
+# by XOR distance to our own id, so closest() only walks a few buckets and
+# exact lookups hit an in-memory dict. dht.json is now a snapshot of the
+# table, rewritten only when something changed.
+#
+# Remote lookups are Kademlia FIND_NODE / FIND_VALUE over the data channels
+# we currently have: peers we can reach are asked, closest to the target
+# first, ALPHA at a time, and whatever they return is merged into the table.
+#
+# Gossip is anti-entropy: each entry carries a "version" its owner bumps on
+# every change. Peers swap a Bloom filter of node hashes and
+# "hash:version:updated" keys plus a mask of their full buckets (dht_digest),
+# and answer with only the entries the other side lacks, holds an older
+# version of, or still has room for. A sync costs bytes proportional to what
+# changed, not to the table.
+#
+# Entries are signed by their owner (sign_entry) and the first key seen for a
+# node is kept: merge() drops unsigned entries and ones signed by another key,
+# so a peer cannot rewrite someone else's key, status or bio by bumping the
+# version. After key rotation the entry carries "rotation" (the previous key's
+# signature over the new one, see key_storage.rotate_keys); peers holding the
+# previous key accept the change and gossip it on.
+# Frames that add a route carry "ts" and "sig", a signature over
+# "dht-route:<from>:<to>:<ts>" checked against the entry we hold for <from>.
+
+import asyncio
+import hashlib
+import json
+import math
+import os
+import random
+import secrets
+import time
+
+from ecdh_encryption import b64url, from_b64url, sign_message, verify_rotation, verify_signature
+from wire_format import peer_name, send_frame
+
+DHT_FILE = "dht.json"
+ID_BITS = 256
+K = 20  # entries per bucket
+ALPHA = 3  # parallel queries per lookup round
+QUERY_TIMEOUT = 3
+BLOOM_FALSE_POSITIVE = 0.01
+REFRESH_AFTER = 3600  # seconds a bucket may go untouched before it is refreshed
+ROUTE_MAX_AGE = 300  # seconds a route signature stays valid
+
+_table = None
+_private_key = None  # signs our entry and route claims
+_dirty = False
+_routes = {}  # node hash -> channel we can query it on
+_queries = {}  # request id -> future for the dht_nodes reply
+
+
+def node_id(username):
+    return hashlib.sha256(username.encode()).hexdigest()
+
+
+def _distance(a_hex, b_hex):
+    return int(a_hex, 16) ^ int(b_hex, 16)
+
+
+class RoutingTable:
+    def __init__(self, self_hash):
+        self.self_hash = self_hash
+        self.self_id = int(self_hash, 16)
+        self.buckets = [{} for _ in range(ID_BITS)]  # hash -> entry, least recently seen first
+        self.replacements = [{} for _ in range(ID_BITS)]
+        self.touched = [0.0] * ID_BITS
+        self.index = {}  # every live entry (and our own) by hash
+
+    def bucket_index(self, hash_hex):
+        return (int(hash_hex, 16) ^ self.self_id).bit_length() - 1
+
+    def update(self, entry):
+        """Insert or refresh an entry. Returns True if the table changed."""
+        h = entry["username_hash"]
+        i = self.bucket_index(h)
+        if i < 0:
+            changed = self.index.get(h) != entry
+            self.index[h] = entry
+            return changed
+
+        bucket = self.buckets[i]
+        self.touched[i] = time.time()
+        if h in bucket:
+            changed = bucket.pop(h) != entry
+            bucket[h] = entry
+            self.index[h] = entry
+            return changed
+        if len(bucket) < K:
+            bucket[h] = entry
+            self.index[h] = entry
+            return True
+
+        # Full bucket: long-lived entries win, newcomers wait as replacements
+        replacements = self.replacements[i]
+        replacements.pop(h, None)
+        replacements[h] = entry
+        if len(replacements) > K:
+            replacements.pop(next(iter(replacements)))
+        return False
+
+    def remove(self, hash_hex):
+        i = self.bucket_index(hash_hex)
+        if i < 0 or self.buckets[i].pop(hash_hex, None) is None:
+            return False
+        del self.index[hash_hex]
+        if self.replacements[i]:
+            h, entry = self.replacements[i].popitem()
+            self.buckets[i][h] = entry
+            self.index[h] = entry
+        return True
+
+    def closest(self, target_hex, count=K):
+        """Up to `count` entries nearest to `target_hex`, nearest first."""
+        start = self.bucket_index(target_hex)
+        # Bucket `start` holds the nearest entries, all lower buckets come next
+        # (tied on the top bit), then each higher bucket is strictly farther.
+        # Looking up our own id, every bucket is one group sorted by distance.
+        if start < 0:
+            groups = [list(range(ID_BITS))]
+        else:
+            groups = [[start], list(range(start - 1, -1, -1))] + [[i] for i in range(start + 1, ID_BITS)]
+        target = int(target_hex, 16)
+        found = []
+        for group in groups:
+            entries = [e for i in group if i >= 0 for e in self.buckets[i].values()]
+            entries.sort(key=lambda e: int(e["username_hash"], 16) ^ target)
+            found += entries
+            if len(found) >= count:
+                break
+        return found[:count]
+
+    def full_mask(self):
+        """Bit i set when bucket i has no room left."""
+        return sum(1 << i for i, bucket in enumerate(self.buckets) if len(bucket) >= K)
+
+    def stale_buckets(self, now):
+        return [i for i, bucket in enumerate(self.buckets) if bucket and now - self.touched[i] > REFRESH_AFTER]
+
+    def __len__(self):
+        return len(self.index)
+
+
+# === Table & snapshot ===
+
+
+def load(username, private_key=None):
+    """Build the routing table for `username` from the dht.json snapshot (once)."""
+    global _table, _private_key
+    if private_key is not None:
+        _private_key = private_key
+    my_hash = node_id(username)
+    if _table is not None and _table.self_hash == my_hash:
+        return _table
+    _table = RoutingTable(my_hash)
+    if os.path.exists(DHT_FILE):
+        with open(DHT_FILE, "r", encoding="utf-8") as f:
+            for entry in json.load(f):
+                _table.update(entry)
+    return _table
+
+
+def save(force=False):
+    """Write the snapshot if the table changed since the last save."""
+    global _dirty
+    if _table is None or not (_dirty or force):
+        return
+    entries = sorted(_table.index.values(), key=lambda e: _distance(_table.self_hash, e["username_hash"]))
+    tmp = DHT_FILE + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(entries, f, indent=2)
+    os.replace(tmp, DHT_FILE)
+    _dirty = False
+
+
+def update(entry):
+    global _dirty
+    entry.setdefault("updated", time.time())
+    if _table.update(entry):
+        _dirty = True
+        return True
+    return False
+
+
+def _freshness(entry):
+    return entry.get("version", 0), entry.get("updated", 0)
+
+
+def _signed_text(entry):
+    return json.dumps({k: v for k, v in entry.items() if k != "signature"}, sort_keys=True, separators=(",", ":"))
+
+
+def sign_entry(entry, private_key):
+    entry["signature"] = sign_message(private_key, _signed_text(entry))
+    return entry
+
+
+def verify_entry(entry, current=None):
+    """True if `entry` is signed with its own key and keeps the key of `current`,
+    or hands over from it with a "rotation" signed by that key."""
+    key, signature = entry.get("public_key"), entry.get("signature")
+    if not isinstance(key, str) or not isinstance(signature, str):
+        return False
+    previous = current.get("public_key") if current is not None else None
+    if previous not in (None, key) and not verify_rotation(previous, key, entry.get("rotation")):
+        return False
+    return verify_signature(key, _signed_text(entry), signature)
+
+
+def merge(entries):
+    """Merge signed entries received from a peer; higher version (then newer "updated") wins.
+
+    Returns how many entries changed.
+    """
+    changed = 0
+    for entry in entries:
+        if not isinstance(entry, dict) or not isinstance(entry.get("username_hash"), str):
+            continue
+        if entry["username_hash"] == _table.self_hash:
+            continue  # only we publish our own entry
+        current = _table.index.get(entry["username_hash"])
+        if current is not None and _freshness(current) >= _freshness(entry):
+            continue
+        if "updated" not in entry or not verify_entry(entry, current):
+            continue
+        changed += update(dict(entry))
+    return changed
+
+
+def find_value(username):
+    """Local exact lookup: the entry for `username`, or None."""
+    return _table.index.get(node_id(username)) if _table else None
+
+
+def closest(username, count=K):
+    return _table.closest(node_id(username), count)
+
+
+def publish(entry, private_key=None):
+    """Replace our own entry, bumping its version and signing it when the content changed."""
+    private_key = private_key or _private_key
+    current = _table.index.get(entry["username_hash"], {})
+    same = all(current.get(k) == v for k, v in entry.items() if k not in ("version", "updated"))
+    if same and current.get("signature"):
+        return False
+    entry["version"] = current.get("version", 0) + 1
+    entry["updated"] = time.time()
+    sign_entry(entry, private_key)
+    return update(entry)
+
+
+# === Anti-entropy gossip ===
+
+
+class BloomFilter:
+    def __init__(self, bits, hashes, seed, data=None):
+        self.bits = bits
+        self.hashes = hashes
+        self.seed = seed
+        self.data = bytearray(data) if data is not None else bytearray((bits + 7) // 8)
+
+    @classmethod
+    def for_items(cls, count, seed, error=BLOOM_FALSE_POSITIVE):
+        bits = max(64, math.ceil(-count * math.log(error) / math.log(2) ** 2))
+        hashes = max(1, round(bits / max(count, 1) * math.log(2)))
+        return cls(bits, hashes, seed)
+
+    def _positions(self, item):
+        digest = hashlib.sha256(self.seed + item.encode()).digest()
+        h1 = int.from_bytes(digest[:8], "big")
+        h2 = int.from_bytes(digest[8:16], "big") | 1
+        return [(h1 + i * h2) % self.bits for i in range(self.hashes)]
+
+    def add(self, item):
+        for pos in self._positions(item):
+            self.data[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, item):
+        return all(self.data[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(item))
+
+    def to_json(self):
+        return {"bits": self.bits, "hashes": self.hashes, "seed": b64url(self.seed), "data": b64url(bytes(self.data))}
+
+    @classmethod
+    def from_json(cls, obj):
+        """A peer's filter; raises ValueError for sizes digest() would never produce."""
+        bits, hashes, data = obj["bits"], obj["hashes"], from_b64url(obj["data"])
+        if not isinstance(bits, int) or not isinstance(hashes, int):
+            raise ValueError("Bloom filter size is not an integer")
+        if not 0 < bits <= MAX_BLOOM_BITS or (bits + 7) // 8 != len(data):
+            raise ValueError(f"Bloom filter of {bits} bits with {len(data)} bytes of data")
+        if not 0 < hashes <= MAX_BLOOM_HASHES:
+            raise ValueError(f"Bloom filter with {hashes} hash functions")
+        return cls(bits, hashes, from_b64url(obj["seed"]), data)
+
+
+# A full table is K entries in each of ID_BITS buckets, plus our own; digest() adds two keys per entry
+MAX_BLOOM_BITS = BloomFilter.for_items(2 * (K * ID_BITS + 1), b"").bits
+MAX_BLOOM_HASHES = 64  # for_items() tops out at 44: the 64-bit minimum holding a single item
+
+
+def _digest_key(entry):
+    return f"{entry['username_hash']}:{entry.get('version', 0)}:{entry.get('updated', 0)}"
+
+
+def digest():
+    """Bloom filter over every entry we hold, with a fresh seed so false positives differ per sync."""
+    bloom = BloomFilter.for_items(2 * len(_table.index), os.urandom(8))
+    for entry in _table.index.values():
+        bloom.add(entry["username_hash"])
+        bloom.add(_digest_key(entry))
+    return bloom
+
+
+def missing_from(bloom, peer_hash, full_mask=0):
+    """Our entries the digest's owner lacks, holds an older version of, or has room for."""
+    peer_id = int(peer_hash, 16)
+    delta = []
+    for entry in _table.index.values():
+        if _digest_key(entry) in bloom:
+            continue
+        if entry["username_hash"] not in bloom:
+            bucket = (int(entry["username_hash"], 16) ^ peer_id).bit_length() - 1
+            if bucket >= 0 and full_mask >> bucket & 1:
+                continue  # the peer's bucket is full, it would only drop this
+        delta.append(entry)
+    return delta
+
+
+def _digest_frame(channel, username, reply=False):
+    bloom = digest()
+    frame = {"type": "dht_digest", "from": username, "bloom": bloom.to_json(), "full": f"{_table.full_mask():x}"}
+    if reply:
+        frame["reply"] = True
+    return json.dumps(_stamp(frame, channel))
+
+
+def start_sync(channel, username):
+    """Open an anti-entropy round: send our digest, the peer answers with what we lack."""
+    frame = _digest_frame(channel, username)
+    send_frame(channel, frame)
+    return len(frame)
+
+
+# === Routes ===
+
+
+def _stamp(frame, channel):
+    """Sign "from" for the peer on `channel` so it may route to us over it."""
+    to = peer_name(channel)
+    if _private_key is not None and to:
+        frame["ts"] = int(time.time())
+        frame["sig"] = sign_message(_private_key, f"dht-route:{frame['from']}:{to}:{frame['ts']}")
+    return frame
+
+
+def _proves_sender(parsed, username):
+    """True if the frame is signed, recently and for us, by the key we hold for "from"."""
+    sender, ts, sig = parsed.get("from"), parsed.get("ts"), parsed.get("sig")
+    if not isinstance(sender, str) or not isinstance(ts, int) or not isinstance(sig, str):
+        return False
+    if abs(time.time() - ts) > ROUTE_MAX_AGE:
+        return False
+    entry = _table.index.get(node_id(sender))
+    if entry is None or not entry.get("signature"):
+        return False
+    return verify_signature(entry["public_key"], f"dht-route:{sender}:{username}:{ts}", sig)
+
+
+def add_route(username, channel):
+    """Remember that `username` can be queried over `channel`."""
+    _routes[node_id(username)] = channel
+
+
+def channel_for(username):
+    """The channel `username` was last heard on, if any."""
+    return _routes.get(node_id(username))
+
+
+def drop_channel(channel):
+    for h in [h for h, c in _routes.items() if c is channel]:
+        del _routes[h]
+
+
+# === Iterative lookups ===
+
+
+async def _query(node_hash, username, target_hex, find_value):
+    rid = secrets.token_hex(8)
+    future = asyncio.get_running_loop().create_future()
+    _queries[rid] = future
+    frame = {"type": "dht_find_value" if find_value else "dht_find_node", "from": username, "rid": rid, "target": target_hex}
+    try:
+        channel = _routes[node_hash]
+        send_frame(channel, json.dumps(_stamp(frame, channel)))
+        return await asyncio.wait_for(future, QUERY_TIMEOUT)
+    except (asyncio.TimeoutError, KeyError):
+        return None
+    finally:
+        _queries.pop(rid, None)
+
+
+async def lookup(username, target_hex, find_value=False):
+    """Iterative FIND_NODE / FIND_VALUE for `target_hex`.
+
+    Returns the value entry (find_value) or the K closest entries known afterwards.
+    """
+    if find_value and target_hex in _table.index:
+        return _table.index[target_hex]
+
+    queried = {_table.self_hash}
+    best = None
+    while True:
+        candidates = sorted((h for h in _routes if h not in queried), key=lambda h: _distance(h, target_hex))
+        batch = candidates[:ALPHA]
+        if not batch:
+            break
+        queried.update(batch)
+        replies = await asyncio.gather(*(_query(h, username, target_hex, find_value) for h in batch))
+
+        for reply in replies:
+            if not reply:
+                continue
+            if find_value and reply.get("value"):
+                merge([reply["value"]])
+                return reply["value"]
+            merge(reply.get("nodes", []))
+
+        nearest = _table.closest(target_hex, 1)
+        nearest = _distance(nearest[0]["username_hash"], target_hex) if nearest else None
+        if best is not None and (nearest is None or nearest >= best):
+            break  # a full round without getting closer
+        best = nearest
+    save()
+    return None if find_value else _table.closest(target_hex)
+
+
+async def lookup_user(username, target_username):
+    """FIND_VALUE for a username: local index first, then the network."""
+    return find_value(target_username) or await lookup(username, node_id(target_username), find_value=True)
+
+
+def random_id_in_bucket(i):
+    """A random id whose distance to us falls in bucket i."""
+    distance = (1 << i) | random.getrandbits(i)
+    return f"{_table.self_id ^ distance:064x}"
+
+
+async def refresh_buckets(username):
+    """Look up a random id in every bucket nobody touched for REFRESH_AFTER seconds."""
+    for i in _table.stale_buckets(time.time()):
+        _table.touched[i] = time.time()
+        await lookup(username, random_id_in_bucket(i))
+
+
+# === Frame handlers ===
+
+
+def register_handlers(dispatcher, channel, username):
+    load(username)
+
+    def route(parsed):
+        # Only a sender that signed for us may be reached through this channel
+        if _proves_sender(parsed, username):
+            add_route(parsed["from"], channel)
+
+    def on_share(parsed):
+        changed = merge(parsed.get("data", []))
+        route(parsed)  # after merging: their own entry may have just arrived
+        save()
+        print(f"🤝 Merged {changed} of {len(parsed.get('data', []))} DHT entries from {parsed['from']}.")
+
+    def on_digest(parsed):
+        route(parsed)
+        bloom = BloomFilter.from_json(parsed["bloom"])
+        delta = missing_from(bloom, node_id(parsed["from"]), int(parsed.get("full", "0"), 16))
+        if delta:
+            send_frame(channel, json.dumps(_stamp({"type": "dht_share", "from": username, "data": delta}, channel)))
+        if not parsed.get("reply"):
+            # Let the initiator send us what we are missing too
+            send_frame(channel, _digest_frame(channel, username, reply=True))
+
+    def on_find(parsed):
+        route(parsed)
+        target = parsed["target"]
+        reply = {"type": "dht_nodes", "rid": parsed["rid"], "nodes": _table.closest(target)}
+        if parsed["type"] == "dht_find_value":
+            reply["value"] = _table.index.get(target)
+        send_frame(channel, json.dumps(reply))
+
+    def on_nodes(parsed):
+        future = _queries.get(parsed.get("rid"))
+        if future is not None and not future.done():
+            future.set_result(parsed)
+
+    dispatcher.register("dht_share", on_share)
+    dispatcher.register("dht_digest", on_digest)
+    dispatcher.register("dht_find_node", on_find)
+    dispatcher.register("dht_find_value", on_find)
+    dispatcher.register("dht_nodes", on_nodes)
@@ -0,0 +1,145 @@
+# dispatcher.py – Table-driven routing for incoming data-channel frames
+#
+# Two frame shapes exist on the wire:
+#   "@type::field1::field2..."   text commands (@msg::, @ping::, ...)
+#   {"type": "...", ...}         JSON frames (onion, dht_share)
+# plus binary envelopes (see wire_format.py) once a peer has negotiated them.
+# Each frame is parsed exactly once, the handler is found with one dict lookup,
+# and per-type counters / latency histograms are kept for /protostats (per
+# connection) and in the metrics registry (all connections).
+
+import asyncio
+import json
+import time
+
+import app_log
+import metrics
+import usage_store
+import wire_format
+
+log = app_log.get("dispatcher")
+
+# Upper bounds (ms) of the latency histogram buckets; the last one catches the rest
+LATENCY_BUCKETS_MS = (0.1, 0.5, 1, 5, 10, 50, 100, 500, 1000, float("inf"))
+
+RAW = "raw"  # type name used for frames no handler claims
+INVALID = "invalid"  # type name used for frames that could not be decoded
+
+
+def parse_frame(frame):
+    """Return (type, payload). payload is a list of fields or a parsed JSON dict."""
+    if wire_format.is_binary_frame(frame):
+        return wire_format.decode_frame(frame)
+    if isinstance(frame, bytes):
+        frame = frame.decode("utf-8")
+    if frame.startswith("@"):
+        head, sep, rest = frame.partition("::")
+        if sep:
+            return head[1:], rest
+    elif frame.startswith("{"):
+        try:
+            parsed = json.loads(frame)
+        except ValueError:
+            return RAW, frame
+        if isinstance(parsed, dict) and "type" in parsed:
+            return parsed["type"], parsed
+    return RAW, frame
+
+
+class MessageDispatcher:
+    def __init__(self, channel=None):
+        self.channel = channel  # the connection frames arrive on, for usage by contact
+        self.handlers = {}
+        self.arity = {}
+        self.counts = {}
+        self.errors = {}
+        self.histograms = {}
+        self.total_ms = {}
+
+    def register(self, msg_type, handler, fields=None):
+        """Route `msg_type` to `handler`.
+
+        Text frames are split into at most `fields` parts (the last part keeps
+        any further "::"), JSON frames are passed as the parsed dict. Handlers
+        may be plain functions or coroutines.
+        """
+        self.handlers[msg_type] = handler
+        self.arity[msg_type] = fields
+
+    def on(self, msg_type, fields=None):
+        """Decorator form of register()."""
+        def wrap(handler):
+            self.register(msg_type, handler, fields)
+            return handler
+        return wrap
+
+    def _route(self, frame):
+        """(type, handler, payload) for a frame; raises if it cannot be decoded."""
+        msg_type, payload = parse_frame(frame)
+        handler = self.handlers.get(msg_type)
+        if handler is None or msg_type == RAW:
+            msg_type, handler = RAW, self.handlers.get(RAW)
+            payload = frame.decode("utf-8") if isinstance(frame, bytes) else frame
+        elif isinstance(payload, str):
+            fields = self.arity[msg_type]
+            payload = payload.split("::", fields - 1) if fields else payload.split("::")
+        return msg_type, handler, payload
+
+    async def dispatch(self, frame):
+        start = time.perf_counter()
+        msg_type, payload = INVALID, None
+        try:
+            msg_type, handler, payload = self._route(frame)
+            if handler is not None:
+                result = handler(payload)
+                if asyncio.iscoroutine(result):
+                    await result
+        except Exception as e:
+            self.errors[msg_type] = self.errors.get(msg_type, 0) + 1
+            metrics.inc("frame_errors_total", type=msg_type)
+            if msg_type == INVALID:
+                # Unknown tag, bad version, truncated varint, bad UTF-8...: drop it
+                metrics.inc("frames_dropped_total", reason="undecodable")
+                log.warning("Dropped an undecodable frame: %r", e, extra={"type": msg_type, "size": len(frame)})
+            else:
+                log.warning("Failed to decrypt or process: %s", e, extra={"type": msg_type})
+        finally:
+            elapsed = time.perf_counter() - start
+            metrics.inc("frames_in_total", type=msg_type)
+            metrics.inc("bytes_in_total", len(frame))
+            metrics.observe("frame_seconds", elapsed, type=msg_type)
+            # Only a sender that proved its name on this channel is counted as a contact
+            contact = usage_store.sender_of(msg_type, payload)
+            if contact is not None and contact != wire_format.verified_peer(self.channel):
+                contact = None
+            usage_store.record(usage_store.IN, msg_type, len(frame), contact)
+            self._observe(msg_type, elapsed * 1000)
+
+    def _observe(self, msg_type, elapsed_ms):
+        self.counts[msg_type] = self.counts.get(msg_type, 0) + 1
+        self.total_ms[msg_type] = self.total_ms.get(msg_type, 0.0) + elapsed_ms
+        buckets = self.histograms.setdefault(msg_type, [0] * len(LATENCY_BUCKETS_MS))
+        for i, bound in enumerate(LATENCY_BUCKETS_MS):
+            if elapsed_ms <= bound:
+                buckets[i] += 1
+                break
+
+    def stats(self):
+        return {
+            msg_type: {
+                "count": count,
+                "errors": self.errors.get(msg_type, 0),
+                "avg_ms": self.total_ms[msg_type] / count,
+                "histogram": dict(zip(LATENCY_BUCKETS_MS, self.histograms[msg_type])),
+            }
+            for msg_type, count in self.counts.items()
+        }
+
+    def print_stats(self):
+        stats = self.stats()
+        if not stats:
+            print("📭 No frames received yet.")
+            return
+        print("📶 Protocol stats:")
+        for msg_type, s in sorted(stats.items(), key=lambda item: -item[1]["count"]):
+            print(f"   - {msg_type}: {s['count']} frames, {s['errors']} errors, avg {s['avg_ms']:.2f} ms")
@@ -2,11 +2,21 @@
 # Unified ECDH + AES-GCM encryption module for messages and files
 
 import base64
-import os
+import hashlib
+import re
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
 from cryptography.hazmat.primitives.kdf.hkdf import HKDF
-from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec, ed25519
+from cryptography.exceptions import InvalidSignature
+
+import metrics
+from constants import SIGNATURE_SCHEME
+from crypto_provider import WIRE_BACKEND, cipher
 
 # === Utility ===
 
@@ -22,27 +32,115 @@ def from_b64url(data: str) -> bytes:
 # === Key Pair ===
 
 
-def generate_keypair():
-    private_key = ec.generate_private_key(ec.SECP256R1())
-    public_key = private_key.public_key()
-    private_jwk = private_key.private_bytes(
-        serialization.Encoding.PEM,
-        serialization.PrivateFormat.PKCS8,
-        serialization.NoEncryption()
-    ).decode()
-    public_jwk = public_key.public_bytes(
+def _pem(key, private):
+    if private:
+        return key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption()
+        ).decode()
+    return key.public_bytes(
         serialization.Encoding.PEM,
         serialization.PublicFormat.SubjectPublicKeyInfo
     ).decode()
+
+
+def generate_keypair(scheme: str = None):
+    """(private PEM, public PEM). With the ed25519 scheme an Ed25519 signing key
+    is appended to each as a second PEM block; the ECDH key stays first, so
+    older clients that load only the first block keep working."""
+    private_key = ec.generate_private_key(ec.SECP256R1())
+    private_jwk, public_jwk = _pem(private_key, True), _pem(private_key.public_key(), False)
+    if (scheme or SIGNATURE_SCHEME) == "ed25519":
+        private_jwk, public_jwk = add_signing_key(private_jwk, public_jwk)
     return private_jwk, public_jwk
 
 
+def add_signing_key(private_pem: str, public_pem: str):
+    """Append an Ed25519 signing key to an existing pair (no-op if it has one)."""
+    if _ed25519_key(_load_keys(private_pem, True)) is not None:
+        return private_pem, public_pem
+    signing_key = ed25519.Ed25519PrivateKey.generate()
+    return private_pem + _pem(signing_key, True), public_pem + _pem(signing_key.public_key(), False)
+
+
+def is_pem(key) -> bool:
+    return isinstance(key, str) and key.lstrip().startswith("-----BEGIN")
+
+
+# Parsed key objects are cached by PEM text: callers pass PEM strings around
+# and re-parsing them costs more than the signature check itself.
+_PEM_BLOCK = re.compile(r"-----BEGIN [A-Z ]+-----.+?-----END [A-Z ]+-----", re.S)
+
+
+@lru_cache(maxsize=512)
+def _load_keys(pem: str, private: bool):
+    keys = []
+    for block in _PEM_BLOCK.findall(pem):
+        if private:
+            keys.append(serialization.load_pem_private_key(block.encode(), password=None))
+        else:
+            keys.append(serialization.load_pem_public_key(block.encode()))
+    if not keys:
+        raise ValueError("not a PEM key")
+    return tuple(keys)
+
+
+def _ed25519_key(keys):
+    for key in keys:
+        if isinstance(key, (ed25519.Ed25519PrivateKey, ed25519.Ed25519PublicKey)):
+            return key
+    return None
+
+
 def load_private_key(pem: str):
-    return serialization.load_pem_private_key(pem.encode(), password=None)
+    return _load_keys(pem, True)[0]
 
 
 def load_public_key(pem: str):
-    return serialization.load_pem_public_key(pem.encode())
+    return _load_keys(pem, False)[0]
+
+# === Session Key Cache ===
+# derive_key() costs a P-256 exchange + HKDF, so the derived
+# AES key is kept per (own key, peer key) pair and reused until evicted.
+
+SESSION_CACHE_SIZE = 256
+
+_session_keys = OrderedDict()
+_session_lock = threading.Lock()
+
+
+def key_fingerprint(pem: str) -> str:
+    return hashlib.sha256(pem.encode()).hexdigest()
+
+
+def get_session_key(private_key_pem: str, public_key_pem: str) -> bytes:
+    """Cached derive_key(); least recently used pairs are evicted first."""
+    cache_key = (key_fingerprint(private_key_pem), key_fingerprint(public_key_pem))
+    with _session_lock:
+        key = _session_keys.get(cache_key)
+        if key is not None:
+            _session_keys.move_to_end(cache_key)
+            return key
+
+    key = derive_key(private_key_pem, public_key_pem)
+    with _session_lock:
+        _session_keys[cache_key] = key
+        _session_keys.move_to_end(cache_key)
+        while len(_session_keys) > SESSION_CACHE_SIZE:
+            _session_keys.popitem(last=False)
+    return key
+
+
+def clear_session_keys(pem: str = None):
+    """Drop cached session keys, either all of them or only those using `pem`."""
+    with _session_lock:
+        if pem is None:
+            _session_keys.clear()
+            return
+        fp = key_fingerprint(pem)
+        for cache_key in [k for k in _session_keys if fp in k]:
+            del _session_keys[cache_key]
 
 # === Derive Shared AES Key ===
 
@@ -61,43 +159,45 @@ def derive_key(private_key_pem: str, public_key_pem: str) -> bytes:
 # === Encrypt & Decrypt Messages ===
 
 
+def session_cipher(private_key_pem: str, public_key_pem: str, backend: str = WIRE_BACKEND):
+    """Cached AEAD provider keyed with the ECDH session key of this pair."""
+    return cipher(get_session_key(private_key_pem, public_key_pem), backend)
+
+
 def encrypt_message(sender_priv_pem: str, recipient_pub_pem: str, plaintext: str) -> str:
-    key = derive_key(sender_priv_pem, recipient_pub_pem)
-    aesgcm = AESGCM(key)
-    iv = os.urandom(12)
-    encrypted = aesgcm.encrypt(iv, plaintext.encode(), None)
-    return f"{b64url(iv)}.{b64url(encrypted)}"
+    start = time.perf_counter()
+    sealed = session_cipher(sender_priv_pem, recipient_pub_pem).seal(plaintext.encode())
+    metrics.observe("crypto_seconds", time.perf_counter() - start, op="encrypt")
+    return f"{b64url(sealed[:12])}.{b64url(sealed[12:])}"
 
 
-def decrypt_message(recipient_priv_pem: str, sender_pub_pem: str, ciphertext: str) -> str:
-    key = derive_key(recipient_priv_pem, sender_pub_pem)
-    aesgcm = AESGCM(key)
+def split_ciphertext(ciphertext):
+    """(iv, encrypted) from "b64(iv).b64(ct)" text or raw iv + ct bytes (binary frames)."""
+    if isinstance(ciphertext, (bytes, bytearray, memoryview)):
+        ciphertext = memoryview(ciphertext)
+        return bytes(ciphertext[:12]), ciphertext[12:]
     iv_b64, enc_b64 = ciphertext.split(".")
-    iv = from_b64url(iv_b64)
-    encrypted = from_b64url(enc_b64)
-    return aesgcm.decrypt(iv, encrypted, None).decode()
+    return from_b64url(iv_b64), from_b64url(enc_b64)
+
+
+def decrypt_message(recipient_priv_pem: str, sender_pub_pem: str, ciphertext: str) -> str:
+    start = time.perf_counter()
+    iv, encrypted = split_ciphertext(ciphertext)
+    text = session_cipher(recipient_priv_pem, sender_pub_pem).decrypt(iv, encrypted, None).decode()
+    metrics.observe("crypto_seconds", time.perf_counter() - start, op="decrypt")
+    return text
 
 # === Encrypt & Decrypt Files ===
 
 
 def encrypt_file(sender_priv_pem: str, recipient_pub_pem: str, file_bytes: bytes) -> str:
-    key = derive_key(sender_priv_pem, recipient_pub_pem)
-    aesgcm = AESGCM(key)
-    iv = os.urandom(12)
-    encrypted = aesgcm.encrypt(iv, file_bytes, None)
-    return f"{b64url(iv)}.{b64url(encrypted)}"
+    sealed = session_cipher(sender_priv_pem, recipient_pub_pem).seal(file_bytes)
+    return f"{b64url(sealed[:12])}.{b64url(sealed[12:])}"
 
 
 def decrypt_file(recipient_priv_pem: str, sender_pub_pem: str, encrypted_blob: str) -> bytes:
-    key = derive_key(recipient_priv_pem, sender_pub_pem)
-    aesgcm = AESGCM(key)
-    iv_b64, enc_b64 = encrypted_blob.split(".")
-    iv = from_b64url(iv_b64)
-    encrypted = from_b64url(enc_b64)
-    return aesgcm.decrypt(iv, encrypted, None)
-
-
-import hashlib
+    iv, encrypted = split_ciphertext(encrypted_blob)
+    return session_cipher(recipient_priv_pem, sender_pub_pem).decrypt(iv, encrypted, None)
 
 
 def calculate_hash(data: bytes) -> str:
@@ -105,19 +205,60 @@ def calculate_hash(data: bytes) -> str:
     return hashlib.sha256(data).hexdigest()
 
 
-from cryptography.hazmat.primitives.asymmetric import ec
-from cryptography.exceptions import InvalidSignature
+# === Signatures ===
+# ECDSA P-256 signatures are DER (first byte 0x30); Ed25519 ones are sent as
+# 0xED + the 64-byte signature so a verifier can tell them apart.
+
+ED25519_TAG = 0xED
 
 
 def sign_message(private_key, message):
+    """Hex signature of `message` with a PEM string or key object."""
+    with metrics.timer("crypto_seconds", op="sign"):
+        return _sign(private_key, message)
+
+
+def _sign(private_key, message):
+    if isinstance(private_key, str):
+        keys = _load_keys(private_key, True)
+        signing_key = _ed25519_key(keys)
+        if SIGNATURE_SCHEME == "ed25519" and signing_key is not None:
+            return (bytes([ED25519_TAG]) + signing_key.sign(message.encode())).hex()
+        private_key = keys[0]
     signature = private_key.sign(message.encode(), ec.ECDSA(hashes.SHA256()))
     return signature.hex()
 
 
+def rotation_text(public_key):
+    """What the previous key signs to hand a name over to `public_key` (key_storage.rotate_keys)."""
+    return f"key-rotation:{public_key}"
+
+
+def verify_rotation(previous_key, public_key, rotation):
+    """True if `rotation` ({"previous_key", "signature"}) hands `previous_key` over to `public_key`."""
+    if not isinstance(rotation, dict) or rotation.get("previous_key") != previous_key:
+        return False
+    signature = rotation.get("signature")
+    return isinstance(signature, str) and verify_signature(previous_key, rotation_text(public_key), signature)
+
+
 def verify_signature(public_key, message, signature_hex):
-    signature = bytes.fromhex(signature_hex)
+    with metrics.timer("crypto_seconds", op="verify"):
+        return _verify(public_key, message, signature_hex)
+
+
+def _verify(public_key, message, signature_hex):
+    # Binary frames carry the raw signature instead of hex
     try:
-        public_key.verify(signature, message.encode(), ec.ECDSA(hashes.SHA256()))
+        signature = signature_hex if isinstance(signature_hex, bytes) else bytes.fromhex(signature_hex)
+        keys = _load_keys(public_key, False) if isinstance(public_key, str) else (public_key,)
+        if len(signature) == 65 and signature[0] == ED25519_TAG:
+            verify_key = _ed25519_key(keys)
+            if verify_key is None:
+                return False
+            verify_key.verify(signature[1:], message.encode())
+        else:
+            keys[0].verify(signature, message.encode(), ec.ECDSA(hashes.SHA256()))
         return True
-    except InvalidSignature:
+    except (InvalidSignature, ValueError):
         return False
@@ -1,48 +1,38 @@
 import os
 import json
+import state_store
 
-EMOJI_FILE = "custom_emojis.json"
+EMOJI_NS = "custom_emojis"
 
 
 def load_emojis():
-    if os.path.exists(EMOJI_FILE):
-        with open(EMOJI_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
-    return {}
+    return state_store.items(EMOJI_NS)
 
 
 def save_emojis(emojis):
-    with open(EMOJI_FILE, "w", encoding="utf-8") as f:
-        json.dump(emojis, f, indent=2)
+    state_store.replace(EMOJI_NS, emojis)
 
 
 def add_custom_emoji(name, emoji):
-    emojis = load_emojis()
-    emojis[name] = emoji
-    save_emojis(emojis)
+    state_store.put(EMOJI_NS, name, emoji)
     print(f"✨ Added emoji '{emoji}' as '{name}'")
 
 
 def get_custom_emoji(name):
-    return load_emojis().get(name)
+    return state_store.get(EMOJI_NS, name)
 
 
 def remove_emoji(name):
-    emojis = load_emojis()
-    if name in emojis:
-        del emojis[name]
-        save_emojis(emojis)
+    if state_store.delete(EMOJI_NS, name):
         print(f"🗑️ Removed emoji '{name}'")
     else:
         print(f"❌ Emoji '{name}' not found.")
 
 
 def update_custom_emoji(name, new_value):
-    emojis = load_emojis()
     name = name.lower()
-    if name in emojis:
-        emojis[name] = new_value
-        save_emojis(emojis)
+    if state_store.get(EMOJI_NS, name) is not None:
+        state_store.put(EMOJI_NS, name, new_value)
         return True
     return False
 
@@ -60,11 +50,9 @@ def import_emoji_pack(file_path):
             print("❌ Invalid format. Must be a JSON object.")
             return
 
-        emojis = load_emojis()
-        emojis.update(imported)
-
-        with open("emojis.json", "w", encoding="utf-8") as f:
-            json.dump(emojis, f, indent=2)
+        with state_store.transaction():
+            for name, emoji in imported.items():
+                state_store.put(EMOJI_NS, name, emoji)
 
         print(f"✅ Imported {len(imported)} emojis.")
     except Exception as e:
@@ -72,22 +60,12 @@ def import_emoji_pack(file_path):
 
 
 def wipe_all_emojis():
-    import os
-    if os.path.exists("emojis.json"):
-        os.remove("emojis.json")
+    if state_store.keys(EMOJI_NS):
+        state_store.clear(EMOJI_NS)
         print("🧹 All emojis wiped.")
     else:
-        print("📭 No emoji file to wipe.")
+        print("📭 No emojis to wipe.")
 
 
 def delete_emoji(name):
-    if not os.path.exists("emojis.json"):
-        return False
-    with open("emojis.json", "r", encoding="utf-8") as f:
-        data = json.load(f)
-    if name in data:
-        del data[name]
-        with open("emojis.json", "w", encoding="utf-8") as f:
-            json.dump(data, f, indent=2)
-        return True
-    return False
+    return state_store.delete(EMOJI_NS, name)
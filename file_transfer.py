@@ -0,0 +1,379 @@
+# file_transfer.py – Chunked, streaming, resumable file transfer over the data channel
+#
+# Used instead of the single "@file::" frame when the peer speaks wire v2:
+#
+#   sender                                  receiver
+#   @xfer_start (name, size, chunk size) -> creates transfers/<id>.part
+#   @xfer_chunk (seq, AES-GCM sealed)    -> appended to the .part file
+#   @xfer_end   (chunk count, sha256)    -> hash check, moved to downloads/
+#               <- @xfer_done (ok / bad_hash)
+#               <- @xfer_resume (next seq)   after a reconnect or a gap
+#
+# Chunks are sealed with the ECDH session key, a per-transfer nonce prefix +
+# sequence number, and the transfer id + seq as associated data, so they cannot
+# be replayed into another transfer or reordered. Neither side ever holds more
+# than one chunk in memory, and the sender pauses while the SCTP send buffer is
+# above HIGH_WATER. Transfer state lives in state_store so it survives restarts.
+# @xfer_resume and @xfer_done only count when they come from the transfer's
+# recipient, on a channel where it proved its name (wire_format.verified_peer).
+# Transfers in either direction that see no activity for TRANSFER_TTL are
+# dropped by the hourly "transfers_expire" job.
+
+import asyncio
+import hashlib
+import io
+import os
+import secrets
+import time
+
+import scheduler
+import state_store
+import wire_format
+from ecdh_encryption import session_cipher
+
+CHUNK_SIZE = 16 * 1024  # stays well under common SCTP message limits
+HIGH_WATER = 1024 * 1024  # pause sending while more than this is buffered
+SAVE_PROGRESS_EVERY = 64  # chunks between persisted receive cursors
+TRANSFER_TTL = 7 * 86400  # unfinished transfers are dropped after a week without progress
+TRANSFER_DIR = "transfers"
+DOWNLOAD_DIR = "downloads"
+
+OUTGOING = "transfers_out"
+INCOMING = "transfers_in"
+
+_send_tasks = {}  # transfer id -> streaming task
+_incoming = {}  # transfer id -> receive state (hot copy of the INCOMING entry)
+_part_files = {}  # transfer id -> open .part handle
+_buffers = {}  # transfer id -> bytes for offer_bytes() (not kept across restarts)
+
+
+def _nonce(prefix, seq):
+    return prefix + seq.to_bytes(8, "big")
+
+
+def _aad(transfer_id, seq):
+    return f"{transfer_id}:{seq}".encode()
+
+
+def _part_path(transfer_id):
+    return os.path.join(TRANSFER_DIR, f"{transfer_id}.part")
+
+
+def hash_file(path, block=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for data in iter(lambda: f.read(block), b""):
+            digest.update(data)
+    return digest.hexdigest()
+
+
+async def _wait_for_buffer(channel):
+    while getattr(channel, "bufferedAmount", 0) > HIGH_WATER:
+        await asyncio.sleep(0.01)
+
+
+# === Sending ===
+
+
+def offer_file(channel, username, private_key, recipient, recipient_pub, path, filename=None, expiry="None"):
+    """Announce `path` to the peer and stream it in the background. Returns the transfer id."""
+    return _offer(channel, username, private_key, recipient, recipient_pub, os.path.abspath(path),
+                  filename or os.path.basename(path), os.path.getsize(path), expiry)
+
+
+def offer_bytes(channel, username, private_key, recipient, recipient_pub, data, filename, expiry="None"):
+    """Like offer_file() for an in-memory buffer. Resumes within the session only."""
+    return _offer(channel, username, private_key, recipient, recipient_pub, None,
+                  filename, len(data), expiry, data)
+
+
+def _offer(channel, username, private_key, recipient, recipient_pub, path, filename, size, expiry, data=None):
+    transfer_id = secrets.token_hex(8)
+    if data is not None:
+        _buffers[transfer_id] = data
+    transfer = {
+        "path": path,
+        "filename": filename,
+        "recipient": recipient,
+        "recipient_pub": recipient_pub,
+        "size": size,
+        "chunk_size": CHUNK_SIZE,
+        "nonce_prefix": secrets.token_hex(4),
+        "expiry": expiry,
+        "updated": time.time(),
+    }
+    state_store.put(OUTGOING, transfer_id, transfer)
+    wire_format.send_frame(
+        channel,
+        f"@xfer_start::{username}::{transfer_id}::{transfer['filename']}::{transfer['size']}"
+        f"::{CHUNK_SIZE}::{transfer['nonce_prefix']}::{expiry}",
+    )
+    _start_stream(channel, username, private_key, transfer_id, 0)
+    return transfer_id
+
+
+def _start_stream(channel, username, private_key, transfer_id, start_seq):
+    previous = _send_tasks.pop(transfer_id, None)
+    if previous:
+        previous.cancel()
+    task = asyncio.get_running_loop().create_task(
+        _stream(channel, username, private_key, transfer_id, start_seq)
+    )
+    _send_tasks[transfer_id] = task
+    task.add_done_callback(lambda t: _send_tasks.get(transfer_id) is t and _send_tasks.pop(transfer_id))
+
+
+async def _stream(channel, username, private_key, transfer_id, start_seq):
+    transfer = state_store.get(OUTGOING, transfer_id)
+    if transfer is None:
+        return
+    aead = session_cipher(private_key, transfer["recipient_pub"])
+    prefix = bytes.fromhex(transfer["nonce_prefix"])
+    digest = hashlib.sha256()
+    seq = 0
+    if transfer["path"] is None and transfer_id not in _buffers:
+        print(f"⚠️ '{transfer['filename']}' was only held in memory and is gone; send it again")
+        state_store.delete(OUTGOING, transfer_id)
+        return
+    try:
+        with (open(transfer["path"], "rb") if transfer["path"] else io.BytesIO(_buffers[transfer_id])) as f:
+            for data in iter(lambda: f.read(transfer["chunk_size"]), b""):
+                # Chunks the receiver already has are only hashed, not resent
+                digest.update(data)
+                if seq >= start_seq:
+                    sealed = aead.encrypt(_nonce(prefix, seq), data, _aad(transfer_id, seq))
+                    await _wait_for_buffer(channel)
+                    wire_format.send_raw(channel, wire_format.encode_frame("xfer_chunk", [username, transfer_id, seq, sealed]), "xfer_chunk")
+                    await asyncio.sleep(0)
+                seq += 1
+    except OSError as e:
+        print(f"❌ Transfer of '{transfer['filename']}' failed:", e)
+        return
+    wire_format.send_frame(channel, f"@xfer_end::{username}::{transfer_id}::{seq}::{digest.hexdigest()}")
+
+
+# === Receiving ===
+
+
+def _open_part(transfer_id, state):
+    """Open the .part file positioned at the persisted cursor, dropping anything past it."""
+    f = _part_files.get(transfer_id)
+    if f is None:
+        os.makedirs(TRANSFER_DIR, exist_ok=True)
+        path = _part_path(transfer_id)
+        f = open(path, "r+b" if os.path.exists(path) else "wb")
+        f.truncate(state["next_seq"] * state["chunk_size"])
+        f.seek(0, os.SEEK_END)
+        _part_files[transfer_id] = f
+    return f
+
+
+def _close_part(transfer_id):
+    f = _part_files.pop(transfer_id, None)
+    if f:
+        f.close()
+
+
+def _incoming_state(transfer_id):
+    state = _incoming.get(transfer_id)
+    if state is None:
+        state = state_store.get(INCOMING, transfer_id)
+        if state is not None:
+            _incoming[transfer_id] = state
+    return state
+
+
+def _save_progress(transfer_id, state):
+    f = _part_files.get(transfer_id)
+    if f:
+        f.flush()
+    state["updated"] = time.time()
+    state_store.put(INCOMING, transfer_id, state)
+
+
+def _final_path(filename):
+    os.makedirs(DOWNLOAD_DIR, exist_ok=True)
+    base, ext = os.path.splitext(f"received_{os.path.basename(filename)}")
+    path = os.path.join(DOWNLOAD_DIR, base + ext)
+    n = 1
+    while os.path.exists(path):
+        path = os.path.join(DOWNLOAD_DIR, f"{base}_{n}{ext}")
+        n += 1
+    return path
+
+
+def _expire(job):
+    try:
+        os.remove(job["path"])
+        print("💥 File deleted after view.")
+    except OSError as e:
+        print("⚠️ Error during file expiration:", e)
+
+
+scheduler.register("expire_file", _expire)
+
+
+def expire_transfers(job=None):
+    """Drop transfers in either direction that saw no activity for TRANSFER_TTL (scheduler job)."""
+    expire_incoming()
+    expire_outgoing()
+
+
+def expire_outgoing():
+    now = time.time()
+    for transfer_id, transfer in state_store.items(OUTGOING).items():
+        if "updated" not in transfer:
+            transfer["updated"] = now  # from before "updated" was kept
+            state_store.put(OUTGOING, transfer_id, transfer)
+            continue
+        if now - transfer["updated"] < TRANSFER_TTL or transfer_id in _send_tasks:
+            continue
+        state_store.delete(OUTGOING, transfer_id)
+        _buffers.pop(transfer_id, None)
+        print(f"🗑️ Dropped unfinished transfer '{transfer['filename']}' to {transfer['recipient']}")
+
+
+def expire_incoming():
+    """Drop unfinished incoming transfers that made no progress for TRANSFER_TTL."""
+    now = time.time()
+    for transfer_id, state in state_store.items(INCOMING).items():
+        if "updated" not in state:
+            _save_progress(transfer_id, _incoming.get(transfer_id, state))  # from before "updated" was kept
+            continue
+        if now - state["updated"] < TRANSFER_TTL:
+            continue
+        _incoming.pop(transfer_id, None)
+        _close_part(transfer_id)
+        state_store.delete(INCOMING, transfer_id)
+        if os.path.exists(_part_path(transfer_id)):
+            os.remove(_part_path(transfer_id))
+        print(f"🗑️ Dropped unfinished transfer '{state['filename']}' from {state['sender']}")
+
+
+scheduler.register("transfers_expire", expire_transfers)
+
+
+def resume_incoming(channel, username, peer):
+    """Ask `peer` to continue the unfinished transfers it was sending us (after a reconnect)."""
+    for transfer_id, state in state_store.items(INCOMING).items():
+        if state["sender"] != peer:
+            continue
+        state = _incoming.setdefault(transfer_id, state)
+        wire_format.send_frame(channel, f"@xfer_resume::{username}::{transfer_id}::{state['next_seq']}")
+        print(f"🔁 Resuming '{state['filename']}' from chunk {state['next_seq']}")
+
+
+def register_handlers(dispatcher, channel, username, private_key, public_keys, on_complete=None):
+    """Wire the xfer_* frames into `dispatcher`. `on_complete(path, state)` runs per finished file."""
+
+    def on_start(fields):
+        sender, transfer_id, filename, size, chunk_size, prefix, expiry = fields
+        if _incoming_state(transfer_id) is not None:
+            return
+        state = {
+            "sender": sender,
+            "filename": os.path.basename(filename),
+            "size": int(size),
+            "chunk_size": int(chunk_size),
+            "nonce_prefix": prefix,
+            "expiry": expiry,
+            "next_seq": 0,
+            "updated": time.time(),
+        }
+        _incoming[transfer_id] = state
+        state_store.put(INCOMING, transfer_id, state)
+        print(f"📥 Receiving '{state['filename']}' ({state['size']} bytes) from {sender}...")
+
+    def on_chunk(fields):
+        sender, transfer_id, seq, sealed = fields
+        state = _incoming_state(transfer_id)
+        if state is None or sender != state["sender"]:
+            return
+        expected = state["next_seq"]
+        if seq < expected:
+            return  # duplicate after a resume
+        if seq > expected:
+            # Lost chunks: ask once per gap for a restart at the cursor
+            if state.get("gap") != expected:
+                state["gap"] = expected
+                wire_format.send_frame(channel, f"@xfer_resume::{username}::{transfer_id}::{expected}")
+            return
+        if sender not in public_keys:
+            print(f"❌ No public key for sender: {sender}")
+            return
+
+        aead = session_cipher(private_key, public_keys[sender])
+        data = aead.decrypt(_nonce(bytes.fromhex(state["nonce_prefix"]), seq), sealed, _aad(transfer_id, seq))
+        _open_part(transfer_id, state).write(data)
+        state["next_seq"] = expected + 1
+        state.pop("gap", None)
+        if state["next_seq"] % SAVE_PROGRESS_EVERY == 0:
+            _save_progress(transfer_id, state)
+
+    async def on_end(fields):
+        sender, transfer_id, count, file_hash = fields
+        state = _incoming_state(transfer_id)
+        if state is None:
+            return
+        if state["next_seq"] < int(count):
+            _save_progress(transfer_id, state)
+            wire_format.send_frame(channel, f"@xfer_resume::{username}::{transfer_id}::{state['next_seq']}")
+            return
+
+        _open_part(transfer_id, state)
+        _close_part(transfer_id)
+        part = _part_path(transfer_id)
+        actual = await asyncio.get_running_loop().run_in_executor(None, hash_file, part)
+        _incoming.pop(transfer_id, None)
+        state_store.delete(INCOMING, transfer_id)
+
+        if actual != file_hash:
+            os.remove(part)
+            print(f"🚨 File '{state['filename']}' from {sender} failed integrity check!")
+            wire_format.send_frame(channel, f"@xfer_done::{username}::{transfer_id}::bad_hash")
+            return
+
+        save_path = _final_path(state["filename"])
+        os.replace(part, save_path)
+        print(f"📁 File from {sender} saved to: {save_path}")
+        wire_format.send_frame(channel, f"@xfer_done::{username}::{transfer_id}::ok")
+        if on_complete:
+            on_complete(save_path, state)
+
+        if state["expiry"] and state["expiry"] != "None":
+            seconds = int(state["expiry"])
+            print(f"⏳ This file will self-destruct in {seconds} seconds...")
+            scheduler.schedule_in("expire_file", seconds, {"path": save_path})
+
+    def _outgoing_for(receiver, transfer_id):
+        # Only the recipient, proven on this channel, may restart or end its transfer
+        transfer = state_store.get(OUTGOING, transfer_id)
+        if transfer is None or transfer["recipient"] != receiver or wire_format.verified_peer(channel) != receiver:
+            return None
+        return transfer
+
+    def on_resume(fields):
+        receiver, transfer_id, next_seq = fields
+        transfer = _outgoing_for(receiver, transfer_id)
+        if transfer is not None:
+            transfer["updated"] = time.time()
+            state_store.put(OUTGOING, transfer_id, transfer)
+            _start_stream(channel, username, private_key, transfer_id, int(next_seq))
+
+    def on_done(fields):
+        receiver, transfer_id, status = fields
+        transfer = _outgoing_for(receiver, transfer_id)
+        if transfer is None:
+            return
+        state_store.delete(OUTGOING, transfer_id)
+        _buffers.pop(transfer_id, None)
+        if status == "ok":
+            print(f"✅ {receiver} received '{transfer['filename']}'")
+        else:
+            print(f"🚨 {receiver} rejected '{transfer['filename']}' ({status})")
+
+    dispatcher.register("xfer_start", on_start, fields=7)
+    dispatcher.register("xfer_chunk", on_chunk, fields=4)
+    dispatcher.register("xfer_end", on_end, fields=4)
+    dispatcher.register("xfer_resume", on_resume, fields=3)
+    dispatcher.register("xfer_done", on_done, fields=3)
@@ -0,0 +1,150 @@
+# group_session.py – Sender-key group messaging
+#
+# Instead of encrypting and signing every group message once per member, each
+# sender holds one random AES key per group and membership epoch:
+#
+#   @gkey::sender::group::epoch::<sender key sealed for one member>
+#       sent once per member per epoch (pairwise ECDH session key)
+#   @gmsg::sender::group::epoch::n::<ciphertext>::<signature>
+#       every message: one AES-GCM encryption, one signature, one frame
+#
+# The epoch moves forward whenever the member list in groups.json changes, so
+# removed members never see the next key. A member who gets a @gmsg for an
+# epoch it has no key for answers @gkey_request and the sender re-sends it.
+
+import os
+
+import connection_pool
+import crypto_pool
+import outbox
+import state_store
+from crypto_provider import cipher
+from ecdh_encryption import b64url, decrypt_message, encrypt_message, from_b64url, sign_message, split_ciphertext
+from wire_format import send_frame
+
+OWN_KEYS = "group_sender_keys"  # group -> {"epoch", "members", "key", "n", "sent_to"}
+PEER_KEYS = "group_peer_keys"  # "group|sender|epoch" -> b64 sender key
+
+
+def _aad(group, sender, epoch, n):
+    return f"{group}|{sender}|{epoch}|{n}".encode()
+
+
+def _signed_text(group, epoch, n, text):
+    return f"{group}|{epoch}|{n}|{text}"
+
+
+def current_session(group, members):
+    """Our sender-key state for `group`, starting a new epoch if membership changed."""
+    members = sorted(set(members))
+    session = state_store.get(OWN_KEYS, group)
+    if session is None or session["members"] != members:
+        session = {
+            "epoch": str(int(session["epoch"]) + 1 if session else 1),
+            "members": members,
+            "key": b64url(os.urandom(32)),
+            "n": 0,
+            "sent_to": [],
+        }
+        state_store.put(OWN_KEYS, group, session)
+    return session
+
+
+def _key_frame(username, private_key, member_pub, group, session):
+    sealed = encrypt_message(private_key, member_pub, session["key"])
+    return f"@gkey::{username}::{group}::{session['epoch']}::{sealed}"
+
+
+def distribute_key(channel, username, private_key, public_keys, group, session):
+    """Send this epoch's sender key to every member that does not have it yet."""
+    sent = []
+    for member in session["members"]:
+        if member == username or member in session["sent_to"]:
+            continue
+        if member not in public_keys:
+            continue  # no key to seal it with yet; they will ask with @gkey_request
+        send_frame(connection_pool.channel_for(member, channel), _key_frame(username, private_key, public_keys[member], group, session))
+        sent.append(member)
+    if sent:
+        session["sent_to"] += sent
+        state_store.put(OWN_KEYS, group, session)
+    return sent
+
+
+def send_group_message(channel, username, private_key, public_keys, group, members, text, online=None):
+    """Encrypt and sign `text` once and send it on each connection that leads to
+    a member. Returns the frame. Members not in `online` get it through their outbox.
+    """
+    with state_store.transaction():
+        session = current_session(group, members)
+        distribute_key(channel, username, private_key, public_keys, group, session)
+        session["n"] += 1
+        state_store.put(OWN_KEYS, group, session)
+
+    n = session["n"]
+    aead = cipher(from_b64url(session["key"]))
+    iv = os.urandom(12)
+    encrypted = aead.encrypt(iv, text.encode(), _aad(group, username, session["epoch"], n))
+    signature = sign_message(private_key, _signed_text(group, session["epoch"], n, text))
+    frame = f"@gmsg::{username}::{group}::{session['epoch']}::{n}::{b64url(iv)}.{b64url(encrypted)}::{signature}"
+
+    online = public_keys if online is None else online
+    links = {}
+    for member in session["members"]:
+        if member == username:
+            continue
+        if member not in online:
+            outbox.queue(member, frame)
+            continue
+        link = connection_pool.channel_for(member, channel)
+        links[id(link)] = link
+    for link in links.values():
+        send_frame(link, frame)
+    return frame
+
+
+def register_handlers(dispatcher, channel, username, private_key, public_keys, on_message=None):
+    """Wire gkey / gkey_request / gmsg into `dispatcher`.
+
+    `on_message(group, sender, text)` runs for every verified group message.
+    """
+
+    def on_gkey(fields):
+        sender, group, epoch, sealed = fields
+        if sender not in public_keys:
+            print(f"❌ No public key for {sender}; cannot open group key")
+            return
+        key = decrypt_message(private_key, public_keys[sender], sealed)
+        state_store.put(PEER_KEYS, f"{group}|{sender}|{epoch}", key)
+        print(f"🔑 Got {sender}'s key for group '{group}' (epoch {epoch})")
+
+    def on_gkey_request(fields):
+        requester, owner, group, epoch = fields
+        if owner != username:
+            return
+        session = state_store.get(OWN_KEYS, group)
+        if not session or session["epoch"] != epoch or requester not in session["members"]:
+            return
+        if requester in public_keys:
+            send_frame(channel, _key_frame(username, private_key, public_keys[requester], group, session))
+
+    async def on_gmsg(fields):
+        sender, group, epoch, n, ciphertext, signature = fields
+        key = state_store.get(PEER_KEYS, f"{group}|{sender}|{epoch}")
+        if key is None:
+            print(f"🔑 Missing {sender}'s key for group '{group}', asking for it...")
+            send_frame(channel, f"@gkey_request::{username}::{sender}::{group}::{epoch}")
+            return
+        iv, encrypted = split_ciphertext(ciphertext)
+        text = cipher(from_b64url(key)).decrypt(iv, encrypted, _aad(group, sender, epoch, int(n)))
+        text = text.decode()
+        if sender not in public_keys or not await crypto_pool.verify(public_keys[sender], _signed_text(group, epoch, n, text), signature):
+            print(f"🚨 Signature check failed for group message from {sender}")
+            return
+        print(f"\n👥 [{group}] {sender}: {text}")
+        if on_message:
+            on_message(group, sender, text)
+
+    dispatcher.register("gkey", on_gkey, fields=4)
+    dispatcher.register("gkey_request", on_gkey_request, fields=4)
+    dispatcher.register("gmsg", on_gmsg, fields=6)
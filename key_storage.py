@@ -2,7 +2,10 @@ import json
 import os
 from datetime import datetime
 from cryptography.fernet import Fernet
-from encryption import generate_keypair  # Make sure this exists in encryption.py
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from constants import SIGNATURE_SCHEME
+from ecdh_encryption import add_signing_key, clear_session_keys, generate_keypair, is_pem, rotation_text, sign_message
 
 KEY_BACKUP_DIR = "backups"
 RECOVERY_KEY_FILE = "recovery.key"
@@ -10,27 +13,74 @@ RECOVERY_KEY_FILE = "recovery.key"
 # Ensure backup directory exists
 os.makedirs(KEY_BACKUP_DIR, exist_ok=True)
 
-def load_or_create_recovery_key():
+def load_recovery_key_bytes():
     if not os.path.exists(RECOVERY_KEY_FILE):
         key = Fernet.generate_key()
         with open(RECOVERY_KEY_FILE, "wb") as f:
             f.write(key)
     else:
         key = open(RECOVERY_KEY_FILE, "rb").read()
-    return Fernet(key)
+    return key
+
+
+def load_or_create_recovery_key():
+    return Fernet(load_recovery_key_bytes())
+
+
+def derive_local_key(info: bytes):
+    """32-byte key for data at rest (vault, search index, backups).
+
+    Derived from recovery.key, which survives key rotation; the key pair does not.
+    """
+    return HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=info).derive(load_recovery_key_bytes())
+
+def _save_keys(filename, private_key, public_key, rotation=None):
+    keys = {
+        "private_key": private_key,
+        "public_key": public_key
+    }
+    if rotation:
+        keys["rotation"] = rotation
+    with open(filename, "w") as f:
+        json.dump(keys, f)
+
+
+def _rotation(old_private, old_public, new_public):
+    """The old key's signature handing our name over to the new one (None for legacy keys)."""
+    if not is_pem(old_private):
+        return None
+    return {"previous_key": old_public, "signature": sign_message(old_private, rotation_text(new_public))}
+
+
+def load_rotation(filename: str):
+    """{"previous_key", "signature"} from the last key change, for peers that pinned the old key."""
+    if not os.path.exists(filename):
+        return None
+    with open(filename, "r") as f:
+        return json.load(f).get("rotation")
+
 
 def load_or_create_keys(filename: str):
     if os.path.exists(filename):
         with open(filename, "r") as f:
             keys = json.load(f)
-            return keys["private_key"], keys["public_key"]
+        private_key, public_key = keys["private_key"], keys["public_key"]
+        if not is_pem(private_key):
+            # Old NaCl keys cannot sign or do ECDH; keep a backup and start over
+            print("🔐 Replacing legacy keys with an ECDH key pair...")
+            return rotate_keys(filename)
+        if SIGNATURE_SCHEME == "ed25519":
+            upgraded = add_signing_key(private_key, public_key)
+            if upgraded != (private_key, public_key):
+                backup_keys(filename)
+                rotation = _rotation(private_key, public_key, upgraded[1])
+                private_key, public_key = upgraded
+                _save_keys(filename, private_key, public_key, rotation)
+                print("🖋️ Added an Ed25519 signing key")
+        return private_key, public_key
     else:
         private_key, public_key = generate_keypair()
-        with open(filename, "w") as f:
-            json.dump({
-                "private_key": private_key,
-                "public_key": public_key
-            }, f)
+        _save_keys(filename, private_key, public_key)
         return private_key, public_key
 
 def backup_keys(filename: str):
@@ -47,15 +97,18 @@ def backup_keys(filename: str):
     return True
 
 def rotate_keys(filename: str):
+    old = None
     if os.path.exists(filename):
+        with open(filename, "r") as f:
+            old = json.load(f)
         backup_keys(filename)
         os.remove(filename)
+    # Session keys derived from the old pair must not outlive it
+    clear_session_keys()
     private_key, public_key = generate_keypair()
-    with open(filename, "w") as f:
-        json.dump({
-            "private_key": private_key,
-            "public_key": public_key
-        }, f)
+    # Signed by the old key, so the signaling server and DHT peers accept the new one
+    rotation = _rotation(old["private_key"], old["public_key"], public_key) if old else None
+    _save_keys(filename, private_key, public_key, rotation)
     return private_key, public_key
 
 def recover_last_backup(filename: str):
@@ -0,0 +1,355 @@
+# message_store.py – Segmented, append-only store for encrypted chat history
+#
+# Layout under MESSAGE_STORE_DIR:
+#   seg_000001.log ...  records: fixed-size header + peer name + ciphertext
+#   all.idx             one fixed-size index entry per record (global, time ordered)
+#   conv/<peer>.idx     the same entries, but only for one conversation
+#
+# Bodies are stored exactly as produced by ecdh_encryption.encrypt_message, so
+# nothing here ever sees plaintext. Paging and time-range reads seek straight
+# into the index files and only open the records they return.
+
+import hashlib
+import os
+import struct
+import time
+from bisect import bisect_left
+from datetime import datetime
+
+import metrics
+from constants import HISTORY_FILE, MESSAGE_STORE_DIR
+
+SEGMENT_MAX_BYTES = 4 * 1024 * 1024
+
+DIRECTION_TO = 0
+DIRECTION_FROM = 1
+
+# magic, direction, timestamp, peer length, body length
+RECORD_HEADER = struct.Struct(">2sBdHI")
+RECORD_MAGIC = b"SX"
+# segment number, offset in segment, timestamp
+INDEX_ENTRY = struct.Struct(">IQd")
+
+GLOBAL_INDEX = "all.idx"
+CONVERSATION_DIR = "conv"
+
+_active = None  # [segment number, size] of the segment being appended to
+
+
+def _path(*parts):
+    return os.path.join(MESSAGE_STORE_DIR, *parts)
+
+
+def _segment_path(seg_no):
+    return _path(f"seg_{seg_no:06d}.log")
+
+
+def _conversation_index(peer):
+    name = hashlib.sha256(peer.encode()).hexdigest()[:32]
+    return _path(CONVERSATION_DIR, f"{name}.idx")
+
+
+def _ensure_dirs():
+    os.makedirs(_path(CONVERSATION_DIR), exist_ok=True)
+
+
+def _segments():
+    if not os.path.isdir(MESSAGE_STORE_DIR):
+        return []
+    numbers = []
+    for name in os.listdir(MESSAGE_STORE_DIR):
+        if name.startswith("seg_") and name.endswith(".log"):
+            numbers.append(int(name[4:-4]))
+    return sorted(numbers)
+
+
+def _active_segment(incoming):
+    """Segment the next `incoming` bytes go to; the directory is only listed once."""
+    global _active
+    if _active is None:
+        segments = _segments()
+        _active = [segments[-1], os.path.getsize(_segment_path(segments[-1]))] if segments else [1, 0]
+    if _active[1] and _active[1] + incoming > SEGMENT_MAX_BYTES:
+        _active = [_active[0] + 1, 0]
+    return _active[0]
+
+
+def reset():
+    """Forget the cached active segment (after the directory was changed behind our back)."""
+    global _active
+    _active = None
+
+
+def has_messages():
+    return os.path.exists(_path(GLOBAL_INDEX)) and os.path.getsize(_path(GLOBAL_INDEX)) > 0
+
+
+# === Writing ===
+
+
+def record_ref(seg_no, offset):
+    """Pack a record location into one int, stable across index rebuilds."""
+    return (seg_no << 40) | offset
+
+
+def split_ref(ref):
+    return ref >> 40, ref & ((1 << 40) - 1)
+
+
+def append_message(peer, direction, ciphertext, timestamp=None):
+    """Append one encrypted record and index it. Returns its record_ref()."""
+    _ensure_dirs()
+    timestamp = time.time() if timestamp is None else timestamp
+    peer_bytes = peer.encode()
+    body = ciphertext.encode()
+    record = RECORD_HEADER.pack(RECORD_MAGIC, direction, timestamp, len(peer_bytes), len(body)) + peer_bytes + body
+
+    with metrics.timer("disk_write_seconds", store="messages"):
+        seg_no = _active_segment(len(record))
+        with open(_segment_path(seg_no), "ab") as f:
+            offset = f.tell()
+            f.write(record)
+        _active[1] = offset + len(record)
+
+        entry = INDEX_ENTRY.pack(seg_no, offset, timestamp)
+        with open(_path(GLOBAL_INDEX), "ab") as f:
+            f.write(entry)
+        with open(_conversation_index(peer), "ab") as f:
+            f.write(entry)
+    return record_ref(seg_no, offset)
+
+
+# === Reading ===
+
+
+def _read_record(f, offset):
+    f.seek(offset)
+    header = f.read(RECORD_HEADER.size)
+    magic, direction, timestamp, peer_len, body_len = RECORD_HEADER.unpack(header)
+    if magic != RECORD_MAGIC:
+        raise ValueError(f"Corrupt record at offset {offset}")
+    payload = f.read(peer_len + body_len)
+    if len(payload) != peer_len + body_len:
+        raise ValueError(f"Truncated record at offset {offset}")
+    peer = payload[:peer_len].decode()
+    body = payload[peer_len:].decode()
+    return {
+        "time": timestamp,
+        "peer": peer,
+        "direction": direction,
+        "ciphertext": body,
+    }
+
+
+def _load_records(entries):
+    """Resolve index entries into records, opening each segment only once."""
+    records = []
+    handles = {}
+    try:
+        for seg_no, offset, _ in entries:
+            if seg_no not in handles:
+                handles[seg_no] = open(_segment_path(seg_no), "rb")
+            record = _read_record(handles[seg_no], offset)
+            record["ref"] = record_ref(seg_no, offset)
+            records.append(record)
+    finally:
+        for f in handles.values():
+            f.close()
+    return records
+
+
+class _IndexFile:
+    """Random access over a file of fixed-size INDEX_ENTRY records."""
+
+    def __init__(self, path):
+        self.path = path
+        self.count = os.path.getsize(path) // INDEX_ENTRY.size if os.path.exists(path) else 0
+
+    def __len__(self):
+        return self.count
+
+    def read(self, start, stop):
+        start, stop = max(0, start), min(self.count, stop)
+        if start >= stop:
+            return []
+        with open(self.path, "rb") as f:
+            f.seek(start * INDEX_ENTRY.size)
+            data = f.read((stop - start) * INDEX_ENTRY.size)
+        return [INDEX_ENTRY.unpack_from(data, i) for i in range(0, len(data), INDEX_ENTRY.size)]
+
+    def timestamps(self):
+        return _TimestampView(self)
+
+
+class _TimestampView:
+    """Sequence of timestamps for bisect, reading one entry per probe."""
+
+    def __init__(self, index):
+        self.index = index
+        self.f = open(index.path, "rb") if index.count else None
+
+    def __len__(self):
+        return self.index.count
+
+    def __getitem__(self, i):
+        self.f.seek(i * INDEX_ENTRY.size)
+        return INDEX_ENTRY.unpack(self.f.read(INDEX_ENTRY.size))[2]
+
+    def close(self):
+        if self.f:
+            self.f.close()
+
+
+def _index_for(peer):
+    return _IndexFile(_conversation_index(peer) if peer else _path(GLOBAL_INDEX))
+
+
+def read_conversation(peer, limit=50, before=None):
+    """Last `limit` records with `peer`, oldest first. `before` pages backwards by timestamp."""
+    index = _index_for(peer)
+    stop = len(index)
+    if before is not None:
+        view = index.timestamps()
+        try:
+            stop = bisect_left(view, before)
+        finally:
+            view.close()
+    return _load_records(index.read(stop - limit, stop))
+
+
+def read_refs(refs):
+    """Records for the given record_ref() values, in the order given."""
+    return _load_records([split_ref(ref) + (None,) for ref in refs])
+
+
+def read_recent(limit=50):
+    """Last `limit` records across all conversations."""
+    index = _index_for(None)
+    return _load_records(index.read(len(index) - limit, len(index)))
+
+
+def read_range(start, end, peer=None):
+    """Records with start <= time < end (epoch seconds), optionally for one peer."""
+    index = _index_for(peer)
+    view = index.timestamps()
+    try:
+        lo = bisect_left(view, start)
+        hi = bisect_left(view, end)
+    finally:
+        view.close()
+    return _load_records(index.read(lo, hi))
+
+
+def iter_messages(batch=500):
+    """Every record in time order, loaded `batch` index entries at a time."""
+    index = _index_for(None)
+    for start in range(0, len(index), batch):
+        yield from _load_records(index.read(start, start + batch))
+
+
+def format_record(record, text=None):
+    timestamp = datetime.fromtimestamp(record["time"]).strftime("%Y-%m-%d %H:%M:%S")
+    arrow = "From" if record["direction"] == DIRECTION_FROM else "To"
+    body = record["ciphertext"] if text is None else text
+    return f"[{timestamp}] {arrow} {record['peer']}: {body}"
+
+
+# === Maintenance ===
+
+
+def index_is_healthy():
+    """Cheap check that the indexes cover the segments: sizes add up and the last
+    indexed record ends where the newest segment ends."""
+    segments = _segments()
+    if not segments:
+        return True
+    global_path = _path(GLOBAL_INDEX)
+    size = os.path.getsize(global_path) if os.path.exists(global_path) else 0
+    if not size or size % INDEX_ENTRY.size:
+        return False
+    conv_dir = _path(CONVERSATION_DIR)
+    conv_size = sum(os.path.getsize(os.path.join(conv_dir, n)) for n in os.listdir(conv_dir)) if os.path.isdir(conv_dir) else 0
+    if conv_size != size:
+        return False
+    try:
+        seg_no, offset, _ = _IndexFile(global_path).read(size // INDEX_ENTRY.size - 1, size // INDEX_ENTRY.size)[0]
+        with open(_segment_path(seg_no), "rb") as f:
+            _read_record(f, offset)
+            end = f.tell()
+    except (OSError, ValueError, struct.error, UnicodeDecodeError):
+        return False
+    return seg_no == segments[-1] and end == os.path.getsize(_segment_path(seg_no))
+
+
+def ensure_index():
+    """Rebuild the indexes if they are missing or damaged. Returns True if it did."""
+    if index_is_healthy():
+        return False
+    print("🔧 Message index is missing or damaged; rebuilding it...")
+    count = rebuild_index()
+    print(f"🔧 Re-indexed {count} messages")
+    return True
+
+
+def rebuild_index():
+    """Recreate all.idx and conv/*.idx by scanning the segments (after a crash or manual edit)."""
+    reset()
+    if not os.path.isdir(MESSAGE_STORE_DIR):
+        return 0
+    _ensure_dirs()
+    for name in os.listdir(_path(CONVERSATION_DIR)):
+        os.remove(_path(CONVERSATION_DIR, name))
+
+    entries = []
+    per_peer = {}
+    for seg_no in _segments():
+        path = _segment_path(seg_no)
+        size = os.path.getsize(path)
+        with open(path, "rb") as f:
+            offset = 0
+            while offset + RECORD_HEADER.size <= size:
+                try:
+                    record = _read_record(f, offset)
+                except (ValueError, struct.error, UnicodeDecodeError):
+                    break
+                entry = INDEX_ENTRY.pack(seg_no, offset, record["time"])
+                entries.append((record["time"], entry))
+                per_peer.setdefault(record["peer"], []).append((record["time"], entry))
+                offset = f.tell()
+        if offset < size:
+            # Torn write at the tail: drop the partial record
+            with open(path, "r+b") as f:
+                f.truncate(offset)
+
+    entries.sort(key=lambda e: e[0])
+    with open(_path(GLOBAL_INDEX), "wb") as f:
+        f.write(b"".join(e for _, e in entries))
+    for peer, peer_entries in per_peer.items():
+        peer_entries.sort(key=lambda e: e[0])
+        with open(_conversation_index(peer), "wb") as f:
+            f.write(b"".join(e for _, e in peer_entries))
+    return len(entries)
+
+
+def migrate_legacy_history(path=HISTORY_FILE):
+    """One-time import of inbox_history.txt lines. The old file is renamed to *.migrated."""
+    if not os.path.exists(path):
+        return 0
+    imported = 0
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            try:
+                prefix, encrypted = line.split(": ", 1)
+                stamp, who = prefix.split("] ", 1)
+                arrow, peer = who.split(" ", 1)
+                timestamp = datetime.strptime(stamp.lstrip("["), "%Y-%m-%d %H:%M:%S").timestamp()
+            except ValueError:
+                continue
+            direction = DIRECTION_FROM if arrow == "From" else DIRECTION_TO
+            append_message(peer, direction, encrypted, timestamp)
+            imported += 1
+    os.replace(path, path + ".migrated")
+    if imported:
+        print(f"📦 Migrated {imported} history lines into {MESSAGE_STORE_DIR}/")
+    return imported
@@ -0,0 +1,264 @@
+# metrics.py – In-process counters, gauges and latency histograms
+#
+# One registry for the whole client. Hot paths record with a dict update:
+#
+#   metrics.inc("frames_out_total", type="msg")
+#   metrics.inc("bytes_out_total", len(frame))
+#   with metrics.timer("crypto_seconds", op="encrypt"):
+#       ...
+#
+# Gauges are either set directly or computed when read: modules register a
+# callback (outbox depth, pool queues, presence states) so nothing has to be
+# kept up to date. /stats and the usage dashboard read snapshot(); serve()
+# exposes the same data on a local port as Prometheus text (/metrics) or JSON
+# (/metrics.json) when the client runs with --metrics-port.
+
+import asyncio
+import bisect
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds (seconds) of the histogram buckets; the last one catches the rest
+BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, float("inf"))
+
+_counters = {}  # (name, labels) -> value; labels is a sorted tuple of (key, value)
+_gauges = {}
+_gauge_fns = {}  # name -> (fn, label); fn returns a number or {label value: number}
+_histograms = {}  # (name, labels) -> [bucket counts..., count, sum]
+_help = {}
+_lock = threading.Lock()  # crypto and backup workers record from other threads
+_started = time.time()
+_server = None
+
+
+def _key(name, labels):
+    if len(labels) < 2:
+        return name, tuple(labels.items())
+    return name, tuple(sorted(labels.items()))
+
+
+def describe(name, text):
+    """One-line help shown in the Prometheus output."""
+    _help[name] = text
+
+
+def inc(name, amount=1, **labels):
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+
+def set_gauge(name, value, **labels):
+    _gauges[_key(name, labels)] = value
+
+
+def gauge(name, fn, label=None):
+    """Compute gauge `name` with fn() whenever it is read.
+
+    fn returns a number, or {label value: number} when `label` is given.
+    """
+    _gauge_fns[name] = (fn, label)
+
+
+def observe(name, seconds, **labels):
+    key = _key(name, labels)
+    i = bisect.bisect_left(BUCKETS, seconds)
+    with _lock:
+        hist = _histograms.get(key)
+        if hist is None:
+            hist = _histograms[key] = [0] * (len(BUCKETS) + 2)
+        hist[i] += 1
+        hist[-2] += 1
+        hist[-1] += seconds
+
+
+@contextmanager
+def timer(name, **labels):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+# === Reading ===
+
+
+def uptime():
+    return time.time() - _started
+
+
+def _matches(labels, where):
+    return all(dict(labels).get(k) == v for k, v in where.items())
+
+
+def total(name, **where):
+    """Sum of counter `name` over every label set matching `where`."""
+    return sum(value for (n, labels), value in list(_counters.items()) if n == name and _matches(labels, where))
+
+
+def by_label(name, label, **where):
+    """{label value: counter total} for counter `name`."""
+    out = {}
+    for (n, labels), value in list(_counters.items()):
+        if n == name and _matches(labels, where):
+            key = dict(labels).get(label)
+            out[key] = out.get(key, 0) + value
+    return out
+
+
+def gauges():
+    """{(name, labels): value} with the callback gauges evaluated now."""
+    out = dict(_gauges)
+    for name, (fn, label) in list(_gauge_fns.items()):
+        try:
+            value = fn()
+        except Exception:
+            continue
+        if label is None:
+            out[(name, ())] = value
+        else:
+            for label_value, v in value.items():
+                out[(name, ((label, str(label_value)),))] = v
+    return out
+
+
+def histogram(name, **where):
+    """(count, sum, bucket counts) of `name` merged over matching label sets."""
+    merged = [0] * (len(BUCKETS) + 2)
+    for (n, labels), hist in list(_histograms.items()):
+        if n == name and _matches(labels, where):
+            merged = [a + b for a, b in zip(merged, hist)]
+    return merged[-2], merged[-1], merged[:-2]
+
+
+def quantile(name, q, **where):
+    """Estimate the q-quantile (seconds) of histogram `name` from its buckets."""
+    count, _, buckets = histogram(name, **where)
+    if not count:
+        return None
+    rank = q * count
+    seen = 0
+    for i, n in enumerate(buckets):
+        if n and seen + n >= rank:
+            low = BUCKETS[i - 1] if i else 0
+            high = BUCKETS[i] if BUCKETS[i] != float("inf") else low * 2 or 1
+            return low + (high - low) * (rank - seen) / n
+        seen += n
+    return BUCKETS[-2]
+
+
+def _label_text(labels, extra=()):
+    items = list(labels) + list(extra)
+    if not items:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in items) + "}"
+
+
+def snapshot():
+    """Everything in the registry as plain JSON-friendly dicts."""
+    def flat(mapping):
+        return {name + _label_text(labels): value for (name, labels), value in mapping.items()}
+
+    with _lock:
+        counters = dict(_counters)
+        hists = {key: list(hist) for key, hist in _histograms.items()}
+    return {
+        "uptime": uptime(),
+        "counters": flat(counters),
+        "gauges": flat(gauges()),
+        "histograms": {
+            name + _label_text(labels): {
+                "count": hist[-2],
+                "sum": hist[-1],
+                "buckets": {str(bound): n for bound, n in zip(BUCKETS, hist[:-2])},
+            }
+            for (name, labels), hist in hists.items()
+        },
+    }
+
+
+def prometheus():
+    """The registry in the Prometheus text exposition format."""
+    lines = []
+    with _lock:
+        counters = sorted(_counters.items())
+        hists = sorted((key, list(hist)) for key, hist in _histograms.items())
+
+    def header(name, kind):
+        if name in _help:
+            lines.append(f"# HELP siphrix_{name} {_help[name]}")
+        lines.append(f"# TYPE siphrix_{name} {kind}")
+
+    last = None
+    for (name, labels), value in counters:
+        if name != last:
+            header(name, "counter")
+            last = name
+        lines.append(f"siphrix_{name}{_label_text(labels)} {value}")
+    for (name, labels), value in sorted(gauges().items()):
+        if name != last:
+            header(name, "gauge")
+            last = name
+        lines.append(f"siphrix_{name}{_label_text(labels)} {value}")
+    for (name, labels), hist in hists:
+        if name != last:
+            header(name, "histogram")
+            last = name
+        cumulative = 0
+        for bound, n in zip(BUCKETS, hist[:-2]):
+            cumulative += n
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            lines.append(f"siphrix_{name}_bucket{_label_text(labels, [('le', le)])} {cumulative}")
+        lines.append(f"siphrix_{name}_count{_label_text(labels)} {hist[-2]}")
+        lines.append(f"siphrix_{name}_sum{_label_text(labels)} {hist[-1]}")
+    return "\n".join(lines) + "\n"
+
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _gauges.clear()
+        _histograms.clear()
+
+
+# === Exporter ===
+
+
+async def _handle(reader, writer):
+    try:
+        request = await reader.readline()
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass  # headers are not needed
+        parts = request.decode("latin-1").split()
+        path = parts[1].split("?")[0] if len(parts) > 1 else "/"
+        if path == "/metrics":
+            status, kind, body = "200 OK", "text/plain; version=0.0.4", prometheus()
+        elif path == "/metrics.json":
+            status, kind, body = "200 OK", "application/json", json.dumps(snapshot())
+        else:
+            status, kind, body = "404 Not Found", "text/plain", "try /metrics or /metrics.json\n"
+        data = body.encode()
+        writer.write(f"HTTP/1.0 {status}\r\nContent-Type: {kind}\r\nContent-Length: {len(data)}\r\n\r\n".encode() + data)
+        await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(port, host="127.0.0.1"):
+    """Expose the registry on http://host:port/metrics until stop() is awaited."""
+    global _server
+    _server = await asyncio.start_server(_handle, host, port)
+    print(f"📈 Metrics on http://{host}:{port}/metrics")
+
+
+async def stop():
+    global _server
+    if _server is not None:
+        _server.close()
+        await _server.wait_closed()
+        _server = None
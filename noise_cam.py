@@ -1,16 +1,135 @@
-import cv2
+# noise_cam.py – Face blurring for /blurcam
+#
+# The Haar detector is loaded once per process instead of once per image.
+# Detection runs on a grayscale copy scaled down to DETECT_WIDTH and the boxes
+# are mapped back to full resolution. Faces are pixelated (default) or
+# box-blurred, both much cheaper than the old 99×99 Gaussian, which is still
+# available as "gaussian". Results are encoded in memory, so nothing is written
+# to a shared output file, and blur_async() / blur_many() run on a process pool
+# so the chat loop keeps going while a photo is processed.
 
-def blur_faces(image_path, output_path):
-    image = cv2.imread(image_path)
-    face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + "haarcascade_frontalface_default.xml")
+import asyncio
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 
+DETECT_WIDTH = 640  # detection input width; larger images are scaled down
+PIXEL_BLOCKS = 12  # pixelate: a face becomes about this many blocks across
+MODES = ("pixelate", "box", "gaussian")
+FORMATS = (".jpg", ".jpeg", ".png", ".bmp", ".webp")
+WORKERS = max(1, min(4, (os.cpu_count() or 1) - 1))
+
+_pool = None
+
+
+@lru_cache(maxsize=1)
+def _detector():
+    import cv2
+    detector = cv2.CascadeClassifier(cv2.data.haarcascades + "haarcascade_frontalface_default.xml")
+    if detector.empty():
+        raise RuntimeError("could not load the Haar face detector")
+    return detector
+
+
+def detect_faces(image, scale_factor=1.1, min_neighbors=4):
+    """Face boxes (x, y, w, h) of a BGR image, in full-resolution coordinates."""
+    import cv2
+    height, width = image.shape[:2]
+    scale = min(1.0, DETECT_WIDTH / width)
     gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-    faces = face_cascade.detectMultiScale(gray, 1.3, 5)
+    if scale < 1.0:
+        gray = cv2.resize(gray, (round(width * scale), round(height * scale)), interpolation=cv2.INTER_AREA)
+
+    boxes = []
+    for (x, y, w, h) in _detector().detectMultiScale(gray, scale_factor, min_neighbors):
+        x0, y0 = int(x / scale), int(y / scale)
+        x1, y1 = min(width, int((x + w) / scale + 0.5)), min(height, int((y + h) / scale + 0.5))
+        boxes.append((x0, y0, x1 - x0, y1 - y0))
+    return boxes
+
+
+def _blur_region(face, mode):
+    import cv2
+    h, w = face.shape[:2]
+    if mode == "pixelate":
+        across = max(1, min(PIXEL_BLOCKS, w))
+        small = cv2.resize(face, (across, max(1, across * h // w)), interpolation=cv2.INTER_AREA)
+        return cv2.resize(small, (w, h), interpolation=cv2.INTER_NEAREST)
+    if mode == "box":
+        k = max(3, w // 4)
+        return cv2.blur(cv2.blur(face, (k, k)), (k, k))  # two passes look close to a Gaussian
+    return cv2.GaussianBlur(face, (99, 99), 30)
+
+
+def blur_image(image, mode="pixelate"):
+    """Blur every face of a decoded BGR image in place. Returns the number of faces."""
+    if mode not in MODES:
+        raise ValueError(f"unknown blur mode {mode!r} (use one of {', '.join(MODES)})")
+    boxes = detect_faces(image)
+    for (x, y, w, h) in boxes:
+        image[y:y + h, x:x + w] = _blur_region(image[y:y + h, x:x + w], mode)
+    return len(boxes)
+
+
+def blur_bytes(data, mode="pixelate", ext=".jpg"):
+    """Decode an encoded image, blur its faces and re-encode it. Returns (bytes, faces)."""
+    import cv2
+    import numpy as np
+    image = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError("not a readable image")
+    faces = blur_image(image, mode)
+    ok, encoded = cv2.imencode(ext, image)
+    if not ok:
+        raise ValueError(f"could not encode the image as {ext}")
+    return encoded.tobytes(), faces
 
-    for (x, y, w, h) in faces:
-        face = image[y:y+h, x:x+w]
-        face = cv2.GaussianBlur(face, (99, 99), 30)
-        image[y:y+h, x:x+w] = face
 
-    cv2.imwrite(output_path, image)
+def blur_file(path, mode="pixelate"):
+    """Blur the image at `path`; the result keeps its format. Returns (bytes, faces)."""
+    with open(path, "rb") as f:
+        data = f.read()
+    ext = os.path.splitext(path)[1].lower()
+    return blur_bytes(data, mode, ext if ext in FORMATS else ".jpg")
+
+
+def blur_faces(image_path, output_path, mode="gaussian"):
+    """Old API: blur `image_path` into `output_path`."""
+    data, _ = blur_file(image_path, mode)
+    with open(output_path, "wb") as f:
+        f.write(data)
     return output_path
+
+
+# === Off the event loop ===
+
+
+def _executor():
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=WORKERS)
+    return _pool
+
+
+async def blur_async(path, mode="pixelate"):
+    """blur_file() on the process pool. Returns (bytes, faces)."""
+    return await asyncio.get_running_loop().run_in_executor(_executor(), blur_file, path, mode)
+
+
+def blur_many(paths, mode="pixelate"):
+    """Blur many images in parallel. Yields (path, bytes, faces), or (path, None, error)."""
+    futures = [(path, _executor().submit(blur_file, path, mode)) for path in paths]
+    for path, future in futures:
+        try:
+            data, faces = future.result()
+        except Exception as e:
+            yield path, None, e
+        else:
+            yield path, data, faces
+
+
+def shutdown():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
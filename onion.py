@@ -0,0 +1,336 @@
+# onion.py – Pre-built onion circuits with per-hop keys
+#
+# A circuit is built once per route and reused for every message to its target:
+#
+#   @circ_create::<circ id>::<CREATE_SIZE bytes>     once per hop per circuit
+#       layer = ephemeral P-256 key | length | AES-GCM(next hop, next circ id, inner layer)
+#       The hop does one ECDH to get its keys, keeps them for the circuit and
+#       forwards the inner layer, padded back to CREATE_SIZE, under a new id.
+#   @cell::<circ id>::<CELL_SIZE bytes>              every message (long ones span cells)
+#       middle hop: one ChaCha20 pass with its key and the cell number, then forward
+#       exit hop:   one AES-GCM open of flags | length | data | zero padding
+#   @circ_destroy::<circ id>                         teardown, in either direction
+#
+# Cells never change size, circuit ids differ on every link, and no hop parses
+# JSON or does public-key work per message. Middle hops do not authenticate
+# cells (like Tor relay cells); the exit's AES-GCM check catches tampering.
+# Circuits are rebuilt after CIRCUIT_LIFETIME or when the cached route
+# rotates, and idle ones send a padding cell every PADDING_INTERVAL.
+
+import asyncio
+import secrets
+import struct
+import time
+
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+import connection_pool
+import scheduler
+import wire_format
+from crypto_provider import cipher
+from ecdh_encryption import b64url, from_b64url, load_private_key, load_public_key
+
+CELL_SIZE = 512
+CREATE_SIZE = 1024
+CELL_HEADER = struct.Struct(">BH")  # flags, data length
+CELL_DATA = CELL_SIZE - 16 - CELL_HEADER.size  # 16 = exit layer's AES-GCM tag
+POINT_SIZE = 65  # uncompressed P-256 point
+CIRCUIT_LIFETIME = 600
+PADDING_INTERVAL = 30
+KEY_TIMEOUT = 5
+
+FLAG_MORE = 0x01  # message continues in the next cell
+FLAG_PAD = 0x02  # cover traffic, dropped by the exit
+
+_circuits = {}  # target -> Circuit we built
+_relays = {}  # (id(channel), circ id) -> hop state for circuits passing through us
+_upstream = {}  # (id(next channel), circ out) -> same hop state, for destroys coming back
+_key_waiters = {}  # username -> [futures]
+_me = {"channel": None, "private_key": None, "on_message": None}
+
+
+class Circuit:
+    def __init__(self, target, route, keys, circ_id, channel):
+        self.target = target
+        self.route = route
+        self.keys = keys  # per-hop cell keys, first hop first
+        self.circ_id = circ_id
+        self.channel = channel
+        self.counter = 0
+        self.created = self.last_used = time.time()
+        self.alive = True
+
+
+# === Cell crypto ===
+
+
+def _hop_keys(shared):
+    okm = HKDF(algorithm=hashes.SHA256(), length=64, salt=None, info=b"siphrix-onion").derive(shared)
+    return okm[:32], okm[32:]  # create-layer key, cell key
+
+
+def _nonce(n):
+    return n.to_bytes(12, "big")
+
+
+def _stream(key, n, data):
+    # ChaCha20 takes a 16-byte nonce: 4-byte block counter + 12-byte nonce
+    return Cipher(algorithms.ChaCha20(key, bytes(4) + _nonce(n)), mode=None).encryptor().update(data)
+
+
+def _pad(data, size):
+    return bytes(data) + secrets.token_bytes(size - len(data))
+
+
+# === Transport ===
+
+
+def _link(username):
+    return connection_pool.channel_for(username, _me["channel"])
+
+
+def _send(channel, msg_type, circ_id, body=None):
+    fields = [circ_id] if body is None else [circ_id, body]
+    if wire_format.peer_version(channel) >= wire_format.SCHEMA_VERSIONS[msg_type]:
+        wire_format.send_raw(channel, wire_format.encode_frame(msg_type, fields), msg_type)
+    elif body is None:
+        wire_format.send_raw(channel, f"@{msg_type}::{circ_id}", msg_type)
+    else:
+        wire_format.send_raw(channel, f"@{msg_type}::{circ_id}::{b64url(body)}", msg_type)
+
+
+def _raw(value):
+    return value if isinstance(value, (bytes, bytearray, memoryview)) else from_b64url(value)
+
+
+# === Building circuits ===
+
+
+async def wait_for_keys(channel, peers, public_keys, timeout=KEY_TIMEOUT):
+    """Ask for any missing public keys and wait for them. Returns those still missing."""
+    loop = asyncio.get_running_loop()
+    waits = []
+    for peer in peers:
+        if peer not in public_keys:
+            print(f"🔍 Requesting key from {peer}...")
+            wire_format.send_frame(channel, f"@request_key::{peer}")
+            future = loop.create_future()
+            _key_waiters.setdefault(peer, []).append(future)
+            waits.append(future)
+    if waits:
+        await asyncio.wait(waits, timeout=timeout)
+        for future in waits:
+            future.cancel()
+    return [peer for peer in peers if peer not in public_keys]
+
+
+def key_arrived(username):
+    """Call when a public key for `username` comes in; wakes wait_for_keys()."""
+    for future in _key_waiters.pop(username, []):
+        if not future.done():
+            future.set_result(True)
+
+
+def build_circuit(target, route, public_keys):
+    """Send the create cell for `route` (ending at `target`) and return the Circuit."""
+    circ_ids = [secrets.token_hex(8) for _ in route]
+    layers = []
+    for hop in route:
+        ephemeral = ec.generate_private_key(ec.SECP256R1())
+        shared = ephemeral.exchange(ec.ECDH(), load_public_key(public_keys[hop]))
+        layers.append((ephemeral, *_hop_keys(shared)))
+
+    blob = b""
+    for i in reversed(range(len(route))):
+        ephemeral, create_key, _ = layers[i]
+        if i + 1 < len(route):
+            name = route[i + 1].encode()
+            hop_info = bytes([len(name)]) + name + bytes.fromhex(circ_ids[i + 1])
+        else:
+            hop_info = b"\x00"  # exit
+        sealed = cipher(create_key).encrypt(bytes(12), hop_info + blob, None)
+        point = ephemeral.public_key().public_bytes(serialization.Encoding.X962, serialization.PublicFormat.UncompressedPoint)
+        blob = point + struct.pack(">H", len(sealed)) + sealed
+    if len(blob) > CREATE_SIZE:
+        raise ValueError(f"route too long ({len(route)} hops)")
+
+    channel = _link(route[0])
+    circuit = Circuit(target, list(route), [keys[2] for keys in layers], circ_ids[0], channel)
+    _send(channel, "circ_create", circuit.circ_id, _pad(blob, CREATE_SIZE))
+    return circuit
+
+
+async def get_circuit(channel, target, route, public_keys):
+    """A live circuit to `target` over `route`, reusing the current one when it matches."""
+    circuit = _circuits.get(target)
+    if circuit and circuit.alive and circuit.route == route and time.time() - circuit.created < CIRCUIT_LIFETIME:
+        return circuit
+    if circuit:
+        destroy(circuit)
+
+    missing = await wait_for_keys(channel, route, public_keys)
+    if missing:
+        print(f"❌ Missing public key for {', '.join(missing)}.")
+        return None
+    circuit = _circuits[target] = build_circuit(target, route, public_keys)
+    print(f"🧅 Built circuit to {target}: {' → '.join(route)}")
+    return circuit
+
+
+def destroy(circuit):
+    if circuit.alive:
+        circuit.alive = False
+        _send(circuit.channel, "circ_destroy", circuit.circ_id)
+    if _circuits.get(circuit.target) is circuit:
+        del _circuits[circuit.target]
+
+
+# === Sending ===
+
+
+def _send_cell(circuit, flags, data):
+    n = circuit.counter
+    circuit.counter += 1
+    plain = CELL_HEADER.pack(flags, len(data)) + data
+    body = cipher(circuit.keys[-1]).encrypt(_nonce(n), plain + bytes(CELL_SIZE - 16 - len(plain)), None)
+    for key in reversed(circuit.keys[:-1]):
+        body = _stream(key, n, body)
+    _send(circuit.channel, "cell", circuit.circ_id, body)
+    circuit.last_used = time.time()
+
+
+def send(circuit, text):
+    """Send `text` to the circuit's exit as one or more fixed-size cells."""
+    data = text.encode()
+    chunks = [data[i:i + CELL_DATA] for i in range(0, len(data), CELL_DATA)] or [b""]
+    for i, chunk in enumerate(chunks):
+        _send_cell(circuit, FLAG_MORE if i + 1 < len(chunks) else 0, chunk)
+    return len(chunks)
+
+
+def maintain(job=None):
+    """Retire old circuits, pad idle ones and forget stale relay state (scheduler job)."""
+    now = time.time()
+    for circuit in list(_circuits.values()):
+        if not circuit.alive or now - circuit.created >= CIRCUIT_LIFETIME:
+            destroy(circuit)  # rebuilt on the next send
+        elif now - circuit.last_used >= PADDING_INTERVAL:
+            _send_cell(circuit, FLAG_PAD, b"")
+    for key, hop in list(_relays.items()):
+        if now - hop["last"] > 2 * CIRCUIT_LIFETIME:
+            _drop_relay(hop)
+
+
+# === Relaying ===
+
+
+def _drop_relay(hop):
+    _relays.pop((id(hop["prev"]), hop["circ_in"]), None)
+    if hop["next_channel"] is not None:
+        _upstream.pop((id(hop["next_channel"]), hop["circ_out"]), None)
+
+
+def on_create(channel, circ_id, blob):
+    blob = memoryview(_raw(blob))
+    (size,) = struct.unpack_from(">H", blob, POINT_SIZE)
+    ephemeral = ec.EllipticCurvePublicKey.from_encoded_point(ec.SECP256R1(), bytes(blob[:POINT_SIZE]))
+    shared = load_private_key(_me["private_key"]).exchange(ec.ECDH(), ephemeral)
+    create_key, cell_key = _hop_keys(shared)
+    plain = cipher(create_key).decrypt(bytes(12), blob[POINT_SIZE + 2:POINT_SIZE + 2 + size], None)
+
+    name_len = plain[0]
+    hop = {
+        "key": cell_key, "prev": channel, "circ_in": circ_id, "counter": 0, "last": time.time(),
+        "next": plain[1:1 + name_len].decode(), "circ_out": plain[1 + name_len:9 + name_len].hex(),
+        "next_channel": None, "partial": bytearray(),
+    }
+    _relays[(id(channel), circ_id)] = hop
+    if hop["next"]:
+        hop["next_channel"] = _link(hop["next"])
+        _upstream[(id(hop["next_channel"]), hop["circ_out"])] = hop
+        _send(hop["next_channel"], "circ_create", hop["circ_out"], _pad(plain[9 + name_len:], CREATE_SIZE))
+
+
+def on_cell(channel, circ_id, body):
+    hop = _relays.get((id(channel), circ_id))
+    if hop is None:
+        return
+    n = hop["counter"]
+    hop["counter"] += 1
+    hop["last"] = time.time()
+    if hop["next"]:
+        _send(hop["next_channel"], "cell", hop["circ_out"], _stream(hop["key"], n, _raw(body)))
+        return
+
+    try:
+        plain = cipher(hop["key"]).decrypt(_nonce(n), _raw(body), None)
+    except Exception:
+        print("🚨 Onion cell failed its integrity check; closing the circuit")
+        _drop_relay(hop)
+        _send(channel, "circ_destroy", circ_id)
+        return
+    flags, length = CELL_HEADER.unpack_from(plain)
+    if flags & FLAG_PAD:
+        return
+    hop["partial"] += plain[CELL_HEADER.size:CELL_HEADER.size + length]
+    if flags & FLAG_MORE:
+        return
+    text = hop["partial"].decode(errors="replace")
+    hop["partial"] = bytearray()
+    if _me["on_message"]:
+        _me["on_message"](text)
+
+
+def on_destroy(channel, circ_id):
+    hop = _relays.get((id(channel), circ_id))
+    if hop is not None:
+        _drop_relay(hop)
+        if hop["next_channel"] is not None:
+            _send(hop["next_channel"], "circ_destroy", hop["circ_out"])
+        return
+    hop = _upstream.get((id(channel), circ_id))
+    if hop is not None:
+        _drop_relay(hop)
+        _send(hop["prev"], "circ_destroy", hop["circ_in"])
+        return
+    for circuit in list(_circuits.values()):
+        if circuit.channel is channel and circuit.circ_id == circ_id:
+            circuit.alive = False
+            print(f"🧅 Circuit to {circuit.target} was closed; it will be rebuilt on the next message")
+
+
+def drop_channel(channel):
+    for circuit in list(_circuits.values()):
+        if circuit.channel is channel:
+            del _circuits[circuit.target]
+    for hop in list(_relays.values()) + list(_upstream.values()):
+        if hop["prev"] is channel or hop["next_channel"] is channel:
+            _drop_relay(hop)
+
+
+def _print_message(text):
+    print("📩 Final onion message reached me!")
+    print("🔓 Onion payload:", text)
+
+
+def register_handlers(dispatcher, channel, username, private_key, on_message=None):
+    """Wire circ_create / cell / circ_destroy into `dispatcher`."""
+    # Every connection registers these; the first one stays the fallback link
+    _me.update(channel=_me["channel"] or channel, private_key=private_key, on_message=on_message or _print_message)
+
+    def create_handler(fields):
+        try:
+            on_create(channel, fields[0], fields[1])
+        except Exception as e:
+            print("❌ Bad onion create cell:", e)
+            _send(channel, "circ_destroy", fields[0])
+
+    dispatcher.register("circ_create", create_handler, fields=2)
+    dispatcher.register("cell", lambda fields: on_cell(channel, fields[0], fields[1]), fields=2)
+    dispatcher.register("circ_destroy", lambda fields: on_destroy(channel, fields[0]), fields=1)
+
+
+scheduler.register("onion_maintenance", maintain)
@@ -0,0 +1,284 @@
+# outbox.py – Write-ahead offline queue with per-recipient delivery cursors
+#
+# Frames for a contact that is offline are appended to that contact's outbox:
+#   outbox/<sha256(recipient)[:32]>/<first seq>.seg   records: header + id + frame
+# Every record gets a sequence number. The recipient's delivery cursor (stored
+# in state_store) is the first seq not yet confirmed, so appending never
+# rewrites anything, and whole segments below the cursor are simply deleted.
+#
+# When the contact answers a ping on a channel where it proved its name
+# (wire_format.verified_peer) the outbox is drained in order, with a bounded
+# number of unacknowledged frames in flight and the channel's buffer watched
+# for backpressure. "@delivered::<user>::<hash>" acks advance the cursor; the
+# hash must match a frame in flight, so acks without one confirm nothing.
+# Frames nobody acked are sent again on the next drain, so delivery is
+# at-least-once, and entries older than TTL_SECONDS are dropped unsent.
+
+import asyncio
+import hashlib
+import os
+import struct
+import time
+from collections import deque
+
+import metrics
+import state_store
+from constants import OUTBOX_DIR
+from wire_format import send_frame
+
+CURSOR_NS = "outbox"
+SEGMENT_MAX_BYTES = 1024 * 1024
+TTL_SECONDS = 7 * 24 * 3600
+WINDOW = 256  # unacknowledged frames in flight per recipient
+ACK_TIMEOUT = 15  # seconds without an ack before a drain gives up until the next pong
+HIGH_WATER = 1024 * 1024  # pause while the channel has more than this buffered
+BATCH = 64  # frames sent between event-loop yields
+
+# seq, queued at, id length, frame length
+RECORD = struct.Struct(">QdHI")
+
+_outboxes = {}
+_migrated = False
+
+
+def _message_id(payload):
+    """The hash a receiver echoes in @delivered: field 2 of @msg, field 3 of @file."""
+    parts = payload.split("::", 4)
+    if parts[0] == "@msg" and len(parts) > 2:
+        return parts[2]
+    if parts[0] == "@file" and len(parts) > 3:
+        return parts[3]
+    return ""
+
+
+class Outbox:
+    def __init__(self, recipient):
+        self.recipient = recipient
+        self.dir = os.path.join(OUTBOX_DIR, hashlib.sha256(recipient.encode()).hexdigest()[:32])
+        self.cursor = state_store.get(CURSOR_NS, recipient, 0)
+        self.next_seq = self.cursor
+        self.pending = deque()  # (seq, queued_at, msg_id, payload) with seq >= cursor
+        self.done = set()  # seqs past the cursor that were acked, expired or need no ack
+        self.inflight = {}  # seq -> (msg_id, sent_at), oldest first
+        self.segments = []  # first seq of each segment file
+        self.drain_task = None
+        self._acked = asyncio.Event()
+        self._fh = None
+        self._load()
+
+    def _segment_path(self, first_seq):
+        return os.path.join(self.dir, f"{first_seq:012d}.seg")
+
+    def _load(self):
+        if not os.path.isdir(self.dir):
+            return
+        self.segments = sorted(int(name[:-4]) for name in os.listdir(self.dir) if name.endswith(".seg"))
+        for first_seq in self.segments:
+            path = self._segment_path(first_seq)
+            with open(path, "rb") as f:
+                data = f.read()
+            pos = 0
+            while pos + RECORD.size <= len(data):
+                seq, queued_at, id_len, size = RECORD.unpack_from(data, pos)
+                end = pos + RECORD.size + id_len + size
+                if end > len(data):
+                    break
+                body = data[pos + RECORD.size:end]
+                if seq >= self.cursor:
+                    self.pending.append((seq, queued_at, body[:id_len].decode(), body[id_len:].decode()))
+                self.next_seq = max(self.next_seq, seq + 1)
+                pos = end
+            if pos < len(data):
+                # Torn write from a crash: drop the partial record
+                with open(path, "r+b") as f:
+                    f.truncate(pos)
+
+    # === Writing ===
+
+    def append(self, payload):
+        seq = self.next_seq
+        self.next_seq += 1
+        msg_id = _message_id(payload)
+        queued_at = time.time()
+        id_raw, body = msg_id.encode(), payload.encode()
+
+        if self._fh is None or self._fh.tell() >= SEGMENT_MAX_BYTES:
+            self._roll(seq)
+        self._fh.write(RECORD.pack(seq, queued_at, len(id_raw), len(body)) + id_raw + body)
+        self._fh.flush()
+        if self.cursor == seq == 0:
+            state_store.put(CURSOR_NS, self.recipient, 0)
+        self.pending.append((seq, queued_at, msg_id, payload))
+        return seq
+
+    def _roll(self, first_seq):
+        if self._fh is not None:
+            self._fh.close()
+        os.makedirs(self.dir, exist_ok=True)
+        if self.segments and os.path.getsize(self._segment_path(self.segments[-1])) < SEGMENT_MAX_BYTES:
+            first_seq = self.segments[-1]  # keep filling the last segment after a restart
+        else:
+            self.segments.append(first_seq)
+        self._fh = open(self._segment_path(first_seq), "ab")
+
+    # === Delivery ===
+
+    def ack(self, msg_id):
+        if not msg_id:
+            return False
+        seq = None
+        for candidate, (inflight_id, _) in self.inflight.items():
+            if inflight_id == msg_id:
+                seq = candidate
+                break
+        if seq is None:
+            return False
+        del self.inflight[seq]
+        self.done.add(seq)
+        self._acked.set()
+        self._advance()
+        return True
+
+    def _advance(self):
+        moved = False
+        while self.pending and self.pending[0][0] in self.done:
+            seq = self.pending.popleft()[0]
+            self.done.discard(seq)
+            self.cursor = seq + 1
+            moved = True
+        if not self.pending:
+            self.cursor = self.next_seq
+        if moved or not self.pending:
+            state_store.put(CURSOR_NS, self.recipient, self.cursor)
+            self._compact()
+
+    def _compact(self):
+        # A segment can go once the next one starts at or below the cursor
+        while len(self.segments) > 1 and self.segments[1] <= self.cursor:
+            os.remove(self._segment_path(self.segments.pop(0)))
+        if self.segments and not self.pending:
+            if self._fh is not None:
+                self._fh.close()
+                self._fh = None
+            for first_seq in self.segments:
+                os.remove(self._segment_path(first_seq))
+            self.segments = []
+
+    def expire(self, now=None):
+        now = now or time.time()
+        expired = 0
+        for seq, queued_at, _, _ in self.pending:
+            if seq not in self.done and seq not in self.inflight and now - queued_at > TTL_SECONDS:
+                self.done.add(seq)
+                expired += 1
+        if expired:
+            self._advance()
+        return expired
+
+    async def drain(self, channel):
+        now = time.time()
+        expired = self.expire(now)
+        if expired:
+            print(f"⌛ Dropped {expired} expired queued messages for {self.recipient}")
+
+        # Anything still unacked from an earlier drain is presumed lost
+        for seq, (_, sent_at) in list(self.inflight.items()):
+            if now - sent_at > ACK_TIMEOUT:
+                del self.inflight[seq]
+
+        sent = 0
+        for seq, _, msg_id, payload in list(self.pending):
+            if seq in self.done or seq in self.inflight:
+                continue
+            while len(self.inflight) >= WINDOW:
+                self._acked.clear()
+                try:
+                    await asyncio.wait_for(self._acked.wait(), ACK_TIMEOUT)
+                except asyncio.TimeoutError:
+                    print(f"⚠️ {self.recipient} stopped acknowledging; {len(self.pending) - len(self.done)} messages stay queued")
+                    return sent
+            while getattr(channel, "bufferedAmount", 0) > HIGH_WATER:
+                await asyncio.sleep(0.01)
+
+            send_frame(channel, payload)
+            if msg_id:
+                self.inflight[seq] = (msg_id, time.time())
+            else:
+                self.done.add(seq)
+            sent += 1
+            if sent % BATCH == 0:
+                await asyncio.sleep(0)
+        self._advance()
+        return sent
+
+
+# === Module API ===
+
+
+def _outbox(recipient):
+    global _migrated
+    if not _migrated:
+        _migrated = True
+        _migrate_legacy_queue()
+    box = _outboxes.get(recipient)
+    if box is None:
+        box = _outboxes[recipient] = Outbox(recipient)
+    return box
+
+
+def _migrate_legacy_queue():
+    # Payload lists from the old offline_queue namespace / offline_queue.json
+    legacy = state_store.items("offline_queue")
+    if not legacy:
+        return
+    for recipient, payloads in legacy.items():
+        box = _outboxes[recipient] = Outbox(recipient)
+        for payload in payloads:
+            box.append(payload)
+    state_store.clear("offline_queue")
+    print(f"📦 Moved queued messages for {len(legacy)} contacts into the outbox")
+
+
+def queue(recipient, payload):
+    """Durably queue a frame for `recipient`. Returns its sequence number."""
+    return _outbox(recipient).append(payload)
+
+
+def pending_count(recipient):
+    box = _outbox(recipient)
+    return len(box.pending) - len(box.done)
+
+
+def ack(recipient, msg_id):
+    """Handle "@delivered::recipient::msg_id"; True if it confirmed a frame in flight."""
+    if not msg_id or recipient not in _outboxes and state_store.get(CURSOR_NS, recipient) is None:
+        return False
+    return _outbox(recipient).ack(msg_id)
+
+
+def start_drain(channel, recipient):
+    """Send everything queued for `recipient` in the background (no-op while a drain runs)."""
+    box = _outbox(recipient)
+    if box.drain_task and not box.drain_task.done():
+        return box.drain_task
+    if len(box.pending) == len(box.done):
+        return None
+
+    async def run():
+        sent = await box.drain(channel)
+        if sent:
+            print(f"📤 Sent {sent} queued messages to {recipient}")
+
+    box.drain_task = asyncio.get_running_loop().create_task(run())
+    return box.drain_task
+
+
+def expire_all(job=None):
+    """Drop expired entries and compact every outbox (runs as a scheduler job)."""
+    for recipient in state_store.keys(CURSOR_NS):
+        expired = _outbox(recipient).expire()
+        if expired:
+            print(f"⌛ Dropped {expired} expired queued messages for {recipient}")
+
+
+metrics.gauge("outbox_pending", lambda: {name: pending_count(name) for name in _outboxes}, label="recipient")
@@ -3,18 +3,39 @@
 import asyncio
 import json
 import os
-import cv2
 channel = None
-from aiortc import RTCPeerConnection, RTCSessionDescription
-try:
-    from playsound import playsound
-except ImportError:
-    playsound = None
+# aiortc, playsound and OpenCV (noise_cam) are imported where they are used: together they
+# take longer to import than the rest of the app takes to start
 public_keys = {}
-presence_status = {}
-from auto_backup import should_backup, create_auto_backup
+import scheduler
+import outbox
+import dht
+import group_session
+import onion
+import crypto_pool
+import presence
+import state_store
 from pinned import set_pinned_for
 from pinned import get_pinned_for, unpin_message
+from hashlib import sha256
+from dispatcher import MessageDispatcher, RAW
+from wire_format import send_frame, send_hello, on_hello, peer_version, forget_channel
+from wire_format import answer_challenge, on_proof, send_challenge
+import wire_format
+import console
+from console import ask
+import file_transfer
+from profile_manager import get_contact_profile
+import vault_manager
+from key_storage import load_rotation
+import connection_pool
+import signaling
+import noise_cam
+import metrics
+import usage_store
+
+# 📶 Routes every incoming frame; other modules may register extra handlers
+dispatcher = MessageDispatcher()
 
 
 # 💡 Temporary signal file (simulate QR exchange or basic server)
@@ -35,514 +56,418 @@ def save_groups(groups):
         json.dump(groups, f, indent=2)
 
 
-def auto_share_dht(channel, username):
-    if not os.path.exists("dht.json"):
-        print("📭 No DHT to share.")
-        return
-
-    with open("dht.json", "r", encoding="utf-8") as f:
-        dht_data = json.load(f)
-
-    payload = json.dumps({
-        "type": "dht_share",
-        "from": username,
-        "data": dht_data
-    })
-
-    channel.send(payload)
-    print("📡 Auto-shared DHT with all peers.")
+async def file_signal(name, offer):
+    """Per-peer version of the signal file exchange, used by /connect."""
+    offer_file, answer_file = f"signal_offer_{name}.json", f"signal_answer_{name}.json"
+    with open(offer_file, "w") as f:
+        json.dump(offer, f)
+    print(f"📤 Offer for {name} saved to {offer_file}; waiting for {answer_file}")
+    while not os.path.exists(answer_file):
+        await asyncio.sleep(1)
+    with open(answer_file, "r") as f:
+        answer = json.load(f)
+    os.remove(answer_file)
+    return answer
 
 
-def ping_contacts(channel, contacts, username):
-    for contact in contacts:
-        channel.send(f"@ping::{username}")
+def auto_share_dht(channel, username):
+    size = dht.start_sync(channel, username)
+    print(f"📡 Sent DHT digest ({size} bytes) to peer.")
 
 
 from datetime import datetime
-from constants import HISTORY_FILE
 from ecdh_encryption import encrypt_message
 from ecdh_encryption import decrypt_message
+from message_store import append_message, DIRECTION_FROM
+from search_index import index_message
 
 
-def log_received(my_username, sender, text, private_key, public_key):
-    encrypted = encrypt_message(private_key, public_key, text)
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    with open(HISTORY_FILE, "a", encoding="utf-8") as f:
-        f.write(f"[{timestamp}] From {sender}: {encrypted}\n")
-
-
-def merge_dht(received, username):
-    filename = "dht.json"
-    if os.path.exists(filename):
-        with open(filename, "r", encoding="utf-8") as f:
-            local = json.load(f)
-    else:
-        local = []
-
-    hashes = {entry["username_hash"] for entry in local}
-    for entry in received:
-        if entry["username_hash"] not in hashes:
-            local.append(entry)
-
-    # ✅ Sort by XOR distance to your own username
-    import hashlib
-    my_hash = hashlib.sha256(username.encode()).hexdigest()
-
-    def xor_dist(h1, h2):
-        return int(h1, 16) ^ int(h2, 16)
-    local.sort(key=lambda e: xor_dist(my_hash, e["username_hash"]))
-
-    local = local[:200]  # Keep only closest 200
-    with open(filename, "w", encoding="utf-8") as f:
-        json.dump(local, f, indent=2)
-    print(f"🤝 Merged {len(received)} entries into DHT.")
-
-
-def blur_faces(image_path):
-    try:
-        image = cv2.imread(image_path)
-        if image is None:
-            print("❌ Could not read image.")
-            return None
-
-        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + "haarcascade_frontalface_default.xml")
-        faces = face_cascade.detectMultiScale(gray, 1.1, 4)
-
-        for (x, y, w, h) in faces:
-            face = image[y:y + h, x:x + w]
-            blurred = cv2.GaussianBlur(face, (99, 99), 30)
-            image[y:y + h, x:x + w] = blurred
-
-        out_path = "blurred_output.jpg"
-        cv2.imwrite(out_path, image)
-        return out_path
-    except Exception as e:
-        print("❌ Blur failed:", e)
-        return None
-
-
-async def start_webrtc_chat(username, private_key, public_key):
-    # Setup
-    pc = RTCPeerConnection()
-    channel = pc.createDataChannel("siphrix")
-    import __main__
-    __main__.channel = channel
-    from user_send import start_scheduled_sender
-    from ecdh_encryption import encrypt_message, sign_message
-    start_scheduled_sender(channel, username, private_key, public_key, encrypt_message, sign_message)
-
-    print(f"📡 [{username}] Peer connection created.")
+def known_key(name):
+    """Key to check `name`'s proofs against: its signed DHT entry, else the key it sent us."""
+    entry = dht.find_value(name)
+    return entry["public_key"] if entry else public_keys.get(name)
 
-    async def monitor_presence():
-        while True:
-            for person in presence_status:
-                if presence_status[person] != "🟢 online":
-                    presence_status[person] = "⚫ offline"
-            await asyncio.sleep(30)
 
-    # When message is received
-    @channel.on("message")
-    async def on_message(message):
+def log_received(my_username, sender, text, private_key, public_key):
+    encrypted = encrypt_message(private_key, public_key, text)
+    ref = append_message(sender, DIRECTION_FROM, encrypted)
+    index_message(ref, text)
 
-        # ✅ Handle onion messages
-        try:
-            parsed = json.loads(message)
-            from ecdh_encryption import decrypt_message
-
-            if parsed.get("type") == "onion":
-                route = parsed.get("route", [])
-                encrypted_payload = parsed.get("payload")
-
-                if not route:
-                    print("📩 Final onion message reached me!")
-                    from ecdh_encryption import decrypt_message
-                    decrypted = decrypt_message(private_key, "", encrypted_payload)
-                    print("🔓 Onion payload:", decrypted)
-                    return
-
-                next_hop = route[0]
-                remaining_route = route[1:]
-
-                # Prepare next layer to send
-                from ecdh_encryption import encrypt_message
-                if next_hop not in public_keys:
-                    print(f"❌ No key for next hop: {next_hop}")
-                    return
-
-                inner_payload = json.dumps({
-                    "type": "onion",
-                    "route": remaining_route,
-                    "payload": encrypted_payload
-                })
 
-                double_encrypted = encrypt_message(private_key, public_keys[next_hop], inner_payload)
+def make_bind(username, private_key, public_key):
+    """bind(channel, dispatcher): registers every frame handler for one connection."""
+    from user_send import check_for_reminder, handle_incoming_receipt
 
-                forward = json.dumps({
-                    "type": "onion",
-                    "route": [next_hop],
-                    "payload": double_encrypted
-                })
+    # === Incoming frame handlers ===
+    # Every connection gets its own dispatcher; replies go back on the channel the frame came in on
 
-                channel.send(forward)
-                print(f"🧅 Forwarded to {next_hop}")
-                return
-        except:
-            pass
+    def bind(channel, dispatcher):
+        # Onion traffic now runs over circuits (onion.py); old clients still send JSON
+        def on_onion(parsed):
+            print("⚠️ Ignored a legacy onion frame; the sender needs to update to use circuits")
 
-        try:
+        def on_ping(fields):
+            send_frame(channel, f"@pong::{username}")
 
-            if message.startswith("@ping::"):
-                sender = message.split("::")[1]
-                channel.send(f"@pong::{username}")
-                return
-
-            if message.startswith("@pong::"):
-                sender = message.split("::")[1]
-                presence_status[sender] = "🟢 online"
+        def on_pong(fields):
+            sender = fields[0]
+            if presence.seen(sender):
                 print(f"🟢 {sender} is online")
-                last_seen = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-
-                # Save it to a local file
-                seen_data = {}
-                if os.path.exists("last_seen.json"):
-                    with open("last_seen.json", "r", encoding="utf-8") as f:
-                        seen_data = json.load(f)
-                seen_data[sender] = last_seen
-                with open("last_seen.json", "w", encoding="utf-8") as f:
-                    json.dump(seen_data, f, indent=2)
-
-                # ✅ Send any queued messages
+
+            # ✅ Send any queued messages (the outbox keeps them until @delivered comes back),
+            # but only to a channel where the recipient proved its name
+            if wire_format.verified_peer(channel) == sender:
+                outbox.start_drain(channel, sender)
+
+        def on_key(fields):
+            # Save the peer's public key
+            sender, pubkey = fields
+            public_keys[sender] = pubkey
+            onion.key_arrived(sender)
+            print(f"🔐 Received public key from {sender}")
+
+        def on_request_key(fields):
+            requester = fields[0]
+            response = f"@key_for::{username}::{public_key}"  # your own public key
+            send_frame(channel, response)
+            print(f"📤 Sent public key to {requester}")
+
+        def on_key_for(fields):
+            contact, pubkey = fields
+            public_keys[contact] = pubkey
+            onion.key_arrived(contact)
+            print(f"📬 Key for {contact} received and saved.")
+
+        def on_typing(fields):
+            print(f"✍️ {fields[0]} is typing...")
+
+        def on_stop_typing(fields):
+            print(f"✍️ {fields[0]} stopped typing.")
+
+        def on_reaction(fields):
+            if len(fields) == 3:
+                sender, msg_id, emoji = fields
+                print(f"💞 {sender} reacted to msg {msg_id}: {emoji}")
                 try:
-                    from user_send import queue_offline_message
-                    if os.path.exists("offline_queue.json"):
-                        with open("offline_queue.json", "r", encoding="utf-8") as f:
-                            queue = json.load(f)
-                        if sender in queue:
-                            for payload in queue[sender]:
-                                channel.send(payload)
-                                print(f"📤 Sent queued message to {sender}")
-                            del queue[sender]
-                            with open("offline_queue.json", "w", encoding="utf-8") as f:
-                                json.dump(queue, f, indent=2)
+                    from playsound import playsound
+                    playsound("sounds/reaction.mp3", block=False)
+                except ImportError:
+                    pass
                 except Exception as e:
-                    print("⚠️ Failed to send queued messages:", e)
-
-            if message.startswith("@key::"):
-                # Save the peer's public key
-                parts = message.split("::", 2)
-                sender = parts[1]
-                pubkey = parts[2]
-                public_keys[sender] = pubkey
-                print(f"🔐 Received public key from {sender}")
-                return
+                    print("🔇 Could not play sound:", e)
+
+        def on_edit(fields):
+            if len(fields) == 3:
+                sender, msg_id, new_text = fields
+                print(f"✏️ Message from {sender} (ID: {msg_id}) was edited:")
+                print(f"➡️  New content: {new_text}")
+
+                # 📝 Save to edit history
+                key = state_store.message_key(sender, msg_id)
+                edits = state_store.get("edit_history", key, [])
+                edits.append({
+                    "new_text": new_text,
+                    "time": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                })
+                state_store.put("edit_history", key, edits)
 
-            if message.startswith("@request_key::"):
-                parts = message.split("::", 1)
-                requester = parts[1]
-                key = public_key  # your own public key
-                response = f"@key_for::{username}::{key}"
-                channel.send(response)
-                print(f"📤 Sent public key to {requester}")
-                return
+        def on_delete(fields):
+            if len(fields) == 2:
+                sender, msg_id = fields
+                print(f"🗑️ Message from {sender} (ID: {msg_id}) was deleted.")
 
-            if message.startswith("@key_for::"):
-                parts = message.split("::", 2)
-                contact = parts[1]
-                pubkey = parts[2]
-                public_keys[contact] = pubkey
-                print(f"📬 Key for {contact} received and saved.")
-                return
+        async def on_file(fields):
+            sender, filename, file_hash, expiry, encrypted = fields
 
-            if isinstance(message, bytes):
-                message = message.decode("utf-8")
+            if sender not in public_keys:
+                print(f"❌ No public key for sender: {sender}")
+                return
 
+            # Decrypt
+            decrypted_bytes = decrypt_message(private_key, public_keys[sender], encrypted).encode()
+            actual_hash = sha256(decrypted_bytes).hexdigest()
 
+            if actual_hash != file_hash:
+                print(f"🚨 File '{filename}' from {sender} failed integrity check!")
+                return
+            send_frame(channel, f"@delivered::{username}::{file_hash}")
 
-            # ✅ Check for DHT sharing
             try:
-                parsed = json.loads(message)
-                if parsed.get("type") == "dht_share":
-                    print(f"📥 Received DHT share from {parsed['from']}")
-                    merge_dht(parsed["data"], username)
-                    return
-            except:
-                pass
-
-            if message.startswith("@typing::"):
-                sender = message.split("::")[1]
-                print(f"✍️ {sender} is typing...")
-                return
+                from tkinter import filedialog, Tk
+                Tk().withdraw()
+                folder = filedialog.askdirectory(title="Select folder to save file")
+            except Exception as e:
+                print("❌ Could not open folder dialog:", e)
+                folder = "."
+
+            if folder:
+                save_path = os.path.join(folder, f"received_{filename}")
+                # Save decrypted file to disk
+                with open(save_path, "wb") as f:
+                    f.write(decrypted_bytes)
+                print(f"📁 File saved to: {save_path}")
+
+                # ✅ Also store encrypted copy in vault
+                if (not expiry or expiry == "None") and vault_manager.open_vault(private_key, public_key):
+                    vault_manager.store_bytes(filename, decrypted_bytes, sender=sender)
+                    print(f"🔒 Saved {filename} to the vault")
+
+                print(f"📁 File from {sender} saved to: {save_path}")
 
-            if message.startswith("@stop_typing::"):
-                sender = message.split("::")[1]
-                print(f"✍️ {sender} stopped typing.")
-                return
+                if expiry and expiry != "None":
+                    seconds = int(expiry)
+                    print(f"⏳ This file will self-destruct in {seconds} seconds...")
+                    scheduler.schedule_in("expire_file", seconds, {"path": save_path})
+            else:
+                print("❌ No folder selected.")
 
-            if message.startswith("@reaction::"):
-                parts = message.split("::", 3)
-                if len(parts) == 4:
-                    sender, msg_id, emoji = parts[1], parts[2], parts[3]
-                    print(f"💞 {sender} reacted to msg {msg_id}: {emoji}")
-                    if playsound:
-                        try:
-                            playsound("sounds/reaction.mp3", block=False)
-                        except Exception as e:
-                            print("🔇 Could not play sound:", e)
+        async def on_msg(fields):
+            sender, msg_hash, expiry, encrypted, signature = fields  # expiry: seconds as string
 
-                    pass
+            if sender not in public_keys:
+                print(f"❌ No key for {sender}")
                 return
 
-            if message.startswith("@edit::"):
-                parts = message.split("::", 3)
-                if len(parts) == 4:
-                    sender, msg_id, new_text = parts[1], parts[2], parts[3]
-                    print(f"✏️ Message from {sender} (ID: {msg_id}) was edited:")
-                    print(f"➡️  New content: {new_text}")
-
-                    # 📝 Save to edit_history.json
-                    history_file = "edit_history.json"
-                    history = {}
-                    if os.path.exists(history_file):
-                        with open(history_file, "r", encoding="utf-8") as f:
-                            history = json.load(f)
-                    history.setdefault(sender, {}).setdefault(msg_id, []).append({
-                        "new_text": new_text,
-                        "time": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                    })
-                    with open(history_file, "w", encoding="utf-8") as f:
-                        json.dump(history, f, indent=2)
+            try:
+                decrypted = decrypt_message(private_key, public_keys[sender], encrypted)
+            except Exception as e:
+                print("❌ Decryption failed:", e)
                 return
 
-            if message.startswith("@delete::"):
-                parts = message.split("::", 2)
-                if len(parts) == 3:
-                    sender, msg_id = parts[1], parts[2]
-                    print(f"🗑️ Message from {sender} (ID: {msg_id}) was deleted.")
+            if not await crypto_pool.verify(public_keys[sender], decrypted, signature):
+                print(f"🚨 Signature check failed for message from {sender}")
                 return
 
-            from hashlib import sha256
-
-            if message.startswith("@file::"):
-                parts = message.split("::", 5)
-                sender = parts[1]
-                filename = parts[2]
-                file_hash = parts[3]
-                expiry = parts[4]
-                encrypted = parts[5]
+            actual_hash = sha256(decrypted.encode()).hexdigest()
+            if actual_hash != msg_hash:
+                print(f"🚨 Message from {sender} failed hash check!")
+                return
+            presence.seen(sender)
 
-                if sender not in public_keys:
-                    print(f"❌ No public key for sender: {sender}")
-                    return
+            # 📌 Show pinned messages at the top
+            pinned = get_pinned_for(sender)
+            if pinned:
+                print("📌 Pinned messages:")
+                for i, msg in enumerate(pinned):
+                    print(f"   {i + 1}. {msg}")
 
-                # Decrypt
-                decrypted_bytes = decrypt_message(private_key, public_keys[sender], encrypted).encode()
-                actual_hash = sha256(decrypted_bytes).hexdigest()
+            print(f"\n📩 Message from {sender}: {decrypted}")
 
-                if actual_hash != file_hash:
-                    print(f"🚨 File '{filename}' from {sender} failed integrity check!")
-                    return
+            check_for_reminder(decrypted, sender)
 
+            # 🔵 Increase unread count
+            try:
+                unread = state_store.increment("unread_count", sender)
+                print(f"🔵 Unread count for {sender}: {unread}")
+            except Exception as e:
+                print("⚠️ Failed to update unread count:", e)
+
+            # ✅✅ Send read receipt back to sender
+            if sender:
+                read_receipt = f"@read::{username}"
+                send_frame(channel, read_receipt)
+            # ✅ Send delivery receipt back to sender
+            delivered_receipt = f"@delivered::{username}::{msg_hash}"
+            send_frame(channel, delivered_receipt)
+
+            profile = get_contact_profile(sender)
+            if profile:
+                print("👤 Sender Profile:")
+                print("   - Name:", profile.get("name", "N/A"))
+                print("   - Status:", profile.get("status", "N/A"))
+                print("   - Avatar path:", profile.get("avatar", "Not set"))
+            print("   - Presence:", presence.status(sender))
+
+            if expiry and expiry != "None":
                 try:
-                    from tkinter import filedialog, Tk
-                    Tk().withdraw()
-                    folder = filedialog.askdirectory(title="Select folder to save file")
-                except Exception as e:
-                    print("❌ Could not open folder dialog:", e)
-                    folder = "."
-
-                if folder:
-                    save_path = os.path.join(folder, f"received_{filename}")
-                    # Save decrypted file to disk
-                    with open(save_path, "wb") as f:
-                        f.write(decrypted_bytes)
-                    print(f"📁 File saved to: {save_path}")
-
-                    # ✅ Also store encrypted copy in vault
-                    from vault_manager import save_encrypted_to_vault
-                    save_encrypted_to_vault(filename, decrypted_bytes.decode(errors="ignore"), private_key,
-                                            public_keys[sender])
-
-                    print(f"📁 File from {sender} saved to: {save_path}")
-
-                    if expiry and expiry != "None":
-                        try:
-                            seconds = int(expiry)
-                            print(f"⏳ This file will self-destruct in {seconds} seconds...")
-                            await asyncio.sleep(seconds)
-                            os.remove(save_path)
-                            print("💥 File deleted after view.")
-                        except Exception as e:
-                            print("⚠️ Error during file expiration:", e)
-                else:
-                    print("❌ No folder selected.")
+                    seconds = int(expiry)
+                    print(f"⏳ This message will self-destruct in {seconds} seconds...")
+                    await asyncio.sleep(seconds)
+                    print("💥 Message destroyed.")
+                except:
+                    pass
+            else:
+                log_received(username, sender, decrypted, private_key, public_key)
+                print("📩 Message saved.")
+
+        # 📨 Handle read/delivered receipts
+        def on_receipt(fields, kind):
+            handle_incoming_receipt(f"@{kind}::{'::'.join(fields)}")
+
+        def on_hello_frame(fields):
+            version = on_hello(channel, fields, username)
+            print(f"🤝 {fields[0]} speaks wire v{version}")
+            if version >= 5:
+                send_challenge(channel)
+
+        def on_auth_challenge(fields):
+            answer_challenge(channel, username, private_key, fields[0])
+
+        def on_auth_proof(fields):
+            # Only a peer that signed our challenge gets traffic addressed to its name
+            name, signature = fields
+            if not on_proof(channel, username, name, signature, known_key(name)):
+                print(f"⚠️ {name} could not prove its hello; nothing is routed to it")
+                return
+            connection_pool.adopt(name, channel)
+            file_transfer.resume_incoming(channel, username, name)
+            outbox.start_drain(channel, name)
+
+        def on_raw(message):
+            print(f"📨 Raw message received: {message}")
+
+        dispatcher.register("onion", on_onion)
+        dispatcher.register("ping", on_ping, fields=1)
+        dispatcher.register("pong", on_pong, fields=1)
+        dispatcher.register("key", on_key, fields=2)
+        dispatcher.register("request_key", on_request_key, fields=1)
+        dispatcher.register("key_for", on_key_for, fields=2)
+        dispatcher.register("typing", on_typing, fields=1)
+        dispatcher.register("stop_typing", on_stop_typing, fields=1)
+        dispatcher.register("reaction", on_reaction, fields=3)
+        dispatcher.register("edit", on_edit, fields=3)
+        dispatcher.register("delete", on_delete, fields=2)
+        dispatcher.register("file", on_file, fields=5)
+        dispatcher.register("msg", on_msg, fields=5)
+        dispatcher.register("read", lambda fields: on_receipt(fields, "read"), fields=1)
+        dispatcher.register("delivered", lambda fields: on_receipt(fields, "delivered"), fields=2)
+        dispatcher.register("hello", on_hello_frame, fields=2)
+        dispatcher.register("auth_challenge", on_auth_challenge, fields=1)
+        dispatcher.register("auth_proof", on_auth_proof, fields=2)
+        dispatcher.register(RAW, on_raw)
+        def store_in_vault(path, state):
+            # Self-destructing files stay out of the vault; the rest are encrypted off the loop
+            if state["expiry"] and state["expiry"] != "None":
+                return
+            if not vault_manager.open_vault(private_key, public_key):
                 return
 
-            from hashlib import sha256
-
-            if message.startswith("@msg::"):
-                parts = message.split("::", 5)
-                sender = parts[1]
-                msg_hash = parts[2]
-                expiry = parts[3]  # seconds as string
-                encrypted = parts[4]
-                signature = parts[5]
-
-                if sender not in public_keys:
-                    print(f"❌ No key for {sender}")
-                    return
-
+            def run():
                 try:
-                    decrypted = decrypt_message(private_key, public_keys[sender], encrypted)
-                    from ecdh_encryption import verify_signature
-                    if not verify_signature(public_keys[sender], decrypted, signature):
-                        print(f"🚨 Signature check failed for message from {sender}")
-                        return
-
+                    vault_manager.store_file(path, state["filename"], state["sender"])
                 except Exception as e:
-                    print("❌ Decryption failed:", e)
-                    return
+                    print("❌ Failed to store file in vault:", e)
 
-                actual_hash = sha256(decrypted.encode()).hexdigest()
-                if actual_hash != msg_hash:
-                    print(f"🚨 Message from {sender} failed hash check!")
-                    return
+            asyncio.get_running_loop().run_in_executor(None, run)
 
-                # 📌 Show pinned messages at the top
-                from pinned import get_pinned_for
-                pinned = get_pinned_for(sender)
-                if pinned:
-                    print("📌 Pinned messages:")
-                    for i, msg in enumerate(pinned):
-                        print(f"   {i + 1}. {msg}")
+        file_transfer.register_handlers(dispatcher, channel, username, private_key, public_keys, on_complete=store_in_vault)
+        dht.register_handlers(dispatcher, channel, username)
+        onion.register_handlers(dispatcher, channel, username, private_key)
+        group_session.register_handlers(
+            dispatcher, channel, username, private_key, public_keys,
+            on_message=lambda group, sender, text: log_received(username, sender, text, private_key, public_key),
+        )
 
-                print(f"\n📩 Message from {sender}: {decrypted}")
+    return bind
 
-                from user_send import check_for_reminder
-                check_for_reminder(decrypted, sender)
 
-                # 🔵 Increase unread count
-                unread_file = "unread_count.json"
-                try:
-                    unread_data = {}
-                    if os.path.exists(unread_file):
-                        with open(unread_file, "r", encoding="utf-8") as f:
-                            unread_data = json.load(f)
-                    unread_data[sender] = unread_data.get(sender, 0) + 1
-                    with open(unread_file, "w", encoding="utf-8") as f:
-                        json.dump(unread_data, f, indent=2)
-                    print(f"🔵 Unread count for {sender}: {unread_data[sender]}")
-                except Exception as e:
-                    print("⚠️ Failed to update unread count:", e)
-
-                # ✅✅ Send read receipt back to sender
-                if sender:
-                    read_receipt = f"@read::{username}"
-                    channel.send(read_receipt)
-                # ✅ Send delivery receipt back to sender
-                delivered_receipt = f"@delivered::{username}"
-                channel.send(delivered_receipt)
-
-                from profile_manager import get_contact_profile  # 📌 Make sure this is at the top of the file!
-
-                profile = get_contact_profile(sender)
-                if profile:
-                    print("👤 Sender Profile:")
-                    print("   - Name:", profile.get("name", "N/A"))
-                    print("   - Status:", profile.get("status", "N/A"))
-                    print("   - Last seen:", profile.get("last_seen", "N/A"))
-                    print("   - Avatar path:", profile.get("avatar", "Not set"))
-                # ✅ Show last seen info
-                if os.path.exists("last_seen.json"):
-                    with open("last_seen.json", "r", encoding="utf-8") as f:
-                        seen_data = json.load(f)
-                    last_seen = seen_data.get(sender)
-                    if last_seen:
-                        print("   - Last seen:", last_seen)
+async def start_webrtc_chat(username, private_key, public_key, console_source=None):
+    from aiortc import RTCPeerConnection, RTCSessionDescription
 
-                if expiry and expiry != "None":
-                    try:
-                        seconds = int(expiry)
-                        print(f"⏳ This message will self-destruct in {seconds} seconds...")
-                        await asyncio.sleep(seconds)
-                        print("💥 Message destroyed.")
-                    except:
-                        pass
-                else:
-                    log_received(username, sender, decrypted, private_key, public_key)
-                    print("📩 Message saved.")
+    # Setup
+    pc = RTCPeerConnection()
+    channel = pc.createDataChannel("siphrix")
+    dispatcher.channel = channel
+    import user_send
+    user_send.channel = channel
+    from user_send import start_scheduled_jobs
+    from ecdh_encryption import encrypt_message, sign_message
+    start_scheduled_jobs(channel, username, private_key, encrypt_message, sign_message)
 
-                    if should_backup():
-                        create_auto_backup()
+    print(f"📡 [{username}] Peer connection created.")
+    vault_manager.open_vault(private_key, public_key)
 
-                    if message.startswith("@read::"):
-                        reader = message.split("::")[1]
-                        print(f"👀 Message read by {reader} (✅✅✨)")
-                        return
+    bind = make_bind(username, private_key, public_key)
 
-            # 📨 Handle read/delivered receipts
-            from user_send import handle_incoming_receipt
-            if message.startswith("@read::") or message.startswith("@delivered::"):
-                handle_incoming_receipt(message)
-                return
+    def opened(name, channel):
+        send_hello(channel, username)
+        auto_share_dht(channel, username)
+        presence.attach(channel, username)
 
-            else:
-                print(f"📨 Raw message received: {message}")
+    def closed(channel):
+        presence.detach(channel)
+        dht.drop_channel(channel)
+        onion.drop_channel(channel)
+        forget_channel(channel)
 
-        except Exception as e:
-            print("❌ Failed to decrypt or process:", e)
+    bind(channel, dispatcher)
+    connection_pool.configure(bind, opened, closed, signal=file_signal)
+    connection_pool.set_primary(channel)
+
+    # When message is received
+    @channel.on("message")
+    async def on_message(message):
+        await dispatcher.dispatch(message)
 
     offer = await pc.createOffer()
     await pc.setLocalDescription(offer)
+    local = {"sdp": pc.localDescription.sdp, "type": pc.localDescription.type}
+    await console.start(**(console_source or {}))
+
+    data = None
+    if await signaling.connect(username, private_key, public_key, rotation=load_rotation(f"{username}_keys.json")):
+        # 📡 One round trip through the local signaling server
+        from contacts import load_contacts
+        await signaling.subscribe(load_contacts())
+        while data is None:
+            target = (await ask("👤 Connect to (username, Enter to use signal files): ")).strip().lower()
+            if not target:
+                break
+            try:
+                data = await asyncio.wait_for(signaling.signal(target, local), connection_pool.CONNECT_TIMEOUT)
+            except (asyncio.TimeoutError, ConnectionError):
+                print(f"⌛ {target} did not answer.")
 
-    # 💾 Save offer to file
-    with open(SIGNAL_FILE, "w") as f:
-        json.dump({"sdp": pc.localDescription.sdp, "type": pc.localDescription.type}, f)
-    print("📤 Offer saved to", SIGNAL_FILE)
+    if data is None:
+        # 💾 Save offer to file
+        with open(SIGNAL_FILE, "w") as f:
+            json.dump(local, f)
+        print("📤 Offer saved to", SIGNAL_FILE)
 
-    # 🔁 Wait for answer
-    print("⏳ Waiting for answer... Paste into 'signal_answer.json'")
-    while not os.path.exists("signal_answer.json"):
-        await asyncio.sleep(1)
+        # 🔁 Wait for answer
+        print("⏳ Waiting for answer... Paste into 'signal_answer.json'")
+        while not os.path.exists("signal_answer.json"):
+            await asyncio.sleep(1)
+        with open("signal_answer.json", "r") as f:
+            data = json.load(f)
 
-    with open("signal_answer.json", "r") as f:
-        data = json.load(f)
-        answer = RTCSessionDescription(sdp=data["sdp"], type=data["type"])
-        await pc.setRemoteDescription(answer)
+    await pc.setRemoteDescription(RTCSessionDescription(sdp=data["sdp"], type=data["type"]))
 
     print("✅ Connection established!")
+    send_hello(channel, username)
     auto_share_dht(channel, username)
 
-    # 🟢 Send pings to known contacts
-    from contacts import load_contacts
-    contacts = load_contacts()
-    ping_contacts(channel, contacts, username)
-    # ✅ Start presence monitor AFTER connection is set
-    monitor_task = asyncio.create_task(monitor_presence())
+    # 🟢 One ping reaches everyone behind the channel; the heartbeat job keeps it going
+    presence.attach(channel, username)
 
-    # 🔁 Send message loop
+    # 🔁 Send message loop (input arrives through the console queue, so frames keep flowing while typing)
     while True:
-        text = input("💬 Type message: ").strip()
+        try:
+            text = (await ask("💬 Type message: ")).strip()
+        except EOFError:
+            print("👋 Input closed.")
+            break
 
         if text == "/blurcam":
-            filepath = input("📷 Path to image (jpg/png): ").strip()
-            recipient = input("👤 Send to: ").strip().lower()
+            filepath = (await ask("📷 Path to image (jpg/png): ")).strip()
+            recipient = (await ask("👤 Send to: ")).strip().lower()
 
             if not os.path.exists(filepath):
                 print("❌ File not found.")
                 continue
 
-            blurred_path = blur_faces(filepath)
-            if not blurred_path:
-                print("❌ Failed to blur image.")
+            # Detection and blurring run on a worker process; the chat keeps going meanwhile
+            try:
+                data, faces = await noise_cam.blur_async(filepath)
+            except Exception as e:
+                print("❌ Failed to blur image:", e)
                 continue
-
-            with open(blurred_path, "rb") as f:
-                data = f.read()
+            print(f"🙈 Blurred {faces} face(s)")
+            filename = "blurred_" + os.path.basename(filepath)
 
             if recipient not in public_keys:
                 print(f"🔍 Requesting key from {recipient}...")
-                channel.send(f"@request_key::{recipient}")
+                send_frame(channel, f"@request_key::{recipient}")
                 for _ in range(10):
                     await asyncio.sleep(0.5)
                     if recipient in public_keys:
@@ -551,15 +476,17 @@ async def start_webrtc_chat(username, private_key, public_key):
                 print("❌ Still no key.")
                 continue
 
-            from hashlib import sha256
-            file_hash = sha256(data).hexdigest()
-            from ecdh_encryption import encrypt_message
+            link = connection_pool.channel_for(recipient)
+            if peer_version(link) >= 2:
+                file_transfer.offer_bytes(link, username, private_key, recipient, public_keys[recipient], data, filename)
+                print(f"📤 Streaming blurred image to {recipient}...")
+                continue
 
+            file_hash = sha256(data).hexdigest()
             encrypted = encrypt_message(private_key, public_keys[recipient], data.decode(errors="ignore"))
-            filename = os.path.basename(blurred_path)
             payload = f"@file::{username}::{filename}::{file_hash}::None::{encrypted}"
 
-            channel.send(payload)
+            connection_pool.send(recipient, payload)
             print(f"📤 Blurred image sent to {recipient}")
             continue
 
@@ -569,21 +496,21 @@ async def start_webrtc_chat(username, private_key, public_key):
                 print("❌ Usage: /schedule [username] [YYYY-MM-DD HH:MM]")
                 continue
             recipient = parts[1]
-            send_time = input("🕒 When to send? (YYYY-MM-DD HH:MM): ").strip()
-            msg = input("💬 Message: ").strip()
+            send_time = (await ask("🕒 When to send? (YYYY-MM-DD HH:MM): ")).strip()
+            msg = (await ask("💬 Message: ")).strip()
             from user_send import schedule_message
             schedule_message(recipient, msg, send_time)
             continue
 
         if text.startswith("/pin "):
             msg = text.replace("/pin ", "").strip()
-            recipient = input("👤 Pin this for which contact? ").strip().lower()
+            recipient = (await ask("👤 Pin this for which contact? ")).strip().lower()
             set_pinned_for(recipient, msg)
             print("📌 Message pinned!")
             continue
 
         if text == "/unpin":
-            recipient = input("👤 Unpin message for which contact? ").strip().lower()
+            recipient = (await ask("👤 Unpin message for which contact? ")).strip().lower()
             pins = get_pinned_for(recipient)
 
             if not pins:
@@ -591,7 +518,7 @@ async def start_webrtc_chat(username, private_key, public_key):
                 continue
             for i, msg in enumerate(pins):
                 print(f"{i + 1}. {msg}")
-            idx = input("Which one to unpin? (number): ").strip()
+            idx = (await ask("Which one to unpin? (number): ")).strip()
             if idx.isdigit():
                 removed = unpin_message(recipient, int(idx) - 1)
                 if removed:
@@ -601,18 +528,18 @@ async def start_webrtc_chat(username, private_key, public_key):
             continue
 
         # 🧠 Check if command
-        from user_send import handle_command, extract_hashtags, save_tag, save_mention
-        if handle_command(text):
+        from user_send import handle_command, log_message_to_history
+        if await handle_command(text):
             continue
 
         if text == "/panic":
             from user_send import panic_wipe  # ✅ moved inside
-            panic_wipe(username)
+            await panic_wipe(username)
             continue
 
         if text == "/sendfile":
-            filepath = input("📁 Path to file: ").strip()
-            recipient = input("👤 Send to: ").strip().lower()
+            filepath = (await ask("📁 Path to file: ")).strip()
+            recipient = (await ask("👤 Send to: ")).strip().lower()
 
             if not os.path.exists(filepath):
                 print("❌ File not found.")
@@ -620,7 +547,7 @@ async def start_webrtc_chat(username, private_key, public_key):
 
             if recipient not in public_keys:
                 print(f"🔍 Requesting key from {recipient}...")
-                channel.send(f"@request_key::{recipient}")
+                send_frame(channel, f"@request_key::{recipient}")
                 for _ in range(10):
                     await asyncio.sleep(0.5)
                     if recipient in public_keys:
@@ -629,29 +556,46 @@ async def start_webrtc_chat(username, private_key, public_key):
                 print("❌ Still no key.")
                 continue
 
+            link = connection_pool.channel_for(recipient)
+            if peer_version(link) >= 2:
+                file_transfer.offer_file(link, username, private_key, recipient, public_keys[recipient], filepath)
+                print(f"📤 Streaming '{os.path.basename(filepath)}' to {recipient}...")
+                continue
+
             with open(filepath, "rb") as f:
                 data = f.read()
 
-            from hashlib import sha256
-
             file_hash = sha256(data).hexdigest()
             encrypted = encrypt_message(private_key, public_keys[recipient], data.decode(errors="ignore"))
             filename = os.path.basename(filepath)
-            payload = f"@file::{username}::{filename}::{file_hash}::{encrypted}"
+            payload = f"@file::{username}::{filename}::{file_hash}::None::{encrypted}"
 
-            channel.send(payload)
+            connection_pool.send(recipient, payload)
             print(f"📤 File '{filename}' sent to {recipient}")
             continue
 
+        if text == "/protostats":
+            dispatcher.print_stats()
+            continue
+
+        if text == "/peers":
+            connection_pool.print_stats()
+            continue
+
+        if text.startswith("/connect "):
+            # Signalled through the signaling server, or signal_offer_<name>.json without one
+            connection_pool.connect(text.split(" ", 1)[1].strip().lower())
+            continue
+
         if text == "/exit":
             print("👋 Closing...")
             break
         if text.startswith("/group"):
-            sub = input("Group command (new/show/send): ").strip()
+            sub = (await ask("Group command (new/show/send): ")).strip()
 
             if sub == "new":
-                group_name = input("Group name: ").strip()
-                members = input("Usernames (comma-separated): ").strip().split(",")
+                group_name = (await ask("Group name: ")).strip()
+                members = (await ask("Usernames (comma-separated): ")).strip().split(",")
                 members = [m.strip() for m in members if m.strip()]
                 groups = load_groups()
                 groups[group_name] = members
@@ -667,43 +611,27 @@ async def start_webrtc_chat(username, private_key, public_key):
 
             if sub == "send":
                 groups = load_groups()
-                gname = input("Group name: ").strip()
+                gname = (await ask("Group name: ")).strip()
                 if gname not in groups:
                     print("❌ Group not found.")
                     continue
-                message = input("💬 Group message: ").strip()
-
-                for member in groups[gname]:
-                    if member == username:
-                        continue
-
-                    from hashlib import sha256
-                    from ecdh_encryption import sign_message
-
-                    msg_hash = sha256(message.encode()).hexdigest()
-                    encrypted = encrypt_message(private_key, public_keys.get(member, ""), message)
-                    expiry = "None"
-                    signature = sign_message(private_key, message)
-                    payload = f"@msg::{username}::{msg_hash}::{expiry}::{encrypted}::{signature}"
-
-                    if member not in public_keys:
-                        print(f"📥 {member} is offline. Queuing group message.")
-                        from user_send import queue_offline_message
-                        queue_offline_message(member, payload)
-                    else:
-                        channel.send(payload)
-                        print(f"📤 Sent to {member}")
+                message = (await ask("💬 Group message: ")).strip()
 
+                # One encryption + signature for the whole group (sender key per membership epoch)
+                group_session.send_group_message(channel, username, private_key, public_keys, gname, groups[gname] + [username], message)
+                offline = [m for m in groups[gname] if m != username and m not in public_keys]
+                print(f"📤 Sent to group '{gname}'" + (f" ({len(offline)} queued for offline members)" if offline else ""))
                 continue
 
-        recipient = input("👤 Who do you want to send to? ").strip().lower()
-        # 🟢 Optional: ping before send
-        channel.send(f"@ping::{username}")
+        recipient = (await ask("👤 Who do you want to send to? ")).strip().lower()
+        # 🟢 Ping first unless they answered recently
+        if presence.status(recipient) != presence.ONLINE:
+            presence.ping(channel)
 
         # 🔑 Check for recipient key
         if recipient not in public_keys:
             print(f"🔍 Requesting public key from {recipient}...")
-            channel.send(f"@request_key::{recipient}")
+            send_frame(channel, f"@request_key::{recipient}")
 
             # 🔁 Wait briefly for key to arrive
             for _ in range(10):
@@ -716,7 +644,7 @@ async def start_webrtc_chat(username, private_key, public_key):
         from user_send import update_message_status
         update_message_status(recipient, msg_hash, "sent")
         encrypted = encrypt_message(private_key, public_keys.get(recipient, ""), text)
-        expiry = input("💣 Self-destruct after how many seconds? (or press Enter to keep forever): ").strip()
+        expiry = (await ask("💣 Self-destruct after how many seconds? (or press Enter to keep forever): ")).strip()
         expiry = expiry if expiry else "None"
         from ecdh_encryption import sign_message
         signature = sign_message(private_key, text)
@@ -728,17 +656,24 @@ async def start_webrtc_chat(username, private_key, public_key):
             queue_offline_message(recipient, payload)
             continue
 
-        # 🔖 Save hashtags
-        for tag in extract_hashtags(text):
-            save_tag(tag, text)
-
-        # 📣 Save mentions
-        for word in text.split():
-            if word.startswith("@") and len(word) > 1:
-                mentioned = word[1:]
-                save_mention(mentioned, text)
+        # 🔖 Log + index (hashtags and mentions are indexed with the text); self-destructing ones are not kept
+        if expiry == "None":
+            log_message_to_history(recipient, text)
 
-        channel.send(payload)
+        connection_pool.send(recipient, payload)
         print(f"📤 Sent encrypted message to {recipient} (expires in {expiry} seconds)")
 
+    await console.stop()
+    scheduler.stop()
+    crypto_pool.shutdown()
+    presence.detach(channel)
+    noise_cam.shutdown()
+    presence.flush()
+    usage_store.close()
+    dht.drop_channel(channel)
+    onion.drop_channel(channel)
+    dht.save()
+    await signaling.close()
+    await metrics.stop()
+    await connection_pool.close_all()
     await pc.close()
@@ -0,0 +1,165 @@
+# presence.py – In-memory presence and last-seen table
+#
+# Every pong or message from a contact calls seen(); that is a dict update with
+# a monotonic timestamp. A contact moves online -> away -> offline as
+# ONLINE_TTL / AWAY_TTL pass without hearing from them (sweep()), and state
+# changes are printed once instead of on every pong. Last-seen times are kept
+# in memory and written to state_store in one transaction every FLUSH_INTERVAL
+# seconds (and at shutdown), so disk writes no longer scale with traffic.
+#
+# heartbeat() pings each attached channel adaptively: often while a contact
+# there is about to go stale, backing off to MAX_PING_INTERVAL when everyone
+# is offline. One ping per channel reaches every contact behind it.
+
+import time
+from datetime import datetime
+
+import metrics
+import scheduler
+import state_store
+from wire_format import send_frame
+
+ONLINE = "🟢 online"
+AWAY = "🟡 away"
+OFFLINE = "⚫ offline"
+
+ONLINE_TTL = 90  # seconds without a pong before a contact is "away"
+AWAY_TTL = 300  # ... and "offline"
+MIN_PING_INTERVAL = 30
+MAX_PING_INTERVAL = 300
+FLUSH_INTERVAL = 60
+HEARTBEAT_EVERY = 15  # scheduler tick; each channel decides whether it is due
+
+_peers = {}  # username -> [state, last heard (monotonic), last seen (wall clock string)]
+_channels = {}  # channel -> [username, interval, next ping (monotonic)]
+_dirty = set()
+_loaded = False
+
+
+def _load():
+    global _loaded
+    if _loaded:
+        return
+    _loaded = True
+    for name, last_seen in state_store.items("last_seen").items():
+        _peers.setdefault(name, [OFFLINE, None, last_seen])
+
+
+def seen(name):
+    """Record traffic from `name`. Returns True if they just came online."""
+    _load()
+    entry = _peers.get(name)
+    if entry is None:
+        entry = _peers[name] = [OFFLINE, None, None]
+    came_online = entry[0] != ONLINE
+    entry[0] = ONLINE
+    entry[1] = time.monotonic()
+    entry[2] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    _dirty.add(name)
+    return came_online
+
+
+def left(name):
+    """Mark `name` offline right away (e.g. the signaling server saw them go)."""
+    entry = _peers.get(name)
+    if entry is not None:
+        entry[0] = OFFLINE
+
+
+def status(name):
+    _load()
+    entry = _peers.get(name)
+    return entry[0] if entry else OFFLINE
+
+
+def last_seen(name):
+    _load()
+    entry = _peers.get(name)
+    return entry[2] if entry else None
+
+
+def online():
+    return [name for name, entry in _peers.items() if entry[0] == ONLINE]
+
+
+def counts():
+    """{"online": n, "away": n, "offline": n} over every known contact."""
+    out = {"online": 0, "away": 0, "offline": 0}
+    for entry in _peers.values():
+        out[entry[0].split()[1]] += 1
+    return out
+
+
+def snapshot():
+    """{username: (state, last seen)} for display."""
+    _load()
+    return {name: (entry[0], entry[2]) for name, entry in _peers.items()}
+
+
+def sweep(now=None):
+    """Demote contacts whose TTL ran out. Returns [(name, new state)]."""
+    now = time.monotonic() if now is None else now
+    changed = []
+    for name, entry in _peers.items():
+        if entry[1] is None or entry[0] == OFFLINE:
+            continue
+        idle = now - entry[1]
+        state = OFFLINE if idle >= AWAY_TTL else AWAY if idle >= ONLINE_TTL else ONLINE
+        if state != entry[0]:
+            entry[0] = state
+            changed.append((name, state))
+    return changed
+
+
+def flush(job=None):
+    """Write last-seen times changed since the previous flush."""
+    if not _dirty:
+        return 0
+    names = list(_dirty)
+    _dirty.clear()
+    with state_store.transaction():
+        for name in names:
+            state_store.put("last_seen", name, _peers[name][2])
+    return len(names)
+
+
+# === Heartbeat ===
+
+
+def attach(channel, username):
+    """Start heartbeating on `channel`; the first ping goes out right away."""
+    _channels[channel] = [username, MIN_PING_INTERVAL, 0]
+    ping(channel)
+
+
+def detach(channel):
+    _channels.pop(channel, None)
+
+
+def ping(channel):
+    entry = _channels.get(channel)
+    if entry is None:
+        return
+    send_frame(channel, f"@ping::{entry[0]}")
+    entry[2] = time.monotonic() + entry[1]
+
+
+def heartbeat(job=None):
+    """Sweep TTLs, then ping the channels that are due (scheduler job)."""
+    for name, state in sweep():
+        print(f"{state.split()[0]} {name} is {state.split()[1]}")
+    now = time.monotonic()
+    anyone_online = any(entry[0] == ONLINE for entry in _peers.values())
+    for channel, entry in list(_channels.items()):
+        if now >= entry[2]:
+            # Back off while nobody answers; ping at the normal rate once someone does
+            entry[1] = MIN_PING_INTERVAL if anyone_online else min(entry[1] * 2, MAX_PING_INTERVAL)
+            try:
+                ping(channel)
+            except Exception:
+                detach(channel)
+
+
+scheduler.register("presence_heartbeat", heartbeat)
+scheduler.register("presence_flush", flush)
+metrics.gauge("presence_contacts", counts, label="state")
@@ -1,5 +1,6 @@
 import os
 import json
+import state_store
 
 PROFILE_FILE = "profile.json"
 
@@ -15,18 +16,15 @@ DEFAULT_PROFILE = {
 }
 
 def load_profile():
-    if os.path.exists(PROFILE_FILE):
-        with open(PROFILE_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
-    else:
+    profile = state_store.get("profile", "self")
+    if profile is None:
         profile = setup_profile()
         save_profile(profile)
-        return profile
+    return profile
 
 def save_profile(profile):
     os.makedirs("profiles", exist_ok=True)
-    with open("profile.json", "w", encoding="utf-8") as f:
-        json.dump(profile, f, indent=2)
+    state_store.put("profile", "self", profile)
     # Also save a public version
     username = profile.get("username")
     if username:
@@ -64,9 +62,4 @@ def update_preferences(new_prefs: dict):
     profile["preferences"].update(new_prefs)
     save_profile(profile)
 def get_contact_profile(username):
-    try:
-        with open("contacts_info.json", "r", encoding="utf-8") as f:
-            data = json.load(f)
-        return data.get(username, {})
-    except:
-        return {}
+    return state_store.get("contacts_info", username, {})
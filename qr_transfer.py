@@ -1,4 +1,3 @@
-import qrcode
 import json
 from key_storage import load_or_create_keys
 
@@ -6,6 +5,7 @@ from key_storage import load_or_create_keys
 def export_keys_to_qr(username):
     priv, pub = load_or_create_keys(f"{username}_keys.json")
     data = {"private": priv, "public": pub}
+    import qrcode
     qr = qrcode.make(json.dumps(data))
     filename = f"{username}_keys_qr.png"
     qr.save(filename)
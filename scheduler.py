@@ -0,0 +1,165 @@
+# scheduler.py – Persistent job scheduler on the asyncio loop
+#
+# One min-heap of (due, seq, job id) and a single loop timer armed for the
+# earliest job replace the per-feature polling threads. Jobs are plain dicts
+# kept in the "jobs" namespace of state_store, so scheduled messages, reminders
+# and file self-destruct timers survive a restart; anything that came due while
+# the app was closed runs as soon as start() is called.
+#
+#   scheduler.register("reminder", lambda args: print(args["text"]))
+#   scheduler.schedule_in("reminder", 90, {"text": "stand up"})
+#   scheduler.schedule_in("rotate_routes", 0, every=180, job_id="rotate_routes", persist=False)
+
+import asyncio
+import heapq
+import itertools
+import time
+import uuid
+
+import app_log
+import metrics
+import state_store
+
+log = app_log.get("scheduler")
+
+JOBS_NS = "jobs"
+MAX_SLEEP = 60  # re-check at least this often so wall-clock changes are noticed
+
+_handlers = {}
+_jobs = {}  # job id -> {"kind", "due", "args", "every", "persist"}
+_heap = []  # (due, seq, job id); entries whose due no longer matches are stale
+_seq = itertools.count()
+_loop = None
+_timer = None
+
+
+def register(kind, handler):
+    """`handler(args)` runs on the loop when a `kind` job is due; it may be a coroutine."""
+    _handlers[kind] = handler
+
+
+def schedule(kind, due, args=None, every=None, job_id=None, persist=True):
+    """Run a `kind` job at epoch time `due` (then every `every` seconds). Returns its id."""
+    job_id = job_id or uuid.uuid4().hex[:12]
+    job = {"kind": kind, "due": due, "args": args or {}, "every": every, "persist": persist}
+    _jobs[job_id] = job
+    if persist:
+        state_store.put(JOBS_NS, job_id, job)
+    heapq.heappush(_heap, (due, next(_seq), job_id))
+    _arm()
+    return job_id
+
+
+def schedule_in(kind, seconds, args=None, **options):
+    return schedule(kind, time.time() + seconds, args, **options)
+
+
+def cancel(job_id):
+    job = _jobs.pop(job_id, None)
+    if job is None:
+        return False
+    if job["persist"]:
+        state_store.delete(JOBS_NS, job_id)
+    _arm()
+    return True
+
+
+def pending(kind=None):
+    """{job id: job} for jobs still waiting, optionally of one kind."""
+    return {job_id: dict(job) for job_id, job in _jobs.items() if kind is None or job["kind"] == kind}
+
+
+def start():
+    """Load persisted jobs and start firing them on the running loop."""
+    global _loop
+    _loop = asyncio.get_running_loop()
+    for job_id, job in state_store.items(JOBS_NS).items():
+        if job_id not in _jobs:
+            _jobs[job_id] = job
+            heapq.heappush(_heap, (job["due"], next(_seq), job_id))
+    _arm()
+
+
+def stop():
+    global _loop, _timer
+    if _timer is not None:
+        _timer.cancel()
+    _loop = _timer = None
+
+
+def _is_current(entry):
+    job = _jobs.get(entry[2])
+    return job is not None and job["due"] == entry[0]
+
+
+def _arm():
+    global _timer
+    if _loop is None:
+        return  # jobs scheduled before start() wait for it
+    if _timer is not None:
+        _timer.cancel()
+        _timer = None
+    while _heap and not _is_current(_heap[0]):
+        heapq.heappop(_heap)
+    if _heap:
+        delay = min(max(_heap[0][0] - time.time(), 0), MAX_SLEEP)
+        _timer = _loop.call_later(delay, _fire)
+
+
+def _fire():
+    global _timer
+    _timer = None
+    now = time.time()
+    while _heap and _heap[0][0] <= now:
+        entry = heapq.heappop(_heap)
+        if not _is_current(entry):
+            continue
+        job_id = entry[2]
+        job = _jobs[job_id]
+        if job["kind"] not in _handlers:
+            # Leave it persisted for a later run that knows this kind
+            log.warning("No handler for scheduled job '%s'", job["kind"])
+            del _jobs[job_id]
+            continue
+
+        if job["every"]:
+            # Missed runs collapse into one; the next run is a full interval away
+            job["due"] += job["every"]
+            if job["due"] <= now:
+                job["due"] = now + job["every"]
+            heapq.heappush(_heap, (job["due"], next(_seq), job_id))
+            if job["persist"]:
+                state_store.put(JOBS_NS, job_id, job)
+        else:
+            del _jobs[job_id]
+            if job["persist"]:
+                state_store.delete(JOBS_NS, job_id)
+        # How late the loop got to it: long handlers or a blocked loop show up here
+        metrics.observe("scheduler_lag_seconds", now - entry[0], kind=job["kind"])
+        _run(job)
+    _arm()
+
+
+def _run(job):
+    metrics.inc("scheduler_runs_total", kind=job["kind"])
+    try:
+        result = _handlers[job["kind"]](job["args"])
+        if asyncio.iscoroutine(result):
+            _loop.create_task(_await(job["kind"], result))
+    except Exception as e:
+        _failed(job["kind"], e)
+
+
+async def _await(kind, coro):
+    try:
+        await coro
+    except Exception as e:
+        _failed(kind, e)
+
+
+def _failed(kind, error):
+    metrics.inc("scheduler_failures_total", kind=kind)
+    log.warning("Scheduled %s failed: %s", kind, error, extra={"kind": kind})
+
+
+metrics.gauge("scheduler_jobs", lambda: len(_jobs))
@@ -0,0 +1,312 @@
+# search_index.py – Encrypted inverted index behind /search, /findtag and /findmention
+#
+# Postings map a term to {record_ref: term frequency}. Hashtags and mentions are
+# indexed as "#tag" and "@name" terms next to the plain words, so one index
+# answers all three commands. On disk the index is a snapshot plus an
+# append-only delta log, both AES-GCM encrypted with a key derived from
+# recovery.key; indexing a message appends one small encrypted entry. The index
+# is only a cache of the message store: if it will not decrypt (an index from
+# before the recovery key was used, a damaged file), it is rebuilt.
+
+import json
+import math
+import os
+import re
+import struct
+from bisect import bisect_left
+
+from cryptography.exceptions import InvalidTag
+
+import metrics
+from constants import MESSAGE_STORE_DIR
+from crypto_provider import cipher
+from key_storage import derive_local_key
+
+SNAPSHOT_FILE = os.path.join(MESSAGE_STORE_DIR, "search.snap")
+DELTA_FILE = os.path.join(MESSAGE_STORE_DIR, "search.log")
+COMPACT_AFTER = 500  # delta entries before the log is folded into the snapshot
+
+WORD_RE = re.compile(r"\w+")
+TAG_RE = re.compile(r"#(\w+)")
+MENTION_RE = re.compile(r"@(\w+)")
+QUERY_RE = re.compile(r"[#@]?\w+\*?")
+LENGTH = struct.Struct(">I")
+
+_postings = {}
+_doc_count = 0
+_sorted_terms = None  # rebuilt lazily for prefix queries
+_aead = None
+_loaded = False  # open_index() only derives the key; postings load on first query
+_decrypt = None  # record -> plaintext, for rebuilding from the message store
+_needs_rebuild = False  # there are messages but no index yet
+_delta_count = 0
+
+
+def extract_terms(text):
+    """Term frequencies for one message, including #tag and @mention terms."""
+    terms = {}
+    lowered = text.lower()
+    for word in WORD_RE.findall(lowered):
+        terms[word] = terms.get(word, 0) + 1
+    for tag in TAG_RE.findall(lowered):
+        terms["#" + tag] = terms.get("#" + tag, 0) + 1
+    for name in MENTION_RE.findall(lowered):
+        terms["@" + name] = terms.get("@" + name, 0) + 1
+    return terms
+
+
+# === Encryption at rest ===
+
+
+def _seal(obj):
+    return _aead.seal(json.dumps(obj, separators=(",", ":")).encode())
+
+
+def _open(blob):
+    return json.loads(_aead.open(blob))
+
+
+# === Loading & persistence ===
+
+
+def is_loaded():
+    return _aead is not None
+
+
+def has_index_files():
+    return os.path.exists(SNAPSHOT_FILE) or os.path.exists(DELTA_FILE)
+
+
+def open_index(decrypt=None):
+    """Set the index key without reading anything. New messages are appended to
+    the delta log right away; postings are loaded by the first query. `decrypt`
+    is used to build the index from the message store if none exists yet or the
+    existing one cannot be read."""
+    global _aead, _loaded, _decrypt, _needs_rebuild
+    _aead = cipher(derive_local_key(b"siphrix-search-index"))
+    _loaded = False
+    _decrypt = decrypt
+    _needs_rebuild = decrypt is not None and not has_index_files()
+
+
+def ensure_loaded():
+    if _loaded or _aead is None:
+        return
+    if _needs_rebuild:
+        import message_store
+        if message_store.has_messages():
+            print("🔎 Building search index...")
+            rebuild_from_store(_decrypt)
+            return
+    try:
+        _load()
+    except (InvalidTag, ValueError, KeyError):
+        _discard()
+
+
+def _discard():
+    """Drop an index that will not decrypt and rebuild it from the message store."""
+    global _postings, _doc_count, _sorted_terms, _delta_count, _loaded
+    for path in (SNAPSHOT_FILE, DELTA_FILE):
+        if os.path.exists(path):
+            os.remove(path)
+    if _decrypt is not None:
+        print("🔎 Search index could not be read; rebuilding it...")
+        rebuild_from_store(_decrypt)
+        return
+    print("⚠️ Search index could not be read; starting an empty one")
+    _postings = {}
+    _doc_count = 0
+    _sorted_terms = None
+    _delta_count = 0
+    _loaded = True
+
+
+def load_index():
+    """Decrypt the snapshot and replay the delta log. Returns the number of terms."""
+    open_index()
+    return _load()
+
+
+def _load():
+    global _postings, _doc_count, _sorted_terms, _delta_count, _loaded, _needs_rebuild
+    _postings = {}
+    _doc_count = 0
+    _sorted_terms = None
+    _delta_count = 0
+
+    if os.path.exists(SNAPSHOT_FILE):
+        with open(SNAPSHOT_FILE, "rb") as f:
+            snapshot = _open(f.read())
+        _doc_count = snapshot["docs"]
+        _postings = {
+            term: {int(ref): tf for ref, tf in refs.items()}
+            for term, refs in snapshot["postings"].items()
+        }
+
+    if os.path.exists(DELTA_FILE):
+        with open(DELTA_FILE, "rb") as f:
+            data = f.read()
+        pos = 0
+        while pos + LENGTH.size <= len(data):
+            (size,) = LENGTH.unpack_from(data, pos)
+            blob = data[pos + LENGTH.size:pos + LENGTH.size + size]
+            if len(blob) < size:
+                break  # torn tail write
+            _apply(_open(blob))
+            _delta_count += 1
+            pos += LENGTH.size + size
+    _loaded = True
+    _needs_rebuild = False
+    return len(_postings)
+
+
+def _apply(delta):
+    global _doc_count, _sorted_terms
+    if "drop" in delta:
+        prefix = delta["drop"]
+        for term in [t for t in _postings if t.startswith(prefix)]:
+            del _postings[term]
+    else:
+        ref = delta["ref"]
+        _doc_count += 1
+        for term, tf in delta["terms"].items():
+            _postings.setdefault(term, {})[ref] = tf
+    _sorted_terms = None
+
+
+def _append_delta(delta):
+    global _delta_count
+    os.makedirs(MESSAGE_STORE_DIR, exist_ok=True)
+    blob = _seal(delta)
+    with metrics.timer("disk_write_seconds", store="search"), open(DELTA_FILE, "ab") as f:
+        f.write(LENGTH.pack(len(blob)) + blob)
+    _delta_count += 1
+    if _delta_count >= COMPACT_AFTER and _loaded:
+        compact()
+
+
+def compact():
+    """Fold the delta log into a fresh snapshot."""
+    global _delta_count
+    os.makedirs(MESSAGE_STORE_DIR, exist_ok=True)
+    tmp = SNAPSHOT_FILE + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(_seal({"docs": _doc_count, "postings": _postings}))
+    os.replace(tmp, SNAPSHOT_FILE)
+    if os.path.exists(DELTA_FILE):
+        os.remove(DELTA_FILE)
+    _delta_count = 0
+
+
+# === Updating ===
+
+
+def index_message(ref, text):
+    """Add one logged message (by message_store record ref) to the index."""
+    if not is_loaded():
+        return
+    delta = {"ref": ref, "terms": extract_terms(text)}
+    if _loaded:
+        _apply(delta)
+    if not _needs_rebuild:
+        _append_delta(delta)  # otherwise the first query's rebuild picks it up
+
+
+def drop_terms(prefix):
+    """Forget every term starting with `prefix` ("#" clears tags, "@" clears mentions)."""
+    if not is_loaded():
+        return 0
+    ensure_loaded()
+    count = sum(1 for t in _postings if t.startswith(prefix))
+    delta = {"drop": prefix}
+    _apply(delta)
+    _append_delta(delta)
+    return count
+
+
+def rebuild_from_store(decrypt):
+    """Index every record in the message store. `decrypt` maps a record to plaintext."""
+    global _doc_count, _loaded, _needs_rebuild
+    import message_store
+
+    _postings.clear()
+    _doc_count = 0
+    for record in message_store.iter_messages():
+        try:
+            text = decrypt(record)
+        except Exception:
+            continue
+        _apply({"ref": record["ref"], "terms": extract_terms(text)})
+    _loaded = True
+    _needs_rebuild = False
+    compact()
+    return len(_postings)
+
+
+# === Queries ===
+
+
+def _expand(term):
+    """Postings for a term; a trailing '*' matches every term with that prefix."""
+    global _sorted_terms
+    if not term.endswith("*"):
+        return _postings.get(term, {})
+
+    prefix = term[:-1]
+    if _sorted_terms is None:
+        _sorted_terms = sorted(_postings)
+    merged = {}
+    i = bisect_left(_sorted_terms, prefix)
+    while i < len(_sorted_terms) and _sorted_terms[i].startswith(prefix):
+        for ref, tf in _postings[_sorted_terms[i]].items():
+            merged[ref] = merged.get(ref, 0) + tf
+        i += 1
+    return merged
+
+
+def search(query, limit=20):
+    """Refs of records matching every query term, best TF-IDF score first."""
+    ensure_loaded()
+    terms = QUERY_RE.findall(query.lower())
+    if not terms:
+        return []
+    lists = sorted((_expand(t) for t in terms), key=len)
+    if not lists[0]:
+        return []
+
+    candidates = set(lists[0])
+    for refs in lists[1:]:
+        candidates &= refs.keys()
+        if not candidates:
+            return []
+
+    scores = {}
+    for refs in lists:
+        idf = math.log(1 + max(_doc_count, 1) / len(refs))
+        for ref in candidates:
+            scores[ref] = scores.get(ref, 0.0) + refs[ref] * idf
+    ranked = sorted(scores.items(), key=lambda item: (item[1], item[0]), reverse=True)
+    return [ref for ref, _ in ranked[:limit]]
+
+
+def find_tag(tag):
+    """Refs tagged with #tag, newest first."""
+    ensure_loaded()
+    return sorted(_postings.get("#" + tag.lower().lstrip("#"), {}), reverse=True)
+
+
+def find_mention(name):
+    """Refs mentioning @name, newest first."""
+    ensure_loaded()
+    return sorted(_postings.get("@" + name.lower().lstrip("@"), {}), reverse=True)
+
+
+def term_counts(prefix):
+    """{term without prefix: number of messages} for all "#..." or "@..." terms."""
+    ensure_loaded()
+    return {
+        term[len(prefix):]: len(refs)
+        for term, refs in _postings.items()
+        if term.startswith(prefix)
+    }
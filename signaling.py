@@ -0,0 +1,163 @@
+# signaling.py – Client side of signaling_server.py
+#
+# Registers our username with the local signaling server and plugs into the
+# connection pool: connection_pool.send() to a peer without a connection now
+# sends the SDP offer through the server and gets the answer back in one round
+# trip, instead of writing signal_offer.json and polling for
+# signal_answer.json. Incoming offers are answered through
+# connection_pool.accept(). Presence updates from the server feed presence.py.
+#
+# aiortc gathers ICE candidates before the SDP is returned, so our own offers
+# carry them already; candidates other clients trickle in are added to the
+# matching connection.
+
+import asyncio
+import json
+
+import app_log
+import connection_pool
+import presence
+from constants import WS_HOST, WS_PORT, WS_PROTOCOL
+from ecdh_encryption import sign_message
+
+CONNECT_TIMEOUT = 2  # the server is local; give up quickly and use signal files
+
+_ws = None
+_reader = None
+_answers = {}  # username -> future for the answer to our offer
+_previous = (None, False)  # pool signaling before we took over (signal files)
+
+log = app_log.get("signaling")
+
+
+def url():
+    return f"{WS_PROTOCOL}://{WS_HOST}:{WS_PORT}"
+
+
+def connected():
+    return _ws is not None
+
+
+async def connect(username, private_key, public_key, server_url=None, rotation=None):
+    """Register with the server. Returns False (quietly) if it is not running.
+
+    `rotation` (key_storage.load_rotation) lets the server move from our previous key.
+    """
+    global _ws, _reader, _previous
+    try:
+        import websockets
+        _ws = await asyncio.wait_for(websockets.connect(server_url or url()), CONNECT_TIMEOUT)
+    except Exception:
+        return False
+    register = {"type": "register", "user": username, "key": public_key}
+    if rotation:
+        register["rotation"] = rotation
+    await _ws.send(json.dumps(register))
+    reply = json.loads(await _ws.recv())
+    if reply.get("type") == "challenge":
+        # The name is pinned to our key; prove we hold it
+        register["sig"] = sign_message(private_key, f"register:{username}:{reply['nonce']}")
+        await _ws.send(json.dumps(register))
+        reply = json.loads(await _ws.recv())
+    if reply.get("type") != "registered":
+        print(f"❌ Signaling server refused {username}: {reply.get('error')}")
+        await _ws.close()
+        _ws = None
+        return False
+    _reader = asyncio.get_running_loop().create_task(_read())
+    _previous = connection_pool.set_signal(signal, auto=True)
+    print(f"📡 Registered with signaling server as {username} ({len(reply.get('online', []))} online)")
+    return True
+
+
+async def signal(name, offer):
+    """connection_pool signal hook: send `offer` to `name` and wait for the answer."""
+    future = _answers[name] = asyncio.get_running_loop().create_future()
+    await _ws.send(json.dumps({"type": "offer", "to": name, "sdp": offer}))
+    try:
+        return await future
+    finally:
+        if _answers.get(name) is future:
+            del _answers[name]
+
+
+async def subscribe(users):
+    if _ws is not None and users:
+        await _ws.send(json.dumps({"type": "subscribe", "users": list(users)}))
+
+
+async def relay(name, data):
+    """Hand `data` to the server for `name`; it is stored while they are offline."""
+    await _ws.send(json.dumps({"type": "relay", "to": name, "data": data}))
+
+
+async def _on_offer(message):
+    sender = message["from"]
+    try:
+        answer = await connection_pool.accept(sender, message["sdp"])
+    except Exception as e:
+        log.warning("Could not answer %s's offer: %s", sender, e, extra={"peer": sender})
+        return
+    await _ws.send(json.dumps({"type": "answer", "to": sender, "sdp": answer}))
+
+
+async def _on_candidate(message):
+    from aiortc.sdp import candidate_from_sdp
+
+    sender = message.get("from")
+    peer = connection_pool.get(sender)
+    if peer is None or peer.pc is None:
+        return
+    try:
+        data = message["candidate"]
+        candidate = candidate_from_sdp(data["candidate"].removeprefix("candidate:"))
+        candidate.sdpMid = data.get("sdpMid")
+        candidate.sdpMLineIndex = data.get("sdpMLineIndex")
+        await peer.pc.addIceCandidate(candidate)
+    except Exception as e:
+        log.warning("Ignored a bad ICE candidate from %s: %s", sender, e, extra={"peer": sender})
+
+
+def _handle(message):
+    kind = message.get("type")
+    if kind == "offer":
+        asyncio.get_running_loop().create_task(_on_offer(message))
+    elif kind == "answer":
+        future = _answers.get(message["from"])
+        if future is not None and not future.done():
+            future.set_result(message["sdp"])
+    elif kind == "candidate":
+        asyncio.get_running_loop().create_task(_on_candidate(message))
+    elif kind == "presence":
+        if message["status"] == "online":
+            presence.seen(message["user"])
+        else:
+            presence.left(message["user"])
+    elif kind == "error":
+        log.warning("Signaling server: %s", message.get("error"))
+
+
+async def _read():
+    global _ws
+    try:
+        async for raw in _ws:
+            # One malformed message from some peer must not end the session
+            try:
+                _handle(json.loads(raw))
+            except Exception as e:
+                log.warning("Ignored a bad signaling message: %r", e)
+    except Exception as e:
+        log.warning("Lost the signaling server: %s", e)
+    finally:
+        _ws = None
+        for future in _answers.values():
+            if not future.done():
+                future.set_exception(ConnectionError("signaling server closed"))
+        connection_pool.set_signal(*_previous)
+
+
+async def close():
+    if _ws is not None:
+        await _ws.close()
+    if _reader is not None:
+        _reader.cancel()
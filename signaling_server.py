@@ -0,0 +1,268 @@
+# signaling_server.py – Local websocket signaling and relay service
+#
+#   python signaling_server.py [--host H] [--port P] [--cert C --key K]
+#   python signaling_server.py --load-test 500
+#
+# Clients (signaling.py) register a username and then exchange JSON messages
+# through the server, which fills in "from":
+#
+#   {"type": "register", "user": name, "key": public key PEM, "rotation": {...}}
+#   {"type": "offer" | "answer", "to": name, "sdp": {"sdp": ..., "type": ...}}
+#   {"type": "candidate", "to": name, "candidate": {...}}     trickle ICE
+#   {"type": "relay", "to": name, "data": ...}                any payload
+#   {"type": "subscribe", "users": [...]}                     presence updates
+#   "@presence_request::name"                                 (contacts.py)
+#
+# Registration and disconnects are fanned out as {"type": "presence"} to
+# everyone subscribed to that user. Messages for a user who is not connected
+# are kept (up to QUEUE_LIMIT, for their TTL) and delivered when they register.
+# Offers go stale quickly, so they are only kept for SIGNAL_TTL seconds.
+#
+# The first key a name registers with is pinned. Registering that name again
+# is answered with {"type": "challenge", "nonce": ...}; the client repeats the
+# register with "sig" over "register:<name>:<nonce>" made with the pinned key.
+# A name that is online without a pinned key cannot be taken over at all.
+# After key_storage.rotate_keys() the client sends its new key with
+# "rotation": {"previous_key", "signature"}, the pinned key's signature over
+# "key-rotation:<new key>". If that checks out, the new key answers the
+# challenge and replaces the pinned one. Only one step is covered: a client
+# that rotated twice since it last registered here is refused.
+
+import argparse
+import asyncio
+import json
+import secrets
+import time
+from collections import defaultdict, deque
+
+from constants import WS_HOST, WS_PORT
+from ecdh_encryption import verify_rotation, verify_signature
+
+QUEUE_LIMIT = 256  # stored messages per offline user
+SIGNAL_TTL = 30  # offer / answer / candidate
+RELAY_TTL = 7 * 24 * 3600
+ROUTED = ("offer", "answer", "candidate", "relay")
+
+_clients = {}  # username -> websocket
+_keys = {}  # username -> public key pinned at first registration
+_watchers = defaultdict(set)  # username -> usernames subscribed to its presence
+_stored = defaultdict(deque)  # username -> (expires, message json)
+stats = {"routed": 0, "stored": 0, "delivered_later": 0, "expired": 0}
+
+
+async def _send(ws, message):
+    try:
+        await ws.send(message if isinstance(message, str) else json.dumps(message))
+    except Exception:
+        pass  # the close handler cleans up
+
+
+def _presence(user, online):
+    return {"type": "presence", "user": user, "status": "online" if online else "offline", "time": time.time()}
+
+
+async def _fan_out(user, online):
+    message = json.dumps(_presence(user, online))
+    await asyncio.gather(*(_send(_clients[w], message) for w in _watchers.get(user, ()) if w in _clients))
+
+
+def _store(user, message):
+    queue = _stored[user]
+    ttl = RELAY_TTL if message["type"] == "relay" else SIGNAL_TTL
+    queue.append((time.time() + ttl, json.dumps(message)))
+    while len(queue) > QUEUE_LIMIT:
+        queue.popleft()
+    stats["stored"] += 1
+
+
+async def _deliver_stored(user, ws):
+    queue = _stored.pop(user, None)
+    now = time.time()
+    for expires, message in queue or ():
+        if expires < now:
+            stats["expired"] += 1
+            continue
+        await _send(ws, message)
+        stats["delivered_later"] += 1
+
+
+async def _route(sender, message):
+    target = message.get("to")
+    if not target:
+        return {"type": "error", "error": "missing 'to'"}
+    message["from"] = sender
+    ws = _clients.get(target)
+    if ws is None:
+        _store(target, message)
+        return {"type": "queued", "to": target, "for": message["type"]}
+    stats["routed"] += 1
+    await _send(ws, message)
+    return None
+
+
+def _claim(message, nonce):
+    """(reply, key): reply is None if the register may go ahead, key is the one to pin."""
+    user = str(message["user"])
+    pinned = _keys.get(user)
+    key = str(message["key"]) if message.get("key") else pinned
+    if pinned is None:
+        if user in _clients:
+            return {"type": "error", "error": f"{user} is already registered"}, None
+        return None, key
+    if key != pinned and not verify_rotation(pinned, key, message.get("rotation")):
+        return {"type": "error", "error": f"{user} is registered with another key"}, None
+    sig = message.get("sig")
+    if sig is None:
+        return {"type": "challenge", "nonce": nonce}, None
+    if not verify_signature(key, f"register:{user}:{nonce}", sig):
+        return {"type": "error", "error": f"could not prove ownership of {user}"}, None
+    return None, key
+
+
+async def handle(ws, path=None):
+    user = None
+    nonce = secrets.token_hex(16)
+    try:
+        async for raw in ws:
+            if isinstance(raw, str) and raw.startswith("@presence_request::"):
+                name = raw.split("::", 1)[1]
+                await _send(ws, _presence(name, name in _clients))
+                continue
+            try:
+                message = json.loads(raw)
+                kind = message["type"]
+            except (ValueError, TypeError, KeyError):
+                await _send(ws, {"type": "error", "error": "bad message"})
+                continue
+
+            if kind == "register":
+                if user is not None:
+                    continue
+                refused, key = _claim(message, nonce)
+                if refused:
+                    await _send(ws, refused)
+                    continue
+                user = str(message["user"])
+                if key:
+                    _keys[user] = key
+                old = _clients.get(user)
+                _clients[user] = ws
+                if old is not None and old is not ws:
+                    await old.close()
+                await _send(ws, {"type": "registered", "user": user, "online": sorted(_clients)})
+                await _deliver_stored(user, ws)
+                await _fan_out(user, True)
+            elif user is None:
+                await _send(ws, {"type": "error", "error": "register first"})
+            elif kind in ROUTED:
+                reply = await _route(user, message)
+                if reply:
+                    await _send(ws, reply)
+            elif kind == "subscribe":
+                names = [str(n) for n in message.get("users", [])]
+                for name in names:
+                    _watchers[name].add(user)
+                await asyncio.gather(*(_send(ws, _presence(n, n in _clients)) for n in names))
+            elif kind == "ping":
+                await _send(ws, {"type": "pong"})
+    finally:
+        if user is not None and _clients.get(user) is ws:
+            del _clients[user]
+            await _fan_out(user, False)
+
+
+async def serve(host=WS_HOST, port=WS_PORT, ssl=None):
+    """Start the server; returns the websockets server object."""
+    import websockets
+    return await websockets.serve(handle, host, port, ssl=ssl, max_size=2 ** 20)
+
+
+# === Load test ===
+
+
+async def load_test(clients, host="127.0.0.1", port=0):
+    """Register `clients` simulated users and time one offer/answer round trip each."""
+    import websockets
+
+    server = await serve(host, port)
+    port = next(iter(server.sockets)).getsockname()[1]
+    url = f"ws://{host}:{port}"
+
+    sockets = []
+    for i in range(clients):
+        ws = await websockets.connect(url)
+        await ws.send(json.dumps({"type": "register", "user": f"sim{i}"}))
+        await ws.recv()  # registered
+        sockets.append(ws)
+
+    async def answerer(i, ws):
+        # Answer the one offer this client will get
+        while True:
+            message = json.loads(await ws.recv())
+            if message["type"] == "offer":
+                await ws.send(json.dumps({"type": "answer", "to": message["from"], "sdp": message["sdp"]}))
+                return
+
+    # Offers come from a second set of clients, so each socket has a single reader
+    offer_sockets = []
+    for i in range(clients):
+        ws = await websockets.connect(url)
+        await ws.send(json.dumps({"type": "register", "user": f"off{i}"}))
+        await ws.recv()
+        offer_sockets.append(ws)
+
+    async def one(i):
+        ws = offer_sockets[i]
+        start = time.perf_counter()
+        await ws.send(json.dumps({"type": "offer", "to": f"sim{i}", "sdp": {"type": "offer", "sdp": "x" * 1500}}))
+        while json.loads(await ws.recv())["type"] != "answer":
+            pass
+        return time.perf_counter() - start
+
+    started = time.perf_counter()
+    answering = [asyncio.ensure_future(answerer(i, ws)) for i, ws in enumerate(sockets)]
+    times = sorted(await asyncio.gather(*(one(i) for i in range(clients))))
+    elapsed = time.perf_counter() - started
+    await asyncio.gather(*answering)
+
+    for ws in sockets + offer_sockets:
+        await ws.close()
+    server.close()
+    await server.wait_closed()
+    return {
+        "clients": clients,
+        "seconds": elapsed,
+        "handshakes_per_s": clients / elapsed,
+        "p50_ms": times[len(times) // 2] * 1000,
+        "p99_ms": times[min(len(times) - 1, int(len(times) * 0.99))] * 1000,
+    }
+
+
+async def _main(args):
+    if args.load_test:
+        result = await load_test(args.load_test)
+        print(f"📈 {result['clients']} offer/answer round trips in {result['seconds']:.2f}s "
+              f"({result['handshakes_per_s']:.0f}/s), p50 {result['p50_ms']:.2f} ms, p99 {result['p99_ms']:.2f} ms")
+        return
+
+    ssl_context = None
+    if args.cert:
+        import ssl
+        ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        ssl_context.load_cert_chain(args.cert, args.key)
+    server = await serve(args.host, args.port, ssl_context)
+    print(f"📡 Signaling server listening on {'wss' if ssl_context else 'ws'}://{args.host}:{args.port}")
+    await server.wait_closed()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Siphrix signaling server")
+    parser.add_argument("--host", default=WS_HOST)
+    parser.add_argument("--port", type=int, default=WS_PORT)
+    parser.add_argument("--cert")
+    parser.add_argument("--key")
+    parser.add_argument("--load-test", type=int, metavar="CLIENTS")
+    try:
+        asyncio.run(_main(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,306 @@
+# state_store.py – Transactional key-value store for local app state
+#
+# Replaces the per-feature JSON files (unread_count.json, last_seen.json,
+# pinned.json, ...) with one SQLite database in WAL mode. Each feature gets a
+# namespace; a write touches only the keys that changed instead of rewriting a
+# whole file. Namespaces are cached in memory after first use, and legacy JSON
+# files are imported automatically when the database is first opened.
+#
+#   import state_store
+#   state_store.put("last_seen", "bob", "2025-06-01 12:00:00")
+#   with state_store.transaction():
+#       state_store.put("unread_count", "bob", 0)
+#       state_store.delete("offline_queue", "bob")
+#
+# Per-message state (sent ids, delivery status, edit history) has one row per
+# message under "<contact>|<message id>", so recording a message writes one
+# small value, not the contact's whole history.
+
+import copy
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+import metrics
+from constants import STATE_DB
+
+# Namespace -> legacy JSON file imported on first use
+LEGACY_FILES = {
+    "unread_count": "unread_count.json",
+    "last_seen": "last_seen.json",
+    "message_status": "message_status.json",
+    "offline_queue": "offline_queue.json",
+    "edit_history": "edit_history.json",
+    "sent_ids": "sent_ids.json",
+    "reactions": "reactions.json",
+    "pinned": "pinned.json",
+    "custom_emojis": "custom_emojis.json",
+    "stickers": "stickers.json",
+    "contacts": "contacts.json",
+    "contacts_info": "contacts_info.json",
+    "profile": "profile.json",
+}
+
+# Namespaces keyed by message_key(contact, message id)
+PER_MESSAGE = ("sent_ids", "message_status", "edit_history")
+KEY_SEP = "|"
+
+_conn = None
+_lock = threading.RLock()
+_cache = {}
+_tx_depth = 0
+_tx_undo = []
+
+
+def _db():
+    global _conn
+    if _conn is None:
+        _conn = sqlite3.connect(STATE_DB, isolation_level=None, check_same_thread=False)
+        _conn.execute("PRAGMA journal_mode=WAL")
+        _conn.execute("PRAGMA synchronous=NORMAL")
+        _conn.execute(
+            "CREATE TABLE IF NOT EXISTS kv ("
+            " ns TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL,"
+            " PRIMARY KEY (ns, key))"
+        )
+        for ns in LEGACY_FILES:
+            _import_legacy(ns)
+        for ns in PER_MESSAGE:
+            _split_per_message(ns)
+    return _conn
+
+
+def _import_legacy(ns):
+    path = LEGACY_FILES[ns]
+    if not os.path.exists(path):
+        return
+    if _conn.execute("SELECT 1 FROM kv WHERE ns = ? LIMIT 1", (ns,)).fetchone():
+        return
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return
+
+    if ns == "profile":
+        data = {"self": data}
+    elif isinstance(data, list):
+        # contacts.json is a plain list of usernames
+        data = {item: True for item in data}
+
+    _conn.execute("BEGIN")
+    _conn.executemany(
+        "INSERT OR REPLACE INTO kv (ns, key, value) VALUES (?, ?, ?)",
+        [(ns, key, json.dumps(value)) for key, value in data.items()],
+    )
+    _conn.execute("COMMIT")
+    os.replace(path, path + ".migrated")
+    print(f"📦 Migrated {path} into {STATE_DB}")
+
+
+def _split_per_message(ns):
+    """Turn old {contact: {message id: value}} rows into one row per message."""
+    rows = _conn.execute("SELECT key, value FROM kv WHERE ns = ? AND instr(key, ?) = 0", (ns, KEY_SEP)).fetchall()
+    if not rows:
+        return
+    _conn.execute("BEGIN")
+    for contact, value in rows:
+        messages = json.loads(value)
+        if isinstance(messages, dict):
+            _conn.executemany(
+                "INSERT OR REPLACE INTO kv (ns, key, value) VALUES (?, ?, ?)",
+                [(ns, message_key(contact, msg_id), json.dumps(v)) for msg_id, v in messages.items()],
+            )
+        _conn.execute("DELETE FROM kv WHERE ns = ? AND key = ?", (ns, contact))
+    _conn.execute("COMMIT")
+
+
+def message_key(contact, msg_id):
+    return f"{contact}{KEY_SEP}{msg_id}"
+
+
+def _namespace(ns):
+    data = _cache.get(ns)
+    if data is None:
+        rows = _db().execute("SELECT key, value FROM kv WHERE ns = ? ORDER BY rowid", (ns,)).fetchall()
+        data = {key: json.loads(value) for key, value in rows}
+        _cache[ns] = data
+    return data
+
+
+def _remember(ns, key):
+    if _tx_depth:
+        data = _cache[ns]
+        _tx_undo.append((ns, key, key in data, data.get(key)))
+
+
+# === Reads (served from the in-memory cache) ===
+
+
+def get(ns, key, default=None):
+    with _lock:
+        data = _namespace(ns)
+        if key not in data:
+            return default
+        return copy.deepcopy(data[key])
+
+
+def items(ns):
+    with _lock:
+        return copy.deepcopy(_namespace(ns))
+
+
+def keys(ns):
+    with _lock:
+        return list(_namespace(ns))
+
+
+def scan(ns, prefix):
+    """{key: value} for the keys of `ns` starting with `prefix`."""
+    with _lock:
+        return {k: copy.deepcopy(v) for k, v in _namespace(ns).items() if k.startswith(prefix)}
+
+
+def by_contact(ns, contact=None):
+    """{contact: {message id: value}} for a PER_MESSAGE namespace (one contact's with `contact`)."""
+    out = {}
+    for key, value in scan(ns, "" if contact is None else message_key(contact, "")).items():
+        contact, _, msg_id = key.partition(KEY_SEP)
+        out.setdefault(contact, {})[msg_id] = value
+    return out
+
+
+# === Writes ===
+
+
+def _write(sql, params=()):
+    """Run a write; outside a transaction it commits, so it is timed as a disk write."""
+    if _tx_depth:
+        return _db().execute(sql, params)
+    start = time.perf_counter()
+    try:
+        return _db().execute(sql, params)
+    finally:
+        metrics.observe("disk_write_seconds", time.perf_counter() - start, store="state")
+
+
+def put(ns, key, value):
+    with _lock:
+        data = _namespace(ns)
+        _remember(ns, key)
+        _write(
+            "INSERT INTO kv (ns, key, value) VALUES (?, ?, ?)"
+            " ON CONFLICT (ns, key) DO UPDATE SET value = excluded.value",
+            (ns, key, json.dumps(value)),
+        )
+        data[key] = copy.deepcopy(value)
+
+
+def delete(ns, key):
+    with _lock:
+        data = _namespace(ns)
+        if key not in data:
+            return False
+        _remember(ns, key)
+        _write("DELETE FROM kv WHERE ns = ? AND key = ?", (ns, key))
+        del data[key]
+        return True
+
+
+def clear(ns):
+    with transaction():
+        for key in keys(ns):
+            delete(ns, key)
+
+
+def replace(ns, mapping):
+    """Make `ns` hold exactly `mapping`, writing only keys that changed."""
+    with transaction():
+        current = _namespace(ns)
+        for key in [k for k in current if k not in mapping]:
+            delete(ns, key)
+        for key, value in mapping.items():
+            if current.get(key) != value or key not in current:
+                put(ns, key, value)
+
+
+def increment(ns, key, amount=1):
+    with transaction():
+        value = get(ns, key, 0) + amount
+        put(ns, key, value)
+        return value
+
+
+@contextmanager
+def transaction():
+    """Group writes atomically; nested use joins the outer transaction."""
+    global _tx_depth
+    with _lock:
+        conn = _db()
+        if _tx_depth == 0:
+            conn.execute("BEGIN")
+        _tx_depth += 1
+        try:
+            yield
+        except BaseException:
+            _tx_depth -= 1
+            if _tx_depth == 0:
+                conn.execute("ROLLBACK")
+                # Put the cache back the way it was before the transaction
+                for ns, key, existed, old in reversed(_tx_undo):
+                    if existed:
+                        _cache[ns][key] = old
+                    else:
+                        _cache[ns].pop(key, None)
+                _tx_undo.clear()
+            raise
+        else:
+            _tx_depth -= 1
+            if _tx_depth == 0:
+                _write("COMMIT")
+                _tx_undo.clear()
+
+
+# === Maintenance ===
+
+
+def checkpoint():
+    """Flush the WAL into the main database file (before copying it)."""
+    with _lock:
+        _db().execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+
+def backup_to(path):
+    """Write a consistent copy of the database to `path` while it stays in use.
+
+    The copy is read through its own connection. In WAL mode that is a
+    snapshot of the last commit, so gets and puts go on while it runs.
+    """
+    with _lock:
+        _db()  # creates the file on first use
+    source = sqlite3.connect(STATE_DB)
+    dest = sqlite3.connect(path)
+    try:
+        source.backup(dest)
+    finally:
+        dest.close()
+        source.close()
+
+
+def close():
+    global _conn
+    with _lock:
+        if _conn is not None:
+            _conn.close()
+            _conn = None
+        _cache.clear()
+
+
+def wipe():
+    close()
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(STATE_DB + suffix):
+            os.remove(STATE_DB + suffix)
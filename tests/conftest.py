@@ -0,0 +1,21 @@
+# conftest.py – Run every test from an empty working directory
+#
+# The app keeps all of its files relative to the current directory, so each
+# test gets its own tmp_path as cwd and the shared SQLite connection is closed
+# afterwards.
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(autouse=True)
+def workdir(tmp_path, monkeypatch):
+    import state_store
+
+    monkeypatch.chdir(tmp_path)
+    yield tmp_path
+    state_store.close()
@@ -0,0 +1,95 @@
+# test_auto_backup.py – Restore, dedup and prune of the chunked backups
+
+import os
+
+import auto_backup
+import state_store
+from constants import MESSAGE_STORE_DIR
+from key_storage import RECOVERY_KEY_FILE
+
+
+def _write(path, data):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def _read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def _chunks():
+    return {name for _, _, names in os.walk(auto_backup.CHUNK_DIR) for name in names}
+
+
+def _sample_files():
+    files = {
+        "alice_keys.json": b'{"private_key": "x", "public_key": "y"}',
+        os.path.join(MESSAGE_STORE_DIR, "seg_000001.log"): os.urandom(3 * auto_backup.CHUNK_SIZE + 100),
+        os.path.join(MESSAGE_STORE_DIR, "all.idx"): b"\0" * 40,
+    }
+    for path, data in files.items():
+        _write(path, data)
+    state_store.put("contacts", "bob", {"nick": "Bob"})
+    return files
+
+
+def test_restore_round_trip(tmp_path):
+    files = _sample_files()
+    name = auto_backup.create_auto_backup("alice")
+
+    target = tmp_path / "restored"
+    assert auto_backup.restore_snapshot(name, str(target)) == len(files) + 1
+    for path, data in files.items():
+        assert _read(target / path) == data
+    state_store.close()
+    os.replace(target / "siphrix_state.db", "siphrix_state.db")
+    assert state_store.get("contacts", "bob") == {"nick": "Bob"}
+
+
+def test_unchanged_files_are_not_stored_again():
+    _sample_files()
+    auto_backup.create_auto_backup("alice")
+    chunks = _chunks()
+
+    second = auto_backup.create_auto_backup("alice")
+    # Only the database copy is re-chunked, and its content did not change either
+    assert _chunks() == chunks
+    first, latest = (auto_backup.load_snapshot(n)["files"] for n in auto_backup.list_snapshots())
+    assert first == latest
+    assert second == auto_backup.list_snapshots()[-1]
+
+
+def test_prune_keeps_chunks_of_live_snapshots(tmp_path):
+    segment = os.path.join(MESSAGE_STORE_DIR, "seg_000001.log")
+    contents = []
+    for _ in range(auto_backup.KEEP_SNAPSHOTS + 3):
+        contents.append(os.urandom(auto_backup.CHUNK_SIZE + 10))
+        _write(segment, contents[-1])
+        auto_backup.create_auto_backup("alice")
+
+    snapshots = auto_backup.list_snapshots()
+    assert len(snapshots) == auto_backup.KEEP_SNAPSHOTS
+    live = {digest for name in snapshots
+            for entry in auto_backup.load_snapshot(name)["files"].values()
+            for digest in entry["chunks"]}
+    assert _chunks() == live  # nothing unreferenced left, nothing referenced missing
+
+    # The oldest snapshot that survived still restores byte for byte
+    oldest = len(contents) - auto_backup.KEEP_SNAPSHOTS
+    auto_backup.restore_snapshot(snapshots[0], str(tmp_path / "old"))
+    assert _read(tmp_path / "old" / segment) == contents[oldest]
+
+
+def test_restore_needs_the_original_recovery_key(tmp_path):
+    _sample_files()
+    auto_backup.create_auto_backup("alice")
+
+    os.remove(RECOVERY_KEY_FILE)
+    assert auto_backup.restore_snapshot(target_dir=str(tmp_path / "a")) == 0
+    assert not os.path.exists(RECOVERY_KEY_FILE)
+
+    _write(RECOVERY_KEY_FILE, b"A" * 43 + b"=")  # a different key
+    assert auto_backup.restore_snapshot(target_dir=str(tmp_path / "b")) == 0
+    assert not os.path.exists(tmp_path / "b")
@@ -1,26 +1,207 @@
+# usage_dashboard.py – /stats (metrics registry) and /dashboard (usage history)
+#
+# /stats is this session's numbers from metrics.py. /dashboard reads the
+# usage_store rings for any range ("24h", "7d", "1y", "2025-06-01..2025-06-30"),
+# so drawing a year costs the same as drawing a day. It draws a matplotlib
+# chart when there is a display and sparklines in the terminal otherwise.
+
 import os
-import json
-import matplotlib.pyplot as plt
+import sys
+import time
+from datetime import datetime
+
+import console
+import metrics
+import usage_store
+
+DEFAULT_RANGE = "24h"
+
+FILE_TYPES = ("file", "xfer_start")
+
+
+def _ms(seconds):
+    return "-" if seconds is None else f"{seconds * 1000:.2f} ms"
+
+
+def _size(n):
+    for unit in ("B", "KB", "MB", "GB"):
+        if n < 1024 or unit == "GB":
+            return f"{n:.0f} {unit}" if unit == "B" else f"{n:.1f} {unit}"
+        n /= 1024
+
+
+def summary():
+    """The numbers /stats prints, straight from the registry."""
+    frames_in = metrics.by_label("frames_in_total", "type")
+    frames_out = metrics.by_label("frames_out_total", "type")
+    gauges = metrics.gauges()
+
+    def gauge_sum(name):
+        return sum(v for (n, _), v in gauges.items() if n == name)
+
+    return {
+        "uptime": metrics.uptime(),
+        "messages": {"in": frames_in.get("msg", 0), "out": frames_out.get("msg", 0)},
+        "group_messages": {"in": frames_in.get("gmsg", 0), "out": frames_out.get("gmsg", 0)},
+        "files": {"in": sum(frames_in.get(t, 0) for t in FILE_TYPES), "out": sum(frames_out.get(t, 0) for t in FILE_TYPES)},
+        "frames": {"in": sum(frames_in.values()), "out": sum(frames_out.values())},
+        "bytes": {"in": metrics.total("bytes_in_total"), "out": metrics.total("bytes_out_total")},
+        "frames_in": frames_in,
+        "frames_out": frames_out,
+        "crypto": {
+            op: (metrics.histogram("crypto_seconds", op=op)[0], metrics.quantile("crypto_seconds", 0.99, op=op))
+            for op in ("encrypt", "decrypt", "sign", "verify")
+        },
+        "disk": {
+            store: (metrics.histogram("disk_write_seconds", store=store)[0], metrics.quantile("disk_write_seconds", 0.99, store=store))
+            for store in ("state", "messages", "search")
+        },
+        "queues": {
+            "outbox": gauge_sum("outbox_pending"),
+            "send queues": gauge_sum("send_queue_depth"),
+            "verify batch": gauge_sum("verify_batch_pending"),
+            "scheduled jobs": gauge_sum("scheduler_jobs"),
+        },
+        "presence": {dict(labels)["state"]: v for (n, labels), v in gauges.items() if n == "presence_contacts"},
+        "scheduler_lag": (metrics.quantile("scheduler_lag_seconds", 0.5), metrics.quantile("scheduler_lag_seconds", 0.99)),
+        "errors": metrics.total("frame_errors_total") + metrics.total("scheduler_failures_total"),
+    }
+
+
+def print_stats():
+    s = summary()
+    minutes = int(s["uptime"] // 60)
+    print(f"\n📊 Session stats (up {minutes // 60}h {minutes % 60:02d}m):")
+    print(f"   - Messages:     {s['messages']['in']} in, {s['messages']['out']} out "
+          f"(+ {s['group_messages']['in']} / {s['group_messages']['out']} group)")
+    print(f"   - Files:        {s['files']['in']} in, {s['files']['out']} out")
+    print(f"   - Traffic:      {_size(s['bytes']['in'])} in, {_size(s['bytes']['out'])} out "
+          f"({s['frames']['in']} / {s['frames']['out']} frames)")
+    print("   - Crypto:       " + (", ".join(f"{op} {n} (p99 {_ms(p99)})" for op, (n, p99) in s["crypto"].items() if n) or "-"))
+    print("   - Disk writes:  " + (", ".join(f"{store} {n} (p99 {_ms(p99)})" for store, (n, p99) in s["disk"].items() if n) or "-"))
+    print("   - Queues:       " + ", ".join(f"{name} {n}" for name, n in s["queues"].items()))
+    if s["presence"]:
+        print("   - Presence:     " + ", ".join(f"{n} {state}" for state, n in s["presence"].items()))
+    p50, p99 = s["scheduler_lag"]
+    print(f"   - Timer lag:    p50 {_ms(p50)}, p99 {_ms(p99)}")
+    if s["errors"]:
+        print(f"   - Errors:       {s['errors']} (see the log)")
+
+
+# === /dashboard: usage history from usage_store ===
+
+RANGE_UNITS = {"m": 60, "h": 3600, "d": 86400, "w": 7 * 86400, "y": 365 * 86400}
+SPARK = " ▁▂▃▄▅▆▇█"
+
 
+def parse_range(text, now=None):
+    """(start, end, label) for "24h", "7d", "1y", "2025-06-01" or "2025-06-01..2025-06-30"."""
+    now = time.time() if now is None else now
+    text = (text or DEFAULT_RANGE).strip().lower()
+    if text[:-1].isdigit() and text[-1] in RANGE_UNITS:
+        return now - int(text[:-1]) * RANGE_UNITS[text[-1]], now, f"last {text}"
+    first, _, last = text.partition("..")
+    start = datetime.strptime(first, "%Y-%m-%d")
+    end = datetime.strptime(last, "%Y-%m-%d") if last else start
+    return start.timestamp(), min(end.timestamp() + 86400 - 1, now), text
 
-def show_usage_dashboard():
-    if not os.path.exists("usage_stats.json"):
-        print("📭 No usage stats available.")
+
+def _downsample(values, width):
+    """Sum neighbouring buckets so `values` fits in `width` columns."""
+    if len(values) <= width:
+        return values
+    step = -(-len(values) // width)
+    return [sum(values[i:i + step]) for i in range(0, len(values), step)]
+
+
+def _sparkline(values, width):
+    values = _downsample(values, width)
+    peak = max(values, default=0)
+    if not peak:
+        return SPARK[0] * len(values)
+    return "".join(SPARK[0] if not v else SPARK[max(1, round(v / peak * (len(SPARK) - 1)))] for v in values)
+
+
+def _resolution(width):
+    return {60: "per minute", 3600: "hourly", 86400: "daily"}[width]
+
+
+def render_text(start, end, label):
+    """Sparklines and top contacts / types for terminals without a display."""
+    import shutil
+
+    width, points = usage_store.series(start, end)
+    ring = usage_store.ring_for(start, end)
+    _, incoming = usage_store.series(start, end, direction=usage_store.IN, ring=ring)
+    columns = max(10, min(72, shutil.get_terminal_size().columns - 24))
+    totals = usage_store.totals(start, end, ring=ring)
+    total = totals.get("total")
+    print(f"\n📊 Usage, {label} ({_resolution(width)}):")
+    if not total:
+        print("📭 No usage recorded in this range.")
         return
+    for column, title in (("messages", "Messages"), ("files", "Files"), ("bytes", "Traffic")):
+        values = [p[column] for _, p in points]
+        received = sum(p[column] for _, p in incoming)
+        fmt = _size if column == "bytes" else str
+        print(f"   {title:<9}{_sparkline(values, columns)}  {fmt(received)} in, {fmt(sum(values) - received)} out")
+    print(f"   {'':<9}{datetime.fromtimestamp(start):%Y-%m-%d %H:%M} → {datetime.fromtimestamp(end):%Y-%m-%d %H:%M}")
+
+    for prefix, title, column in (("contact:", "Top contacts", "messages"), ("type:", "Frame types", "frames")):
+        ranked = sorted(
+            ((key.split(":", 1)[1], v["in"][column] + v["out"][column], v["in"]["bytes"] + v["out"]["bytes"])
+             for key, v in totals.items() if key.startswith(prefix)),
+            key=lambda item: (-item[1], -item[2]),
+        )[:8]
+        if ranked:
+            print(f"   {title}: " + ", ".join(f"{name} {count} ({_size(size)})" for name, count, size in ranked))
 
-    with open("usage_stats.json", "r", encoding="utf-8") as f:
-        stats = json.load(f)
-
-    labels = ["Messages Sent", "Files Sent", "Data Sent (KB)"]
-    values = [
-        stats.get("messages_sent", 0),
-        stats.get("files_sent", 0),
-        stats.get("data_sent_kb", 0)
-    ]
-
-    plt.figure(figsize=(8, 4))
-    plt.bar(labels, values)
-    plt.title("📊 Usage Dashboard")
-    plt.ylabel("Count")
-    plt.tight_layout()
+
+def render_chart(start, end, label):
+    import matplotlib.pyplot as plt  # slow to import; only needed when the chart is shown
+
+    ring = usage_store.ring_for(start, end)
+    _, received = usage_store.series(start, end, direction=usage_store.IN, ring=ring)
+    _, sent = usage_store.series(start, end, direction=usage_store.OUT, ring=ring)
+    times = [datetime.fromtimestamp(t) for t, _ in sent]
+    totals = usage_store.totals(start, end, prefix="contact:", ring=ring)
+
+    fig, axes = plt.subplots(2, 2, figsize=(12, 6))
+    for ax, column, title in ((axes[0][0], "messages", "Messages"), (axes[0][1], "files", "Files"), (axes[1][0], "bytes", "Traffic (KB)")):
+        scale = 1024 if column == "bytes" else 1
+        ax.plot(times, [p[column] / scale for _, p in received], label="in")
+        ax.plot(times, [p[column] / scale for _, p in sent], label="out")
+        ax.set_title(title)
+        ax.legend()
+    fig.autofmt_xdate()
+    top = sorted(totals.items(), key=lambda item: -(item[1]["in"]["messages"] + item[1]["out"]["messages"]))[:10]
+    axes[1][1].barh([key.split(":", 1)[1] for key, _ in top],
+                    [v["in"]["messages"] + v["out"]["messages"] for _, v in top])
+    axes[1][1].set_title("Messages per contact")
+    fig.suptitle(f"📊 Usage Dashboard – {label} ({_resolution(ring.width)})")
+    fig.tight_layout()
     plt.show()
+
+
+def _has_display():
+    if sys.platform in ("win32", "darwin"):
+        return True
+    return bool(os.environ.get("DISPLAY") or os.environ.get("WAYLAND_DISPLAY"))
+
+
+def show_usage_dashboard(range_text=None, renderer=None):
+    """/dashboard [range] [text|chart]; headless sessions get the text view."""
+    try:
+        start, end, label = parse_range(range_text)
+    except ValueError:
+        print("❌ Usage: /dashboard [24h|7d|30d|1y|YYYY-MM-DD[..YYYY-MM-DD]] [text|chart]")
+        return
+    usage_store.flush()
+    if renderer is None:
+        renderer = "chart" if console.interactive and _has_display() else "text"
+    if renderer == "chart":
+        try:
+            return render_chart(start, end, label)
+        except ImportError:
+            print("⚠️ matplotlib is not installed; showing the text view")
+    render_text(start, end, label)
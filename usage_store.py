@@ -0,0 +1,340 @@
+# usage_store.py – Time-series usage counters in fixed-size ring files
+#
+# Every frame sent or received is counted into an in-memory bucket for the
+# current minute by (frame type, contact, direction). flush() (scheduler job,
+# and at shutdown) rolls those up into frames, messages, files and bytes for
+# the total, each frame type and each contact, and adds them to three ring
+# files under USAGE_DIR:
+#
+#   minute.ring   one slot per minute, 2 days
+#   hour.ring     one slot per hour, 60 days
+#   day.ring      one slot per (UTC) day, 4 years
+#
+# A slot lives at offset (bucket % slots) and records which bucket it holds,
+# so old data is overwritten in place and a file never grows. Queries use the
+# finest ring that covers the range in a few hundred slots and read only those:
+# a one-year chart is ~365 slot reads whatever the traffic was.
+#
+# Slot: bucket (u32), entry count (u16), then up to `entries` records of
+#   key id (u16) | direction (u8) | frames (u32) | messages (u32) | files (u32) | bytes (u64)
+# Key ids index keys.json: "total", "type:msg", "contact:bob", ...
+# Contacts are only counted once they proved their name on the channel, and
+# at most MAX_CONTACT_KEYS of them get their own key; later ones, and anything
+# past the u16 id space, are counted under "type:(other)" / "contact:(other)".
+
+import json
+import os
+import struct
+import time
+
+import scheduler
+from constants import USAGE_DIR
+
+IN, OUT = 0, 1
+MESSAGE_TYPES = {"msg", "gmsg"}
+FILE_TYPES = {"file", "xfer_start"}
+# Frame types whose first field is the sender's username (text and binary)
+SENDER_TYPES = {"msg", "file", "gmsg", "xfer_start", "xfer_chunk", "xfer_end", "delivered", "read", "reaction"}
+
+FLUSH_INTERVAL = 60
+MAGIC = b"SXU1"
+FILE_HEADER = struct.Struct(">4sIII")  # magic, width, slots, entries per slot
+SLOT_HEADER = struct.Struct(">IH")
+ENTRY = struct.Struct(">HBIIIQ")
+COLUMNS = ("frames", "messages", "files", "bytes")
+
+KEYS_FILE = os.path.join(USAGE_DIR, "keys.json")
+RESERVED_KEYS = 3
+MAX_KEYS = 1 << 16  # key ids are u16
+MAX_CONTACT_KEYS = 4096
+
+
+class Ring:
+    def __init__(self, name, width, slots, entries):
+        self.path = os.path.join(USAGE_DIR, name + ".ring")
+        self.width = width
+        self.slots = slots
+        self.entries = entries
+        self.slot_size = SLOT_HEADER.size + entries * ENTRY.size
+        self._file = None
+
+    def retention(self):
+        return self.width * self.slots
+
+    def _open(self):
+        if self._file is not None:
+            return self._file
+        header = FILE_HEADER.pack(MAGIC, self.width, self.slots, self.entries)
+        if os.path.exists(self.path):
+            f = open(self.path, "r+b")
+            if f.read(FILE_HEADER.size) == header:
+                self._file = f
+                return f
+            f.close()  # written with other settings; start over
+        os.makedirs(USAGE_DIR, exist_ok=True)
+        f = open(self.path, "w+b")
+        f.write(header)
+        f.truncate(FILE_HEADER.size + self.slots * self.slot_size)  # sparse until written
+        self._file = f
+        return f
+
+    def _offset(self, bucket):
+        return FILE_HEADER.size + (bucket % self.slots) * self.slot_size
+
+    def _decode(self, raw, bucket):
+        if len(raw) < SLOT_HEADER.size:
+            return {}
+        stored, count = SLOT_HEADER.unpack_from(raw)
+        if stored != bucket or not count:
+            return {}
+        out = {}
+        for i in range(min(count, self.entries)):
+            key_id, direction, *values = ENTRY.unpack_from(raw, SLOT_HEADER.size + i * ENTRY.size)
+            out[(key_id, direction)] = values
+        return out
+
+    def read(self, first, last):
+        """{bucket: {(key id, direction): [frames, messages, files, bytes]}} for first..last."""
+        first = max(first, last - self.slots + 1)
+        f = self._open()
+        out = {}
+        bucket = first
+        while bucket <= last:
+            # Contiguous slots up to the end of the file in one read
+            run = min(last - bucket + 1, self.slots - bucket % self.slots)
+            f.seek(self._offset(bucket))
+            raw = f.read(run * self.slot_size)
+            for i in range(run):
+                slot = self._decode(raw[i * self.slot_size:(i + 1) * self.slot_size], bucket + i)
+                if slot:
+                    out[bucket + i] = slot
+            bucket += run
+        return out
+
+    def add(self, bucket, delta):
+        f = self._open()
+        f.seek(self._offset(bucket))
+        raw = f.read(self.slot_size)
+        if len(raw) >= SLOT_HEADER.size and SLOT_HEADER.unpack_from(raw)[0] > bucket:
+            return  # older than this ring keeps
+        slot = self._decode(raw, bucket)
+        for key, values in delta.items():
+            if key not in slot and key[0] >= RESERVED_KEYS and len(slot) >= self.entries - 2 * RESERVED_KEYS:
+                # Full: later contacts / types this bucket are counted as "(other)"
+                key = (_key_id(_overflow_key(key[0])), key[1])
+            current = slot.setdefault(key, [0, 0, 0, 0])
+            for i, value in enumerate(values):
+                current[i] += value
+        raw = SLOT_HEADER.pack(bucket, len(slot)) + b"".join(
+            ENTRY.pack(key_id, direction, *values) for (key_id, direction), values in slot.items()
+        )
+        f.seek(self._offset(bucket))
+        f.write(raw)
+
+    def sync(self):
+        if self._file is not None:
+            self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+RINGS = (
+    Ring("minute", 60, 2 * 24 * 60, 32),
+    Ring("hour", 3600, 60 * 24, 64),
+    Ring("day", 86400, 4 * 366, 128),
+)
+
+_keys = None  # list of key names; the index is the id stored in the rings
+_key_ids = {}
+_contact_keys = 0
+_keys_unsaved = False
+_pending = {}  # minute bucket -> {(frame type, contact, direction): [frames, bytes]}
+
+
+def _load_keys():
+    global _keys, _contact_keys
+    if _keys is not None:
+        return
+    _keys = ["total", "type:(other)", "contact:(other)"]  # RESERVED_KEYS, always fit in a slot
+    if os.path.exists(KEYS_FILE):
+        with open(KEYS_FILE, "r", encoding="utf-8") as f:
+            _keys = json.load(f)[:MAX_KEYS]  # ids past u16 never made it into a ring
+    _key_ids.update({name: i for i, name in enumerate(_keys)})
+    _contact_keys = sum(name.startswith("contact:") for name in _keys)
+
+
+def _key_id(name):
+    global _contact_keys, _keys_unsaved
+    key_id = _key_ids.get(name)
+    if key_id is None:
+        _load_keys()
+        key_id = _key_ids.get(name)
+        if key_id is None:
+            contact = name.startswith("contact:")
+            if len(_keys) >= MAX_KEYS or contact and _contact_keys >= MAX_CONTACT_KEYS:
+                return _key_ids["contact:(other)" if contact else "type:(other)"]
+            key_id = _key_ids[name] = len(_keys)
+            _keys.append(name)
+            _contact_keys += contact
+            _keys_unsaved = True
+    return key_id
+
+
+def _overflow_key(key_id):
+    prefix = _keys[key_id].split(":", 1)[0]
+    return f"{prefix}:(other)"
+
+
+def _save_keys():
+    global _keys_unsaved
+    os.makedirs(USAGE_DIR, exist_ok=True)
+    tmp = KEYS_FILE + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(_keys, f)
+    os.replace(tmp, KEYS_FILE)
+    _keys_unsaved = False
+
+
+# === Recording ===
+
+
+def record(direction, msg_type, size, contact=None, now=None):
+    """Count one frame. One dict update; totals are rolled up at flush time."""
+    minute = int((time.time() if now is None else now) // 60)
+    bucket = _pending.get(minute)
+    if bucket is None:
+        bucket = _pending[minute] = {}
+    key = (msg_type, contact, direction)
+    values = bucket.get(key)
+    if values is None:
+        bucket[key] = [1, size]
+    else:
+        values[0] += 1
+        values[1] += size
+
+
+def _expand(raw):
+    """{(type, contact, direction): [frames, bytes]} -> {(key name, direction): [frames, messages, files, bytes]}."""
+    out = {}
+    for (msg_type, contact, direction), (frames, size) in raw.items():
+        row = [frames, frames if msg_type in MESSAGE_TYPES else 0, frames if msg_type in FILE_TYPES else 0, size]
+        names = ("total", "type:" + msg_type, "contact:" + contact) if contact else ("total", "type:" + msg_type)
+        for name in names:
+            current = out.setdefault((name, direction), [0, 0, 0, 0])
+            for i, value in enumerate(row):
+                current[i] += value
+    return out
+
+
+def sender_of(msg_type, fields):
+    """The contact a received frame came from, if its type says so."""
+    if msg_type in SENDER_TYPES and isinstance(fields, list) and fields:
+        return str(fields[0])
+    return None
+
+
+def _merge(into, delta):
+    for key, values in delta.items():
+        current = into.setdefault(key, [0, 0, 0, 0])
+        for i, value in enumerate(values):
+            current[i] += value
+
+
+def flush(job=None):
+    """Add the pending minutes to every ring. Returns how many minutes were written.
+
+    The minutes stay pending until the write went through, so a failed flush is retried.
+    """
+    if not _pending:
+        return 0
+    pending = dict(_pending)
+    _load_keys()
+    by_ring = [{} for _ in RINGS]
+    for minute, raw in pending.items():
+        delta = {}
+        for (name, direction), values in _expand(raw).items():
+            _merge(delta, {(_key_id(name), direction): values})  # capped names share an id
+        for ring, buckets in zip(RINGS, by_ring):
+            _merge(buckets.setdefault(minute * 60 // ring.width, {}), delta)
+    if _keys_unsaved:
+        _save_keys()  # before the rings refer to the new ids
+    for ring, buckets in zip(RINGS, by_ring):
+        for bucket, delta in buckets.items():
+            ring.add(bucket, delta)
+        ring.sync()
+    for minute in pending:
+        del _pending[minute]
+    return len(pending)
+
+
+def close():
+    flush()
+    for ring in RINGS:
+        ring.close()
+
+
+# === Queries ===
+
+
+def ring_for(start, end, max_points=720):
+    """The finest ring that still covers `start` and needs at most `max_points` slots."""
+    now = time.time()
+    for ring in RINGS:
+        if start >= now - ring.retention() and (end - start) / ring.width <= max_points:
+            return ring
+    return RINGS[-1]
+
+
+def _read(ring, start, end):
+    """{bucket: {(key name, direction): values}} including what is not flushed yet."""
+    _load_keys()
+    first, last = int(start // ring.width), int(end // ring.width)
+    out = {}
+    for bucket, slot in ring.read(first, last).items():
+        out[bucket] = {(_keys[key_id], direction): values for (key_id, direction), values in slot.items() if key_id < len(_keys)}
+    for minute, raw in _pending.items():
+        bucket = minute * 60 // ring.width
+        if first <= bucket <= last:
+            _merge(out.setdefault(bucket, {}), _expand(raw))
+    return out
+
+
+def _value(slot, key, direction):
+    if direction is None:
+        a, b = slot.get((key, IN)), slot.get((key, OUT))
+        if a is None or b is None:
+            return a or b
+        return [x + y for x, y in zip(a, b)]
+    return slot.get((key, direction))
+
+
+def series(start, end, key="total", direction=None, ring=None):
+    """(bucket width, [(bucket start, {column: value})]) for one key, zero-filled."""
+    ring = ring or ring_for(start, end)
+    data = _read(ring, start, end)
+    points = []
+    for bucket in range(int(start // ring.width), int(end // ring.width) + 1):
+        values = _value(data.get(bucket, {}), key, direction) or [0, 0, 0, 0]
+        points.append((bucket * ring.width, dict(zip(COLUMNS, values))))
+    return ring.width, points
+
+
+def totals(start, end, prefix=None, ring=None):
+    """{key: {"in": {column: n}, "out": {column: n}}} summed over the range."""
+    ring = ring or ring_for(start, end)
+    out = {}
+    for slot in _read(ring, start, end).values():
+        for (key, direction), values in slot.items():
+            if prefix and not key.startswith(prefix):
+                continue
+            side = out.setdefault(key, {"in": dict.fromkeys(COLUMNS, 0), "out": dict.fromkeys(COLUMNS, 0)})
+            side_values = side["in" if direction == IN else "out"]
+            for column, value in zip(COLUMNS, values):
+                side_values[column] += value
+    return out
+
+
+scheduler.register("usage_flush", flush)
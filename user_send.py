@@ -1,99 +1,101 @@
+# user_send.py – Siphrix entry point: startup, slash commands and chat helpers
+#
+#   python user_send.py [--profile-startup] [--pipe PATH | --listen PORT]
+#                       [--metrics-port PORT] [--log-level LEVEL] [--log-json] [--log-file PATH]
+#
+# Importing this module does no work; main() runs the startup phases (PIN,
+# login, keys, DHT announce, history preview) and then the chat session.
+# Heavy optional libraries (OpenCV, aiortc, matplotlib, qrcode) are imported by
+# the features that use them, and the search index loads on the first query.
+# --profile-startup prints how long each phase took before the chat starts.
+# --metrics-port serves the metrics registry (see metrics.py) on 127.0.0.1.
+
+import time
+
+_IMPORT_START = time.perf_counter()
+
+import asyncio
+import hashlib
+import json
 import os
-if not os.path.exists(".vault"):
-    os.makedirs(".vault")
-channel = None  # we will assign it later
+import random
+import re
 import sys
+from contextlib import contextmanager
+from datetime import datetime
+
+import app_log
+import connection_pool
+import console
+import dht
+import file_transfer
+import message_store
+import metrics
+import onion
+import outbox
 import peer_connection
-public_keys = peer_connection.public_keys
+import presence
+import scheduler
+import search_index
+import state_store
+import usage_store
+from auto_backup import should_backup, create_auto_backup
+from console import ask
+from constants import GROUP_FILE, MESSAGE_STORE_DIR, STATE_DB, OUTBOX_DIR, USAGE_DIR
+from emoji_store import load_emojis
+from pinned import get_pinned_for
+from profile_manager import load_profile
 from sticker_store import add_sticker, get_sticker, load_stickers
-import random
-import threading
-import time
+from wire_format import peer_version
+
+channel = None  # set by peer_connection once the data channel exists
+public_keys = peer_connection.public_keys
+username = password = private_key = public_key = None
+profile = status = None
 
 ROUTE_CACHE = {}  # 🔁 Stores auto-generated routes for each user
+ROUTE_ROTATE_SECONDS = 180
 
-from dotenv import load_dotenv
-from app_lock import check_pin
+_phases = []  # (name, seconds) for --profile-startup
+metrics_port = None  # --metrics-port
+
+
+@contextmanager
+def phase(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _phases.append((name, time.perf_counter() - start))
 
-import hashlib
-# Step 1A: Announce user to DHT
+
+def print_startup_profile():
+    total = time.perf_counter() - _IMPORT_START
+    print("⏱️  Startup profile:")
+    for name, seconds in _phases:
+        print(f"   {name:<20} {seconds * 1000:8.1f} ms")
+    print(f"   {'total':<20} {total * 1000:8.1f} ms (prompts included)")
 
 
 def announce_to_dht(username, public_key, profile):
-    dht_entry = {
-        "username_hash": hashlib.sha256(username.encode()).hexdigest(),
+    from key_storage import load_rotation
+
+    dht.load(username, private_key)
+    entry = {
+        "username_hash": dht.node_id(username),
         "public_key": public_key,
         "status": profile.get("status"),
         "avatar": profile.get("profile_picture"),
         "bio": profile.get("preferences", {}).get("bio", "")
     }
-
-    if not os.path.exists("dht.json"):
-        dht_data = []
-    else:
-        with open("dht.json", "r", encoding="utf-8") as f:
-            dht_data = json.load(f)
-
-    # Add self to DHT (or replace if exists)
-    dht_data = [entry for entry in dht_data if entry["username_hash"] != dht_entry["username_hash"]]
-    dht_data.append(dht_entry)
-
-    with open("dht.json", "w", encoding="utf-8") as f:
-        json.dump(dht_data, f, indent=2)
-
+    rotation = load_rotation(f"{username}_keys.json")
+    if rotation:
+        entry["rotation"] = rotation  # lets peers holding our previous key accept this one
+    dht.publish(entry)
+    dht.save()
     print(f"📡 Announced self to DHT as {username}")
 
 
-try:
-    from playsound import playsound
-except ImportError:
-    playsound = None
-
-try:
-    from win10toast import ToastNotifier
-except ImportError:
-    ToastNotifier = None
-
-notifier = ToastNotifier() if ToastNotifier else None
-
-load_dotenv()
-if not check_pin():
-    exit()  # 🔒 Stop app if PIN is wrong
-from auth import login_local
-from peer_connection import start_webrtc_chat
-import asyncio
-import json
-
-from datetime import datetime
-from constants import USAGE_FILE, GROUP_FILE, HISTORY_FILE, PINNED_FILE
-from profile_manager import load_profile
-username, password = login_local()
-from key_storage import rotate_keys, rotate_keys_if_expired
-
-rotate = input('🔁 Rotate encryption keys before starting? (yes/no): ').strip().lower() == 'yes'
-if rotate:
-    print('🔐 Rotating keys...')
-    private_key, public_key = rotate_keys(f"{username}_keys.json")
-else:
-    from key_storage import load_or_create_keys
-    private_key, public_key = load_or_create_keys(f"{username}_keys.json")
-
-rotate_keys_if_expired()
-
-
-if not username:
-    sys.exit(1)
-print("🔍 CWD:", os.getcwd())
-print("🔍 .env exists:", os.path.exists(".env"))
-profile = load_profile()
-announce_to_dht(username, public_key, profile)
-
-
-status = profile["status"]
-
-# 9️⃣ Now load your keys and continue
-
-
 def pick_random_route(final_user, all_peers, count=2):
     relays = [p for p in all_peers if p != final_user]
     if not relays:
@@ -102,29 +104,17 @@ def pick_random_route(final_user, all_peers, count=2):
     return hops + [final_user]
 
 
-def auto_rotate_routes(peers):
-    while True:
-        for friend in peers:
-            route = pick_random_route(friend, list(peers.keys()), count=3)
-            ROUTE_CACHE[friend] = route
-            print(f"🔄 New onion route to {friend}: {' → '.join(route)}")
-
-        time.sleep(180)  # Rotate every 3 minutes
+def rotate_routes(peers):
+    # Runs as a scheduler job every ROUTE_ROTATE_SECONDS
+    for friend in peers:
+        route = pick_random_route(friend, list(peers.keys()), count=3)
+        ROUTE_CACHE[friend] = route
+        print(f"🔄 New onion route to {friend}: {' → '.join(route)}")
 
 
 def update_stats(category, amount=1):
-    stats = {"messages_sent": 0, "files_sent": 0, "data_sent_kb": 0}
-    if os.path.exists(USAGE_FILE):
-        with open(USAGE_FILE, "r") as f:
-            stats.update(json.load(f))
-    if category == "msg":
-        stats["messages_sent"] += amount
-    elif category == "file":
-        stats["files_sent"] += amount
-    elif category == "data":
-        stats["data_sent_kb"] += amount
-    with open(USAGE_FILE, "w") as f:
-        json.dump(stats, f, indent=2)
+    # Frames and bytes are counted where they are sent; this is for anything else
+    metrics.inc("usage_total", amount, category=category)
 
 
 def extract_hashtags(text):
@@ -135,189 +125,120 @@ def log_message_to_history(recipient, text):
     from ecdh_encryption import encrypt_message
 
     encrypted = encrypt_message(private_key, public_key, text)
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    ref = message_store.append_message(recipient, message_store.DIRECTION_TO, encrypted)
+    search_index.index_message(ref, text)
 
-    with open(HISTORY_FILE, "a", encoding="utf-8") as f:
-        f.write(f"[{timestamp}] To {recipient}: {encrypted}\n")
 
-
-def read_encrypted_history():
+def read_encrypted_history(contact=None, limit=50):
     from ecdh_encryption import decrypt_message
 
-    if not os.path.exists(HISTORY_FILE):
+    if contact:
+        records = message_store.read_conversation(contact, limit)
+    else:
+        records = message_store.read_recent(limit)
+    if not records:
         print("📭 No history found.")
         return
 
-    with open(HISTORY_FILE, "r", encoding="utf-8") as f:
-        for line in f:
-            try:
-                prefix, encrypted = line.split(": ", 1)
-                decrypted = decrypt_message(private_key, public_key, encrypted.strip())
-                print(f"{prefix}: {decrypted}")
-            except:
-                print("⚠️ Could not decrypt line:", line.strip())
+    for record in records:
+        try:
+            decrypted = decrypt_message(private_key, public_key, record["ciphertext"])
+            print(message_store.format_record(record, decrypted))
+        except:
+            print("⚠️ Could not decrypt record:", message_store.format_record(record))
 
 
-def search_messages(query):
+def print_indexed(refs, marker):
     from ecdh_encryption import decrypt_message
-    if not os.path.exists(HISTORY_FILE):
+
+    for record in message_store.read_refs(refs):
+        try:
+            decrypted = decrypt_message(private_key, public_key, record["ciphertext"])
+            print(f"{marker} {message_store.format_record(record, decrypted)}")
+        except:
+            print("⚠️ Could not decrypt record:", message_store.format_record(record))
+
+
+def search_messages(query):
+    # Multi-term queries match all terms; "word*" matches by prefix
+    if not message_store.has_messages():
         print("📭 No chat history found.")
         return
 
-    found = 0
-    with open(HISTORY_FILE, "r", encoding="utf-8") as f:
-        for line in f:
-            try:
-                if ": " not in line:
-                    continue
-                prefix, encrypted = line.strip().split(": ", 1)
-                decrypted = decrypt_message(private_key, public_key, encrypted)
-                if query.lower() in decrypted.lower():
-                    print(f"🔍 {prefix}: {decrypted}")
-                    found += 1
-            except:
-                continue
-
-    if found == 0:
+    refs = search_index.search(query)
+    if not refs:
         print("🔎 No matching messages found.")
+        return
+    print_indexed(refs, "🔍")
 
 
-def save_tag(tag, message):
-    data = {}
-    if os.path.exists("tags.json"):
-        with open("tags.json", "r", encoding="utf-8") as f:
-            data = json.load(f)
-    data.setdefault(tag, []).append(message)
-    with open("tags.json", "w", encoding="utf-8") as f:
-        json.dump(data, f, indent=2)
-
+def load_search_index():
+    from ecdh_encryption import decrypt_message
 
-def save_mention(username, message):
-    data = {}
-    if os.path.exists("mentions.json"):
-        with open("mentions.json", "r", encoding="utf-8") as f:
-            data = json.load(f)
-    data.setdefault(username, []).append(message)
-    with open("mentions.json", "w", encoding="utf-8") as f:
-        json.dump(data, f, indent=2)
+    # Only sets the key; the index is read (or rebuilt) on the first search
+    search_index.open_index(decrypt=lambda record: decrypt_message(private_key, public_key, record["ciphertext"]))
 
 
 def save_sent_id(recipient, msg_id, content):
-    file = "sent_ids.json"
-    data = {}
-
-    if os.path.exists(file):
-        with open(file, "r", encoding="utf-8") as f:
-            data = json.load(f)
-
-    if recipient not in data:
-        data[recipient] = {}
-
-    if msg_id not in data[recipient]:  # Only save if it's new
-        data[recipient][msg_id] = content
-        with open(file, "w", encoding="utf-8") as f:
-            json.dump(data, f, indent=2)
+    key = state_store.message_key(recipient, msg_id)
+    if state_store.get("sent_ids", key) is None:  # Only save if it's new
+        state_store.put("sent_ids", key, content)
 
 
 def list_sent_ids():
-    if not os.path.exists("sent_ids.json"):
+    data = state_store.by_contact("sent_ids")
+    if not data:
         print("📭 No sent messages stored.")
         return
-    with open("sent_ids.json", "r", encoding="utf-8") as f:
-        data = json.load(f)
     print("🆔 Sent Message IDs:")
     for user, messages in data.items():
         for mid, content in messages.items():
             print(f"   {user} → {mid}: {content}")
 
 
-def load_pinned():
-    if os.path.exists(PINNED_FILE):
-        with open(PINNED_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
-    return {}
-
 def search_dht(username):
-    if not os.path.exists("dht.json"):
-        print("📭 No DHT file found.")
-        return None
-    with open("dht.json", "r", encoding="utf-8") as f:
-        dht = json.load(f)
-    for entry in dht:
-        if entry.get("username_hash") == hashlib.sha256(username.encode()).hexdigest():
-            return entry
-    return None
+    return dht.find_value(username)
 
 
-def save_pinned(pins):
-    with open(PINNED_FILE, "w", encoding="utf-8") as f:
-        json.dump(pins, f, indent=2)
-
-
-def get_pinned_for(user):
-    pins = load_pinned()
-    return pins.get(user, [])
-
-
-def set_pinned_for(user, message):
-    pins = load_pinned()
-    if user not in pins:
-        pins[user] = []
-    pins[user].append(message)
-    save_pinned(pins)
-
-
-def unpin_message(user, index):
-    pins = load_pinned()
-    if user in pins and 0 <= index < len(pins[user]):
-        removed = pins[user].pop(index)
-        if not pins[user]:
-            del pins[user]
-        save_pinned(pins)
-        return removed
-    return None
-
-
-def export_chat():
-    if not os.path.exists(HISTORY_FILE):
+async def export_chat():
+    if not message_store.has_messages():
         print("📭 No chat history to export.")
         return
 
-    export_path = input("Enter export file name (e.g. my_chat.txt): ").strip()
+    export_path = (await ask("Enter export file name (e.g. my_chat.txt): ")).strip()
     if not export_path:
         print("❌ Invalid filename.")
         return
 
-    with open(HISTORY_FILE, "r", encoding="utf-8") as src:
-        with open(export_path, "w", encoding="utf-8") as dst:
-            dst.writelines(src.readlines())
+    with open(export_path, "w", encoding="utf-8") as dst:
+        for record in message_store.iter_messages():
+            dst.write(message_store.format_record(record) + "\n")
 
     print(f"✅ Chat history exported to {export_path}")
 
 
-def get_expiry_seconds():
+async def get_expiry_seconds():
     print("\nChoose message expiration:")
     print("1. 1 minute\n2. 5 minutes\n3. Custom\n4. Never delete")
-    choice = input("Enter choice [1-4]: ").strip()
+    choice = (await ask("Enter choice [1-4]: ")).strip()
     if choice == "1": return 60
     elif choice == "2": return 300
     elif choice == "3":
-        unit = input("Unit (seconds/minutes/hours): ").strip().lower()
-        value = int(input("Enter value: "))
+        unit = (await ask("Unit (seconds/minutes/hours): ")).strip().lower()
+        value = int(await ask("Enter value: "))
         return value * {"seconds": 1, "minutes": 60, "hours": 3600}.get(unit, 1)
     return None  # Never delete
 
 
-def handle_command(text):
+async def handle_command(text):
     text = text.strip()
 
     if text == "/showtags":
-        if os.path.exists("tags.json"):
-            with open("tags.json", "r", encoding="utf-8") as f:
-                tags = json.load(f)
-                print("📌 Tags so far:")
-                for tag, items in tags.items():
-                    print(f" - {tag} ({len(items)} messages)")
+        tags = search_index.term_counts("#")
+        if tags:
+            print("📌 Tags so far:")
+            for tag, count in sorted(tags.items()):
+                print(f" - {tag} ({count} messages)")
         else:
             print("📭 No tags found.")
         return True
@@ -333,32 +254,35 @@ def handle_command(text):
                 print(f"{symbol} {name}")
         return True
 
+    elif text == "/presence":
+        contacts = presence.snapshot()
+        if not contacts:
+            print("📭 No presence information yet.")
+        for name, (state, last_seen) in sorted(contacts.items()):
+            print(f"{state:<12} {name} (last seen {last_seen or 'never'})")
+        return True
+
     elif text == "/stats":
-        if os.path.exists(USAGE_FILE):
-            with open(USAGE_FILE, "r", encoding="utf-8") as f:
-                stats = json.load(f)
-            print("\n📊 Usage Stats:")
-            print(f"   - Messages sent: {stats.get('messages_sent', 0)}")
-            print(f"   - Files sent:    {stats.get('files_sent', 0)}")
-            print(f"   - Data sent:     {stats.get('data_sent_kb', 0)} KB")
-        else:
-            print("📭 No usage stats found.")
+        from usage_dashboard import print_stats
+        print_stats()
         return True
 
-    elif text == "/dashboard":
+    elif text == "/dashboard" or text.startswith("/dashboard "):
+        # /dashboard [range] [text|chart]
         from usage_dashboard import show_usage_dashboard
-        show_usage_dashboard()
+        args = text.split()[1:]
+        renderer = args.pop() if args and args[-1] in ("text", "chart") else None
+        show_usage_dashboard(args[0] if args else None, renderer)
         return True
 
 
 
 
     elif text == "/edithistory":
-        if not os.path.exists("edit_history.json"):
+        history = state_store.by_contact("edit_history")
+        if not history:
             print("📭 No edit history.")
             return True
-        with open("edit_history.json", "r", encoding="utf-8") as f:
-            history = json.load(f)
         print("📝 Message Edit History:")
         for user, edits in history.items():
             for msg_id, changes in edits.items():
@@ -369,16 +293,14 @@ def handle_command(text):
 
 
     elif text == "/cleartags":
-        if os.path.exists("tags.json"):
-            os.remove("tags.json")
+        if search_index.drop_terms("#"):
             print("🧹 All tags cleared.")
         else:
             print("📭 No tags to clear.")
         return True
 
     elif text == "/clearmentions":
-        if os.path.exists("mentions.json"):
-            os.remove("mentions.json")
+        if search_index.drop_terms("@"):
             print("🧹 All mentions cleared.")
         else:
             print("📭 No mentions to clear.")
@@ -386,32 +308,22 @@ def handle_command(text):
 
     elif text.startswith("/findtag "):
         tag = text.replace("/findtag ", "").strip("# ")
-        if os.path.exists("tags.json"):
-            with open("tags.json", "r", encoding="utf-8") as f:
-                tags = json.load(f)
-            if tag in tags:
-                print(f"\n🔍 Messages with #{tag}:")
-                for msg in tags[tag]:
-                    print(f" - {msg}")
-            else:
-                print(f"❌ No messages found with tag #{tag}")
+        refs = search_index.find_tag(tag)
+        if refs:
+            print(f"\n🔍 Messages with #{tag}:")
+            print_indexed(refs, " -")
         else:
-            print("📭 No tags saved.")
+            print(f"❌ No messages found with tag #{tag}")
         return True
 
     elif text.startswith("/findmention "):
         name = text.replace("/findmention ", "").strip("@ ")
-        if os.path.exists("mentions.json"):
-            with open("mentions.json", "r", encoding="utf-8") as f:
-                mentions = json.load(f)
-            if name in mentions:
-                print(f"\n📣 Messages mentioning @{name}:")
-                for msg in mentions[name]:
-                    print(f" - {msg}")
-            else:
-                print(f"❌ No mentions for @{name}")
+        refs = search_index.find_mention(name)
+        if refs:
+            print(f"\n📣 Messages mentioning @{name}:")
+            print_indexed(refs, " -")
         else:
-            print("📭 No mentions saved.")
+            print(f"❌ No mentions for @{name}")
         return True
 
 
@@ -456,48 +368,16 @@ def handle_command(text):
         show_reactions(msg_id)
         return True
 
-    elif text == "/stats":
-        if os.path.exists("usage_stats.json"):
-            with open("usage_stats.json", "r", encoding="utf-8") as f:
-                stats = json.load(f)
-            print("📊 Usage Stats:")
-            print(f" - Messages sent: {stats.get('messages_sent', 0)}")
-            print(f" - Files sent: {stats.get('files_sent', 0)}")
-            print(f" - Data sent (KB): {stats.get('data_sent_kb', 0)}")
-        else:
-            print("📭 No usage stats yet.")
-        return True
-    elif text == "/showtags":
-        if os.path.exists("tags.json"):
-            with open("tags.json", "r", encoding="utf-8") as f:
-                tags = json.load(f)
-                print("📌 Tags so far:")
-                for tag, items in tags.items():
-                    print(f" - {tag} ({len(items)} messages)")
-        else:
-            print("📭 No tags found.")
-        return True
-
-
-
-    elif text == "/cleartags":
-        if os.path.exists("tags.json"):
-            os.remove("tags.json")
-            print("🧹 All tags cleared.")
-        else:
-            print("📭 No tags to clear.")
-        return True
-
-    elif text == "/clearmentions":
-        if os.path.exists("mentions.json"):
-            os.remove("mentions.json")
-            print("🧹 All mentions cleared.")
-        else:
-            print("📭 No mentions to clear.")
+    elif text == "/exportchat":
+        await export_chat()
         return True
 
-    elif text == "/exportchat":
-        export_chat()
+    elif text.startswith("/history"):
+        # /history [contact] [count]
+        parts = text.split()
+        contact = parts[1].lower() if len(parts) > 1 and not parts[1].isdigit() else None
+        count = int(parts[-1]) if len(parts) > 1 and parts[-1].isdigit() else 50
+        read_encrypted_history(contact, count)
         return True
 
     elif text.startswith("/search "):
@@ -510,6 +390,17 @@ def handle_command(text):
         export_keys_to_qr(username)
         return True
 
+    elif text == "/selftest":
+        from ecdh_encryption import sign_message
+        import crypto_pool
+        print("🖋️ Signing test: Verifying message signing works...")
+        sig = sign_message(private_key, "Hello")
+        if await crypto_pool.verify(public_key, "Hello", sig):
+            print("✅ Signature valid.")
+        else:
+            print("❌ Signature failed.")
+        return True
+
     elif text.startswith("/importkeys "):
         from qr_transfer import import_keys_from_qr
         image_path = text.split(" ", 1)[1].strip()
@@ -528,8 +419,39 @@ def handle_command(text):
             print(f"🔓 Vault contents of '{filename}':\n{result}")
         return True
 
+    elif text == "/vault":
+        import vault_manager
+        if not vault_manager.open_vault(private_key, public_key):
+            return True
+        entries = vault_manager.list_files()
+        if not entries:
+            print("📭 Vault is empty.")
+        for entry in entries:
+            received = datetime.fromtimestamp(entry["received"]).strftime("%Y-%m-%d %H:%M")
+            print(f" - {entry['name']} ({entry['size']} bytes) from {entry['sender'] or 'me'} at {received}")
+        return True
+
+    elif text.startswith("/exportvault "):
+        import vault_manager
+        parts = text.split(" ", 2)
+        if len(parts) < 3:
+            print("❌ Usage: /exportvault filename destination")
+            return True
+        if not vault_manager.open_vault(private_key, public_key):
+            return True
+        entry = vault_manager.find(parts[1].strip())
+        if entry is None:
+            print("❌ File not found in vault.")
+            return True
+        try:
+            dest = await asyncio.get_running_loop().run_in_executor(None, vault_manager.export_file, entry, parts[2].strip())
+            print(f"📤 Exported {entry['name']} to {dest}")
+        except Exception as e:
+            print("❌ Export failed:", e)
+        return True
+
     elif text == "/showpins":
-        user = input("👤 Whose pinned messages? ").strip()
+        user = (await ask("👤 Whose pinned messages? ")).strip()
         pins = get_pinned_for(user)
         if pins:
             print(f"📌 Pinned messages for {user}:")
@@ -542,12 +464,11 @@ def handle_command(text):
 
 
     elif text == "/mentions":
-        if os.path.exists("mentions.json"):
-            with open("mentions.json", "r", encoding="utf-8") as f:
-                mentions = json.load(f)
-                print("📣 Mentions so far:")
-                for mention, items in mentions.items():
-                    print(f" - @{mention} ({len(items)} messages)")
+        mentions = search_index.term_counts("@")
+        if mentions:
+            print("📣 Mentions so far:")
+            for mention, count in sorted(mentions.items()):
+                print(f" - @{mention} ({count} messages)")
         else:
             print("📭 No mentions found.")
         return True
@@ -618,7 +539,6 @@ def handle_command(text):
 
 
     elif text.startswith("/sendemoji "):
-        global channel
         from emoji_store import load_emojis
         parts = text.split(" ", 2)
         if len(parts) < 3:
@@ -651,7 +571,7 @@ def handle_command(text):
         # Send it
         if recipient in public_keys:
             if channel:
-                channel.send(payload)
+                connection_pool.send(recipient, payload)
                 print("✅ Emoji sent!")
             else:
                 print("❌ Channel not ready yet.")
@@ -739,6 +659,12 @@ def handle_command(text):
             print("❌ Sticker not found.")
             return True
 
+        link = connection_pool.channel_for(recipient)
+        if link and recipient in peer_connection.public_keys and peer_version(link) >= 2:
+            file_transfer.offer_file(link, username, private_key, recipient, peer_connection.public_keys[recipient], path)
+            print(f"📤 Streaming sticker '{sticker_name}' to {recipient}...")
+            return True
+
         # Send it like a file
         with open(path, "rb") as f:
             data = f.read()
@@ -753,7 +679,7 @@ def handle_command(text):
 
         if recipient in peer_connection.public_keys:
             if channel:
-                channel.send(payload)
+                connection_pool.send(recipient, payload)
                 print(f"📤 Sticker '{sticker_name}' sent to {recipient}")
             else:
                 print("❌ Channel not ready yet.")
@@ -765,126 +691,62 @@ def handle_command(text):
 
 
     elif text == "/share_dht":
-        if os.path.exists("dht.json"):
-            with open("dht.json", "r", encoding="utf-8") as f:
-                dht_data = json.load(f)
-            payload = json.dumps({
-                "type": "dht_share",
-                "from": username,
-                "data": dht_data
-            })
-            if channel:
-                channel.send(payload)
-                print("📡 Shared DHT with peer.")
-            else:
-                print("❌ Channel not ready yet.")
+        if channel:
+            size = dht.start_sync(channel, username)
+            print(f"📡 Sent DHT digest ({size} bytes); peer will reply with what differs.")
         else:
-            print("📭 No DHT to share.")
+            print("❌ Channel not ready yet.")
         return True
 
 
     elif text == "/sendonion":
-        global channel
         try:
-            route = input("🔗 Enter onion route (comma-separated usernames): ").strip().lower().split(",")
+            route = (await ask("🔗 Enter onion route (comma-separated usernames): ")).strip().lower().split(",")
             route = [r.strip() for r in route if r.strip()]
-            final_message = input("💬 What is the secret message? ").strip()
+            final_message = (await ask("💬 What is the secret message? ")).strip()
 
             if not route or not final_message:
                 print("❌ Route or message missing.")
                 return True
-
-            from ecdh_encryption import encrypt_message
-            payload = final_message
-            for hop in reversed(route):
-                if hop not in peer_connection.public_keys:
-                    print(f"❌ No public key for {hop}.")
-                    return True
-                payload = encrypt_message(private_key, peer_connection.public_keys[hop], payload)
-
-            first_hop = route[0]
-            full = {
-                "type": "onion",
-                "route": route[1:],  # the rest after first hop
-                "payload": payload
-            }
-
-            # Encrypt outermost layer for first hop
-            outer = encrypt_message(private_key, peer_connection.public_keys[first_hop], json.dumps(full))
-            final_payload = json.dumps({
-                "type": "onion",
-                "route": [first_hop],
-                "payload": outer
-            })
-
-            if channel:
-                channel.send(final_payload)
-                print(f"🧅 Sent onion message through route: {' → '.join(route)}")
-            else:
+            if not channel:
                 print("❌ Channel not ready yet.")
+                return True
 
-            print(f"🧅 Sent onion message through route: {' → '.join(route)}")
+            circuit = await onion.get_circuit(channel, route[-1], route, peer_connection.public_keys)
+            if circuit:
+                onion.send(circuit, final_message)
+                print(f"🧅 Sent onion message through route: {' → '.join(route)}")
 
         except Exception as e:
             print("❌ Error sending onion:", e)
         return True
 
     elif text == "/anonmsg":
-        global channel
-        target = input("👤 Who do you want to message anonymously? ").strip().lower()
+        target = (await ask("👤 Who do you want to message anonymously? ")).strip().lower()
         entry = search_dht(target)
+        if not entry and channel:
+            print("🔎 Asking peers...")
+            entry = await dht.lookup_user(username, target)
         if not entry:
             print("❌ User not found in DHT.")
             return True
 
-        msg = input("💬 What’s the message? ").strip()
-        from ecdh_encryption import encrypt_message
-        from peer_connection import public_keys, channel
+        msg = (await ask("💬 What’s the message? ")).strip()
+        from peer_connection import public_keys
 
-        # Dummy example route (in real case, you'd choose 3 trusted friends)
         route = ROUTE_CACHE.get(target)
         if not route:
             print("❌ No cached route found for that user.")
             return True
-        print(f"🔁 Using route from cache: {' → '.join(route)}")
-
-        # Make sure you have keys
-        for peer in route:
-            if peer not in public_keys:
-                print(f"🔍 Requesting key from {peer}...")
-                channel.send(f"@request_key::{peer}")
-                import time
-                for _ in range(10):
-                    time.sleep(0.5)
-                    if peer in public_keys:
-                        break
-            if peer not in public_keys:
-                print(f"❌ Missing public key for {peer}.")
-                return True
-
-        payload = msg
-        for peer in reversed(route):
-            payload = encrypt_message(private_key, public_keys[peer], payload)
-
-        outer = json.dumps({
-            "type": "onion",
-            "route": route[1:],  # skip first hop
-            "payload": payload
-        })
-
-        wrapped = encrypt_message(private_key, public_keys[route[0]], outer)
-
-        final = json.dumps({
-            "type": "onion",
-            "route": [route[0]],
-            "payload": wrapped
-        })
+        if not channel:
+            print("❌ Channel not ready yet.")
+            return True
 
-        if channel:
-            channel.send(final)
+        # Reuses the circuit until the route rotates or it expires
+        circuit = await onion.get_circuit(channel, target, route, public_keys)
+        if circuit:
+            onion.send(circuit, msg)
             print(f"📤 Sent anonymous message to {target} via: {' → '.join(route)}")
-        else:
-            print("❌ Channel not ready yet.")
 
         return True
 
@@ -907,42 +769,19 @@ def load_group(name):
             return json.load(f).get(name)
     return None
 
-read_encrypted_history()
-
-
-
 
 def update_message_status(recipient, msg_id, status):
-    file = "message_status.json"
-    data = {}
-
-    # Load old data
-    if os.path.exists(file):
-        with open(file, "r", encoding="utf-8") as f:
-            data = json.load(f)
-
-    if recipient not in data:
-        data[recipient] = {}
+    key = state_store.message_key(recipient, msg_id)
 
     # Prevent overwriting "read" with "delivered"
-    current = data[recipient].get(msg_id)
-    if current == "read":
+    if state_store.get("message_status", key) == "read":
         return
 
-    data[recipient][msg_id] = status
-
-    with open(file, "w", encoding="utf-8") as f:
-        json.dump(data, f, indent=2)
+    state_store.put("message_status", key, status)
 
 
 def queue_offline_message(recipient, payload):
-    data = {}
-    if os.path.exists("offline_queue.json"):
-        with open("offline_queue.json", "r", encoding="utf-8") as f:
-            data = json.load(f)
-    data.setdefault(recipient, []).append(payload)
-    with open("offline_queue.json", "w", encoding="utf-8") as f:
-        json.dump(data, f, indent=2)
+    outbox.queue(recipient, payload)
 
 
 
@@ -963,7 +802,7 @@ def try_send_with_retry(websocket, recipient, payload, max_retries=3):
     return False
 
 
-def panic_wipe(username):
+async def panic_wipe(username):
     files_to_delete = [
         "inbox_history.txt",
         "usage_stats.json",
@@ -976,10 +815,12 @@ def panic_wipe(username):
         "sent_ids.json",
         "groups.json",
         "pinned_messages.json",
-        "offline_queue.json"
-    ]
+        "offline_queue.json",
+        "scheduled_messages.json",
+        "scheduled_messages.json.migrated"
+    ] + [name + suffix for name in state_store.LEGACY_FILES.values() for suffix in ("", ".migrated")]
     print("\n⚠️ WARNING: This will delete ALL your local data. This cannot be undone.")
-    confirm = input("Type 'WIPE' to confirm: ").strip()
+    confirm = (await ask("Type 'WIPE' to confirm: ")).strip()
     if confirm != "WIPE":
         print("❌ Panic wipe canceled.")
         return
@@ -989,70 +830,61 @@ def panic_wipe(username):
             os.remove(file)
             print(f"🗑️ Deleted {file}")
 
-    if os.path.exists("vault"):
-        import shutil
-        shutil.rmtree("vault", ignore_errors=True)
-        print("🗑️ Deleted vault folder")
+    state_store.wipe()
+    print(f"🗑️ Deleted {STATE_DB}")
 
-    print("💥 All local data wiped. App reset complete.")
+    import shutil
+    import vault_manager
+    from vault_manager import VAULT_DIR
+    vault_manager.close()
+    if os.path.exists(VAULT_DIR):
+        shutil.rmtree(VAULT_DIR, ignore_errors=True)
+        print(f"🗑️ Deleted {VAULT_DIR} folder")
 
+    message_store.reset()
+    if os.path.exists(MESSAGE_STORE_DIR):
+        shutil.rmtree(MESSAGE_STORE_DIR, ignore_errors=True)
+        print(f"🗑️ Deleted {MESSAGE_STORE_DIR} folder")
 
-from ecdh_encryption import sign_message, verify_signature
+    if os.path.exists(OUTBOX_DIR):
+        shutil.rmtree(OUTBOX_DIR, ignore_errors=True)
+        print(f"🗑️ Deleted {OUTBOX_DIR} folder")
 
-# Start the program
-print("🖋️ Signing test: Verifying message signing works...")
+    for ring in usage_store.RINGS:
+        ring.close()
+    if os.path.exists(USAGE_DIR):
+        shutil.rmtree(USAGE_DIR, ignore_errors=True)
+        print(f"🗑️ Deleted {USAGE_DIR} folder")
+
+    if os.path.exists(file_transfer.TRANSFER_DIR):
+        shutil.rmtree(file_transfer.TRANSFER_DIR, ignore_errors=True)
+        print(f"🗑️ Deleted {file_transfer.TRANSFER_DIR} folder")
+
+    print("💥 All local data wiped. App reset complete.")
 
-test = "Hello"
-sig = sign_message(private_key, test)
-if verify_signature(public_key, test, sig):
-    print("✅ Signature valid.")
-else:
-    print("❌ Signature failed.")
 
 def cleanup_message_state():
-    import json
     removed_entries = {"sent_ids": 0, "message_status": 0, "unread_count": 0}
-
-    # Clean sent_ids.json
-    if os.path.exists("sent_ids.json"):
-        with open("sent_ids.json", "r", encoding="utf-8") as f:
-            sent_ids = json.load(f)
-        for user in list(sent_ids.keys()):
-            for msg_id in list(sent_ids[user].keys()):
-                if os.path.exists("message_status.json"):
-                    with open("message_status.json", "r", encoding="utf-8") as mf:
-                        status_data = json.load(mf)
-                    if user in status_data and msg_id in status_data[user]:
-                        if status_data[user][msg_id] == "read":
-                            del sent_ids[user][msg_id]
-                            removed_entries["sent_ids"] += 1
-            if not sent_ids[user]:
-                del sent_ids[user]
-        with open("sent_ids.json", "w", encoding="utf-8") as f:
-            json.dump(sent_ids, f, indent=2)
-
-    # Clean message_status.json
-    if os.path.exists("message_status.json"):
-        with open("message_status.json", "r", encoding="utf-8") as f:
-            status_data = json.load(f)
-        for user in list(status_data.keys()):
-            for msg_id in list(status_data[user].keys()):
-                if status_data[user][msg_id] == "read":
-                    del status_data[user][msg_id]
-                    removed_entries["message_status"] += 1
-            if not status_data[user]:
-                del status_data[user]
-        with open("message_status.json", "w", encoding="utf-8") as f:
-            json.dump(status_data, f, indent=2)
-
-    # Clean unread_count.json
-    if os.path.exists("unread_count.json"):
-        with open("unread_count.json", "r", encoding="utf-8") as f:
-            unread_data = json.load(f)
-        unread_data = {k: v for k, v in unread_data.items() if v > 0}
-        removed_entries["unread_count"] += 1
-        with open("unread_count.json", "w", encoding="utf-8") as f:
-            json.dump(unread_data, f, indent=2)
+    status_data = state_store.items("message_status")
+
+    with state_store.transaction():
+        # Clean sent ids that were already read
+        for key in state_store.keys("sent_ids"):
+            if status_data.get(key) == "read":
+                state_store.delete("sent_ids", key)
+                removed_entries["sent_ids"] += 1
+
+        # Clean read statuses
+        for key, status in status_data.items():
+            if status == "read":
+                state_store.delete("message_status", key)
+                removed_entries["message_status"] += 1
+
+        # Clean zero unread counts
+        for user, count in state_store.items("unread_count").items():
+            if count <= 0:
+                state_store.delete("unread_count", user)
+                removed_entries["unread_count"] += 1
 
     print("🧹 Cleanup complete:", removed_entries)
 
@@ -1063,27 +895,21 @@ def handle_incoming_receipt(msg: str):
         print(f"👀 Message read by {reader} (✅✅✨)")
 
         # ✅ Reset unread count to 0 when they read it
-        unread_file = "unread_count.json"
         try:
-            if os.path.exists(unread_file):
-                with open(unread_file, "r", encoding="utf-8") as f:
-                    data = json.load(f)
-                if reader in data:
-                    data[reader] = 0
-                    with open(unread_file, "w", encoding="utf-8") as f:
-                        json.dump(data, f, indent=2)
-                    print(f"🔄 Unread count reset for {reader}")
+            if state_store.get("unread_count", reader) is not None:
+                state_store.put("unread_count", reader, 0)
+                print(f"🔄 Unread count reset for {reader}")
         except Exception as e:
             print("⚠️ Could not reset unread count:", e)
 
     elif msg.startswith("@delivered::"):
-        reader = msg.split("::")[1]
+        parts = msg.split("::")
+        reader = parts[1]
+        if len(parts) < 3 or not parts[2]:
+            return  # without the message hash there is nothing to confirm
         print(f"📬 Message delivered to {reader} (✅)")
+        outbox.ack(reader, parts[2])
 
-cleanup_message_state()
-
-import re
-from emoji_store import load_emojis
 
 
 def check_for_reminder(text, sender):
@@ -1096,22 +922,27 @@ def check_for_reminder(text, sender):
         if "min" in unit:
             seconds *= 60
 
-        def remind_later():
-            time.sleep(seconds)
-            print(f"⏰ Reminder: {sender} asked to be reminded '{text}'")
-
-        threading.Thread(target=remind_later, daemon=True).start()
+        scheduler.schedule_in("reminder", seconds, {"sender": sender, "text": text})
         print(f"🧠 Reminder set for {number} {unit}.")
 
-def load_scheduled_messages():
-    if os.path.exists("scheduled_messages.json"):
-        with open("scheduled_messages.json", "r", encoding="utf-8") as f:
-            return json.load(f)
-    return []
 
-def save_scheduled_messages(messages):
-    with open("scheduled_messages.json", "w", encoding="utf-8") as f:
-        json.dump(messages, f, indent=2)
+def remind(job):
+    print(f"⏰ Reminder: {job['sender']} asked to be reminded '{job['text']}'")
+
+
+def migrate_scheduled_messages(path="scheduled_messages.json"):
+    """Turn entries of the old scheduled_messages.json into scheduler jobs."""
+    if not os.path.exists(path):
+        return
+    with open(path, "r", encoding="utf-8") as f:
+        messages = json.load(f)
+    with state_store.transaction():
+        for msg in messages:
+            send_time = datetime.strptime(msg["time"], "%Y-%m-%d %H:%M")
+            scheduler.schedule("scheduled_message", send_time.timestamp(), {"to": msg["to"], "text": msg["text"]})
+    os.replace(path, path + ".migrated")
+    print(f"📦 Migrated {len(messages)} scheduled messages")
+
 
 def schedule_message(recipient, text, send_time_str):
     try:
@@ -1119,48 +950,127 @@ def schedule_message(recipient, text, send_time_str):
     except ValueError:
         print("❌ Invalid format. Use YYYY-MM-DD HH:MM")
         return
-    messages = load_scheduled_messages()
-    messages.append({
-        "to": recipient,
-        "text": text,
-        "time": send_time_str
-    })
-    save_scheduled_messages(messages)
+    scheduler.schedule("scheduled_message", send_time.timestamp(), {"to": recipient, "text": text})
     print(f"⏳ Scheduled message to {recipient} at {send_time_str}")
 
-def start_scheduled_sender(channel, username, private_key, public_key, encrypt_message, sign_message):
-    def check_loop():
-        while True:
-            now = datetime.now()
-            messages = load_scheduled_messages()
-            remaining = []
-            for msg in messages:
-                send_time = datetime.strptime(msg["time"], "%Y-%m-%d %H:%M")
-                if now >= send_time:
-                    text = msg["text"]
-                    recipient = msg["to"]
-                    from hashlib import sha256
-                    emojis = load_emojis()
-                    for name, symbol in emojis.items():
-                        text = text.replace(f":{name}:", symbol)
-                    msg_hash = sha256(text.encode()).hexdigest()
-                    encrypted = encrypt_message(private_key, peer_connection.public_keys.get(recipient, ""), text)
-                    signature = sign_message(private_key, text)
-                    payload = f"@msg::{username}::{msg_hash}::None::{encrypted}::{signature}"
-                    channel.send(payload)
-                    print(f"📤 Sent scheduled message to {recipient}")
-                else:
-                    remaining.append(msg)
-            save_scheduled_messages(remaining)
-            time.sleep(60)
-    t = threading.Thread(target=check_loop, daemon=True)
-    t.start()
-
-
-
-asyncio.run(start_webrtc_chat(username, private_key, public_key))
-import __main__
-channel = getattr(__main__, "channel", None)
-# ✅ Start auto route rotation (every 3 minutes)
-t = threading.Thread(target=auto_rotate_routes, args=(peer_connection.public_keys,), daemon=True)
-t.start()
+
+async def dht_maintenance(username):
+    await dht.refresh_buckets(username)
+    dht.save()
+
+
+def start_scheduled_jobs(channel, username, private_key, encrypt_message, sign_message):
+    """Register the chat session's job handlers and start the scheduler."""
+
+    def send_scheduled(job):
+        recipient = job["to"]
+        if recipient not in peer_connection.public_keys:
+            # No key yet: try again in a minute, like the old polling loop did
+            scheduler.schedule_in("scheduled_message", 60, job)
+            return
+        text = job["text"]
+        for name, symbol in load_emojis().items():
+            text = text.replace(f":{name}:", symbol)
+        msg_hash = hashlib.sha256(text.encode()).hexdigest()
+        encrypted = encrypt_message(private_key, peer_connection.public_keys[recipient], text)
+        signature = sign_message(private_key, text)
+        payload = f"@msg::{username}::{msg_hash}::None::{encrypted}::{signature}"
+        connection_pool.send(recipient, payload)
+        print(f"📤 Sent scheduled message to {recipient}")
+
+    async def backup(job):
+        if should_backup():
+            await asyncio.get_running_loop().run_in_executor(None, create_auto_backup, username)
+
+    scheduler.register("scheduled_message", send_scheduled)
+    scheduler.register("auto_backup", backup)
+    scheduler.register("outbox_expire", outbox.expire_all)
+    scheduler.register("dht_maintenance", lambda job: dht_maintenance(username))
+    migrate_scheduled_messages()
+    scheduler.start()
+    scheduler.schedule_in("rotate_routes", 0, every=ROUTE_ROTATE_SECONDS, job_id="rotate_routes", persist=False)
+    scheduler.schedule_in("auto_backup", 60, every=3600, job_id="auto_backup", persist=False)
+    scheduler.schedule_in("outbox_expire", 300, every=3600, job_id="outbox_expire", persist=False)
+    scheduler.schedule_in("transfers_expire", 600, every=3600, job_id="transfers_expire", persist=False)
+    scheduler.schedule_in("dht_maintenance", 60, every=300, job_id="dht_maintenance", persist=False)
+    scheduler.schedule_in("onion_maintenance", onion.PADDING_INTERVAL, every=onion.PADDING_INTERVAL,
+                          job_id="onion_maintenance", persist=False)
+    scheduler.schedule_in("presence_heartbeat", presence.HEARTBEAT_EVERY, every=presence.HEARTBEAT_EVERY,
+                          job_id="presence_heartbeat", persist=False)
+    scheduler.schedule_in("connection_maintenance", 60, every=60, job_id="connection_maintenance", persist=False)
+    scheduler.schedule_in("presence_flush", presence.FLUSH_INTERVAL, every=presence.FLUSH_INTERVAL,
+                          job_id="presence_flush", persist=False)
+    scheduler.schedule_in("usage_flush", usage_store.FLUSH_INTERVAL, every=usage_store.FLUSH_INTERVAL,
+                          job_id="usage_flush", persist=False)
+    if metrics_port:
+        asyncio.get_running_loop().create_task(metrics.serve(metrics_port))
+
+
+scheduler.register("reminder", remind)
+scheduler.register("rotate_routes", lambda job: rotate_routes(peer_connection.public_keys))
+scheduler.register("cleanup_message_state", lambda job: cleanup_message_state())
+
+
+def main(argv=None):
+    global username, password, private_key, public_key, profile, status, metrics_port
+    argv = sys.argv[1:] if argv is None else list(argv)
+    profile_startup = "--profile-startup" in argv
+    if profile_startup:
+        argv.remove("--profile-startup")
+    app_log.configure(**app_log.options_from_args(argv))
+    if "--metrics-port" in argv:
+        i = argv.index("--metrics-port")
+        if i + 1 >= len(argv):
+            raise SystemExit("❌ --metrics-port needs a value")
+        metrics_port = int(argv[i + 1])
+    _phases.append(("imports", time.perf_counter() - _IMPORT_START))
+
+    with phase("pin"):
+        from dotenv import load_dotenv
+        from app_lock import check_pin
+
+        load_dotenv()
+        if not check_pin():
+            sys.exit(1)  # 🔒 Stop app if PIN is wrong
+
+    with phase("login"):
+        from auth import login_local
+
+        username, password = login_local()
+    if not username:
+        sys.exit(1)
+
+    with phase("keys"):
+        from key_storage import load_or_create_keys, rotate_keys, rotate_keys_if_expired
+
+        if input('🔁 Rotate encryption keys before starting? (yes/no): ').strip().lower() == 'yes':
+            print('🔐 Rotating keys...')
+            private_key, public_key = rotate_keys(f"{username}_keys.json")
+        else:
+            private_key, public_key = load_or_create_keys(f"{username}_keys.json")
+        rotate_keys_if_expired()
+
+    with phase("profile + dht"):
+        profile = load_profile()
+        status = profile["status"]
+        announce_to_dht(username, public_key, profile)
+
+    with phase("history"):
+        message_store.ensure_index()
+        message_store.migrate_legacy_history()
+        load_search_index()
+        read_encrypted_history()
+
+    # Housekeeping that used to block startup runs shortly after the prompt
+    scheduler.schedule_in("cleanup_message_state", 5, job_id="cleanup_message_state", persist=False)
+
+    if profile_startup:
+        print_startup_profile()
+    asyncio.run(peer_connection.start_webrtc_chat(username, private_key, public_key, console.source_from_args(argv)))
+
+
+if __name__ == "__main__":
+    # peer_connection imports helpers from "user_send"; make that name this module
+    # instead of a second copy of it
+    sys.modules.setdefault("user_send", sys.modules[__name__])
+    main()
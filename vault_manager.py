@@ -1,18 +1,284 @@
+# vault_manager.py – Chunked, encrypted local vault for received files
+#
+#   .vault/vault.key        the vault key, sealed with a key derived from recovery.key
+#   .vault/index.vault      encrypted index: file id -> name, size, sha256, sender, received, ...
+#   .vault/<file id>.blob   fixed-size sealed chunks: nonce | ciphertext | tag
+#
+# Every chunk is sealed on its own (AAD = file id + chunk number), so a file is
+# written and exported with one chunk in memory, and read_range() decrypts only
+# the chunks it touches. The key does not depend on the user's key pair, so
+# rotating keys keeps the vault readable, and the backend used for each file is
+# recorded in the index. Files from the old
+# format (<name>.vault, one encrypt_message blob) can still be loaded.
+
+import hashlib
+import json
 import os
-from ecdh_encryption import encrypt_message, decrypt_message
+import secrets
+import struct
+import threading
+import time
+
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+from constants import VAULT_BACKEND
+from crypto_provider import PROVIDERS, cipher
+from ecdh_encryption import decrypt_message, get_session_key
+from key_storage import derive_local_key
 
 VAULT_DIR = ".vault"
+INDEX_FILE = os.path.join(VAULT_DIR, "index.vault")
+KEY_FILE = os.path.join(VAULT_DIR, "vault.key")
+CHUNK_SIZE = 64 * 1024
+TAG_SIZE = 16
+
+_key = None
+_index = None
+_lock = threading.RLock()
+
+
+def _legacy_key(private_key, public_key):
+    """The key vaults used before vault.key: tied to the key pair, so rotation broke it."""
+    return HKDF(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=None,
+        info=b"siphrix-vault",
+    ).derive(get_session_key(private_key, public_key))
+
+
+def _unlock(private_key, public_key):
+    """(key, index). The key is random and stored in vault.key, sealed with a key
+    from recovery.key; an older vault keeps its key pair key, which is sealed the
+    first time it opens."""
+    wrap = cipher(derive_local_key(b"siphrix-vault-key"))
+    index = {}
+    if os.path.exists(KEY_FILE):
+        with open(KEY_FILE, "rb") as f:
+            key = wrap.open(f.read(), b"vault-key")
+    elif os.path.exists(INDEX_FILE):
+        key = _legacy_key(private_key, public_key)
+    else:
+        key = secrets.token_bytes(32)
+    if os.path.exists(INDEX_FILE):
+        with open(INDEX_FILE, "rb") as f:
+            index = json.loads(cipher(key).open(f.read(), b"index"))
+    if not os.path.exists(KEY_FILE):
+        os.makedirs(VAULT_DIR, exist_ok=True)
+        with open(KEY_FILE + ".tmp", "wb") as f:
+            f.write(wrap.seal(key, b"vault-key"))
+        os.replace(KEY_FILE + ".tmp", KEY_FILE)
+    return key, index
+
+
+def open_vault(private_key, public_key):
+    """Load the vault key and index (cheap to call again). False if it cannot be decrypted."""
+    global _key, _index
+    with _lock:
+        if _index is not None:
+            return True
+        try:
+            _key, _index = _unlock(private_key, public_key)
+        except (InvalidTag, ValueError) as e:
+            print("❌ Could not decrypt the vault; its files are left as they are:", type(e).__name__)
+            return False
+        return True
+
+
+def close():
+    global _key, _index
+    with _lock:
+        _key = _index = None
+
+
+def _require():
+    if _key is None:
+        raise RuntimeError("vault is not open")
+
+
+def _save_index():
+    os.makedirs(VAULT_DIR, exist_ok=True)
+    tmp = INDEX_FILE + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(cipher(_key).seal(json.dumps(_index).encode(), b"index"))
+    os.replace(tmp, INDEX_FILE)
+
+
+def _blob_path(file_id):
+    return os.path.join(VAULT_DIR, file_id + ".blob")
+
+
+def _aad(file_id, n):
+    return file_id.encode() + struct.pack(">Q", n)
+
+
+def _record_size(entry):
+    return PROVIDERS[entry["backend"]].nonce_size + entry["chunk_size"] + TAG_SIZE
+
+
+# === Writing ===
+
+
+def store_stream(chunks, name, sender=None):
+    """Encrypt an iterable of byte chunks into the vault. Returns the index entry."""
+    _require()
+    file_id = secrets.token_hex(16)
+    aead = cipher(_key, VAULT_BACKEND)
+    digest = hashlib.sha256()
+    size = n = 0
+
+    def write(piece):
+        nonlocal size, n
+        out.write(aead.seal(piece, _aad(file_id, n)))
+        digest.update(piece)
+        size += len(piece)
+        n += 1
+
+    os.makedirs(VAULT_DIR, exist_ok=True)
+    buffer = b""
+    with open(_blob_path(file_id), "wb") as out:
+        for data in chunks:
+            # Re-cut to CHUNK_SIZE so every record but the last has the same length
+            view = memoryview(data)
+            if buffer:
+                take = CHUNK_SIZE - len(buffer)
+                buffer += bytes(view[:take])
+                view = view[take:]
+                if len(buffer) < CHUNK_SIZE:
+                    continue
+                write(buffer)
+            while len(view) >= CHUNK_SIZE:
+                write(view[:CHUNK_SIZE])
+                view = view[CHUNK_SIZE:]
+            buffer = bytes(view)
+        if buffer or n == 0:
+            write(buffer)
+
+    entry = {
+        "id": file_id, "name": name, "size": size, "sha256": digest.hexdigest(),
+        "sender": sender, "received": time.time(), "chunks": n,
+        "chunk_size": CHUNK_SIZE, "backend": VAULT_BACKEND,
+    }
+    with _lock:
+        _index[file_id] = entry
+        _save_index()
+    return entry
+
+
+def _read_chunks(path):
+    with open(path, "rb") as f:
+        while True:
+            data = f.read(CHUNK_SIZE)
+            if not data:
+                return
+            yield data
+
+
+def store_file(path, name=None, sender=None):
+    """Stream a file from disk into the vault (blocking; fine for very large files)."""
+    entry = store_stream(_read_chunks(path), name or os.path.basename(path), sender)
+    print(f"🔒 Saved {entry['name']} to the vault ({entry['size']} bytes)")
+    return entry
+
+
+def store_bytes(name, data, sender=None):
+    return store_stream([data], name, sender)
+
+
+def delete_file(file_id):
+    _require()
+    with _lock:
+        if _index.pop(file_id, None) is None:
+            return False
+        _save_index()
+    if os.path.exists(_blob_path(file_id)):
+        os.remove(_blob_path(file_id))
+    return True
+
+
+# === Reading ===
+
+
+def list_files():
+    """Index entries, newest first."""
+    _require()
+    with _lock:
+        return sorted(_index.values(), key=lambda entry: entry["received"], reverse=True)
+
+
+def find(name):
+    """The newest entry called `name` (or with that file id), or None."""
+    for entry in list_files():
+        if entry["name"] == name or entry["id"] == name:
+            return entry
+    return None
+
+
+def iter_file(entry, first=0, last=None):
+    """Yield decrypted chunks `first`..`last` (inclusive) of an index entry."""
+    aead = cipher(_key, entry["backend"])
+    record = _record_size(entry)
+    last = entry["chunks"] - 1 if last is None else last
+    with open(_blob_path(entry["id"]), "rb") as f:
+        f.seek(first * record)
+        for n in range(first, last + 1):
+            yield aead.open(f.read(record), _aad(entry["id"], n))
+
+
+def read_range(entry, offset, length):
+    """`length` bytes from `offset`, decrypting only the chunks that cover them."""
+    end = min(offset + length, entry["size"])
+    if offset >= end:
+        return b""
+    size = entry["chunk_size"]
+    first, last = offset // size, (end - 1) // size
+    data = b"".join(iter_file(entry, first, last))
+    start = offset - first * size
+    return data[start:start + end - offset]
+
+
+def export_file(entry, dest_path):
+    """Decrypt an entry to `dest_path` chunk by chunk and check its hash."""
+    digest = hashlib.sha256()
+    tmp = dest_path + ".part"
+    with open(tmp, "wb") as out:
+        for data in iter_file(entry):
+            digest.update(data)
+            out.write(data)
+    if digest.hexdigest() != entry["sha256"]:
+        os.remove(tmp)
+        raise ValueError(f"vault file {entry['name']} failed its integrity check")
+    os.replace(tmp, dest_path)
+    return dest_path
+
+
+# === Old API ===
 
 
 def save_encrypted_to_vault(filename, data, private_key, public_key):
-    encrypted = encrypt_message(private_key, public_key, data)
-    path = os.path.join(VAULT_DIR, filename + ".vault")
-    with open(path, "w", encoding="utf-8") as f:
-        f.write(encrypted)
-    print(f"🔒 Saved encrypted file to {path}")
+    if not open_vault(private_key, public_key):
+        return None
+    entry = store_bytes(filename, data.encode() if isinstance(data, str) else data)
+    print(f"🔒 Saved {filename} to the vault ({entry['size']} bytes)")
+    return entry
 
 
-def load_encrypted_from_vault(filename, private_key, public_key):
+def load_encrypted_from_vault(filename, private_key, public_key, limit=64 * 1024):
+    """Text of a vault file (first `limit` bytes), from the index or an old .vault file."""
+    if not open_vault(private_key, public_key):
+        return None
+    entry = find(filename)
+    if entry is not None:
+        try:
+            data = read_range(entry, 0, limit)
+        except Exception as e:
+            print("❌ Failed to decrypt vault file:", e)
+            return None
+        print(f"🔓 Decrypted {filename}")
+        return data.decode(errors="replace")
+
     path = os.path.join(VAULT_DIR, filename + ".vault")
     if not os.path.exists(path):
         print("❌ File not found in vault.")
@@ -0,0 +1,333 @@
+# wire_format.py – Versioned binary envelope for data-channel frames
+#
+# Legacy frames are "::"-delimited text ("@msg::sender::hash::expiry::ct::sig")
+# where the ciphertext is base64url and hashes/signatures are hex. Once both
+# sides have exchanged "@hello::<user>::<version>", frames are sent as bytes:
+#
+#   magic (1) | version (1) | type tag (1) | flags (1) | message id (8)
+#   then per field: uvarint length + raw bytes   (field 0 is the sender id)
+#
+# Ciphertext, hashes and signatures travel as raw bytes, and the receiver reads
+# fields by length instead of splitting strings. Frames without a schema (legacy
+# JSON onion / DHT frames, unknown commands) are always sent as text.
+#
+# Trailing fields may be omitted, so a schema can grow optional fields at the
+# end: older decoders ignore what they don't know, newer ones get fewer fields.
+#
+# Versions: 1 = binary envelope, 2 = + streaming file transfer (xfer_* frames),
+# 3 = + sender-key group messages (gkey / gmsg), 4 = + onion circuits (circ_*,
+# cell), 5 = + signed hello (auth_challenge / auth_proof). A frame type is only
+# sent as binary once the peer's version includes its schema.
+#
+# The name in a hello is only a claim. From version 5 each side answers the
+# other's hello with a random challenge, and the peer signs
+# "hello:<user>:<challenger>:<challenge>" (auth_proof); naming the challenger
+# keeps a proof from being relayed to someone else. verified_peer() is set
+# only once that signature checks out against the key we hold for <user>.
+
+import os
+
+import metrics
+import usage_store
+from ecdh_encryption import b64url, from_b64url, sign_message, verify_signature
+
+MAGIC = 0xB5
+WIRE_VERSION = 5
+HEADER_SIZE = 12
+
+FLAG_NONE = 0x00
+
+# Field codecs: how a legacy text field maps to bytes on the wire
+STR, HEX, CIPHER, SIG, UINT, BYTES = "str", "hex", "cipher", "sig", "uint", "bytes"
+
+# type name -> (tag, field codecs)
+SCHEMAS = {
+    "ping": (1, (STR,)),
+    "pong": (2, (STR,)),
+    "key": (3, (STR, STR)),
+    "request_key": (4, (STR,)),
+    "key_for": (5, (STR, STR)),
+    "typing": (6, (STR,)),
+    "stop_typing": (7, (STR,)),
+    "reaction": (8, (STR, STR, STR)),
+    "edit": (9, (STR, STR, STR)),
+    "delete": (10, (STR, STR)),
+    "file": (11, (STR, STR, HEX, STR, CIPHER)),
+    "msg": (12, (STR, HEX, STR, CIPHER, SIG)),
+    "read": (13, (STR,)),
+    # receiver, optional hash of the delivered @msg / @file (acks the sender's outbox)
+    "delivered": (14, (STR, HEX)),
+    # sender, transfer id, filename, size, chunk size, nonce prefix, expiry
+    "xfer_start": (20, (STR, STR, STR, STR, STR, HEX, STR)),
+    # sender, transfer id, sequence number, sealed chunk
+    "xfer_chunk": (21, (STR, STR, UINT, BYTES)),
+    # sender, transfer id, chunk count, sha256 of the whole file
+    "xfer_end": (22, (STR, STR, STR, HEX)),
+    # receiver, transfer id, next expected sequence number
+    "xfer_resume": (23, (STR, STR, STR)),
+    # receiver, transfer id, status
+    "xfer_done": (24, (STR, STR, STR)),
+    # sender, group, epoch, sender key sealed for one member
+    "gkey": (25, (STR, STR, STR, CIPHER)),
+    # requester, group sender, group, epoch
+    "gkey_request": (26, (STR, STR, STR, STR)),
+    # sender, group, epoch, message number, ciphertext, signature
+    "gmsg": (27, (STR, STR, STR, UINT, CIPHER, SIG)),
+    # circuit id on this link, padded create layers
+    "circ_create": (28, (HEX, BYTES)),
+    # circuit id on this link, fixed-size onion cell
+    "cell": (29, (HEX, BYTES)),
+    # circuit id on this link
+    "circ_destroy": (30, (HEX,)),
+    # random challenge to sign
+    "auth_challenge": (31, (HEX,)),
+    # sender, signature over "hello:<sender>:<challenger>:<challenge>"
+    "auth_proof": (32, (STR, SIG)),
+}
+# Schemas added after version 1: type -> first wire version that knows them
+SCHEMA_VERSIONS = {
+    "xfer_start": 2, "xfer_chunk": 2, "xfer_end": 2, "xfer_resume": 2, "xfer_done": 2,
+    "gkey": 3, "gkey_request": 3, "gmsg": 3,
+    "circ_create": 4, "cell": 4, "circ_destroy": 4,
+    "auth_challenge": 5, "auth_proof": 5,
+}
+TAGS = {tag: (name, codecs) for name, (tag, codecs) in SCHEMAS.items()}
+
+# Negotiated version per open channel (id(channel) -> version)
+_peer_versions = {}
+_peer_names = {}  # id(channel) -> username from their hello
+_hello_sent = set()
+_challenges = {}  # id(channel) -> challenge we sent the peer
+_verified = {}  # id(channel) -> username that signed our challenge
+
+
+# === Varints ===
+
+
+def _put_uvarint(out, value):
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _get_uvarint(buf, pos):
+    result = shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+
+# === Field codecs ===
+
+
+def _encode_field(codec, value):
+    if codec == CIPHER:
+        iv_b64, enc_b64 = value.split(".")
+        return from_b64url(iv_b64) + from_b64url(enc_b64)
+    if codec in (HEX, SIG):
+        return bytes.fromhex(value)
+    if codec == UINT:
+        return int(value).to_bytes(8, "big")
+    if codec == BYTES:
+        return value if isinstance(value, (bytes, bytearray)) else from_b64url(value)
+    return value.encode()
+
+
+def _decode_field(codec, raw):
+    # Ciphertext and signatures stay bytes: decrypt_message / verify_signature
+    # accept them directly, so the receive path never touches base64 or hex.
+    if codec in (CIPHER, SIG, BYTES):
+        return bytes(raw)
+    if codec == UINT:
+        return int.from_bytes(raw, "big")
+    if codec == HEX:
+        return raw.hex()
+    return str(raw, "utf-8")
+
+
+# === Frames ===
+
+
+def encode_frame(msg_type, fields, flags=FLAG_NONE, msg_id=None):
+    tag, codecs = SCHEMAS[msg_type]
+    if not 0 < len(fields) <= len(codecs):
+        raise ValueError(f"{msg_type} expects up to {len(codecs)} fields, got {len(fields)}")
+    # The version byte is the one that introduced this layout, so older peers
+    # that know the type can still decode it
+    out = bytearray((MAGIC, SCHEMA_VERSIONS.get(msg_type, 1), tag, flags))
+    out += msg_id or os.urandom(8)
+    for codec, value in zip(codecs, fields):
+        raw = _encode_field(codec, value)
+        _put_uvarint(out, len(raw))
+        out += raw
+    return bytes(out)
+
+
+def decode_frame(frame):
+    """Return (type, fields) for a binary envelope; fields match the legacy text order."""
+    buf = memoryview(frame)
+    if len(buf) < HEADER_SIZE or buf[0] != MAGIC:
+        raise ValueError("Not a binary frame")
+    if buf[1] > WIRE_VERSION:
+        raise ValueError(f"Unsupported wire version {buf[1]}")
+    msg_type, codecs = TAGS[buf[2]]
+    pos = HEADER_SIZE
+    fields = []
+    for codec in codecs:
+        if pos >= len(buf):
+            break  # omitted trailing fields
+        size, pos = _get_uvarint(buf, pos)
+        fields.append(_decode_field(codec, buf[pos:pos + size]))
+        pos += size
+    return msg_type, fields
+
+
+def frame_header(frame):
+    """(version, type, flags, message id) without decoding the fields."""
+    return frame[1], TAGS[frame[2]][0], frame[3], bytes(frame[4:12])
+
+
+def is_binary_frame(frame):
+    return isinstance(frame, (bytes, bytearray)) and len(frame) >= HEADER_SIZE and frame[0] == MAGIC
+
+
+def text_to_binary(text):
+    """Convert a legacy text frame to an envelope, or None if it has no schema."""
+    if not text.startswith("@"):
+        return None
+    head, sep, rest = text.partition("::")
+    schema = SCHEMAS.get(head[1:])
+    if not sep or schema is None:
+        return None
+    fields = rest.split("::", len(schema[1]) - 1)
+    try:
+        return encode_frame(head[1:], fields)
+    except (ValueError, KeyError):
+        return None
+
+
+def binary_to_text(frame):
+    msg_type, fields = decode_frame(frame)
+    codecs = SCHEMAS[msg_type][1]
+    parts = []
+    for codec, value in zip(codecs, fields):
+        if codec == CIPHER:
+            value = f"{b64url(value[:12])}.{b64url(value[12:])}"
+        elif codec == SIG:
+            value = value.hex()
+        elif codec == BYTES:
+            value = b64url(value)
+        parts.append(str(value))
+    return "@" + msg_type + "::" + "::".join(parts)
+
+
+# === Per-connection negotiation ===
+
+
+def send_hello(channel, username):
+    """Advertise our wire version once per channel (always as text)."""
+    if id(channel) not in _hello_sent:
+        _hello_sent.add(id(channel))
+        send_raw(channel, f"@hello::{username}::{WIRE_VERSION}", "hello")
+
+
+def on_hello(channel, fields, username):
+    """Handle "@hello::user::version": agree on min(ours, theirs) and answer once."""
+    try:
+        version = min(int(fields[1]), WIRE_VERSION)
+    except (IndexError, ValueError):
+        version = 0
+    _peer_versions[id(channel)] = version
+    _peer_names[id(channel)] = fields[0] if fields else None
+    send_hello(channel, username)
+    return version
+
+
+def peer_version(channel):
+    return _peer_versions.get(id(channel), 0)
+
+
+def peer_name(channel):
+    """Username that said hello on `channel` (who frames sent on it go to)."""
+    return _peer_names.get(id(channel))
+
+
+def _hello_text(username, challenger, challenge):
+    return f"hello:{username}:{challenger}:{challenge}"
+
+
+def send_challenge(channel):
+    """Ask the peer on `channel` to prove the name in its hello (once per channel)."""
+    if id(channel) not in _challenges:
+        _challenges[id(channel)] = os.urandom(16).hex()
+        send_frame(channel, f"@auth_challenge::{_challenges[id(channel)]}")
+
+
+def answer_challenge(channel, username, private_key, challenge):
+    """Sign the peer's challenge; needs its hello first, to know who we are answering."""
+    challenger = peer_name(channel)
+    if challenger:
+        signature = sign_message(private_key, _hello_text(username, challenger, challenge))
+        send_frame(channel, f"@auth_proof::{username}::{signature}")
+
+
+def on_proof(channel, username, name, signature, public_key):
+    """Check an auth_proof against our challenge; True once `name` is proven on `channel`."""
+    challenge = _challenges.get(id(channel))
+    if challenge is None or public_key is None or name != peer_name(channel):
+        return False
+    if not verify_signature(public_key, _hello_text(name, username, challenge), signature):
+        return False
+    _verified[id(channel)] = name
+    return True
+
+
+def verified_peer(channel):
+    """Username that proved its hello on `channel`, or None."""
+    return _verified.get(id(channel))
+
+
+def forget_channel(channel):
+    _peer_versions.pop(id(channel), None)
+    _peer_names.pop(id(channel), None)
+    _hello_sent.discard(id(channel))
+    _challenges.pop(id(channel), None)
+    _verified.pop(id(channel), None)
+
+
+def frame_type(frame):
+    """Type name of a frame in any shape ("json" for legacy JSON frames)."""
+    if is_binary_frame(frame):
+        return TAGS[frame[2]][0] if frame[2] in TAGS else "binary"
+    if isinstance(frame, (bytes, bytearray)):
+        return "raw"
+    if frame.startswith("@"):
+        end = frame.find("::")
+        return frame[1:end] if end > 0 else frame[1:]
+    return "json" if frame.startswith("{") else "raw"
+
+
+def send_raw(channel, frame, msg_type=None):
+    """channel.send() plus the frames_out / bytes_out counters and usage history."""
+    channel.send(frame)
+    msg_type = msg_type or frame_type(frame)
+    metrics.inc("frames_out_total", type=msg_type)
+    metrics.inc("bytes_out_total", len(frame))
+    usage_store.record(usage_store.OUT, msg_type, len(frame), _verified.get(id(channel)))
+
+
+def send_frame(channel, frame):
+    """Send a legacy text frame, as a binary envelope when the peer supports it."""
+    version = peer_version(channel)
+    msg_type = frame_type(frame)
+    if isinstance(frame, str) and version >= 1:
+        binary = text_to_binary(frame) if version >= SCHEMA_VERSIONS.get(msg_type, 1) else None
+        if binary is not None:
+            send_raw(channel, binary, msg_type)
+            return
+    send_raw(channel, frame, msg_type)